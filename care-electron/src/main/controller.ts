@@ -380,6 +380,43 @@ function terminateSubprocess() {
   subProcess = null
 }
 
+// The AI runs report the time, CPU and memory of each of their stages as METRIC: lines on stdout,
+// one JSON object per stage (see python/tracing.py). The metrics of the latest run are kept.
+type StageMetric = {
+  task: string
+  span: string
+  calls: number
+  items: number
+  wall_s: number
+  cpu_s: number
+  peak_rss_mb: number
+}
+let runMetrics: StageMetric[] = []
+
+function metricsCollector() {
+  // Returns a stdout listener for a new run, which collects its METRIC: lines.
+  runMetrics = []
+  let partialLine = ''
+  return (data: Buffer | string) => {
+    const lines = (partialLine + data.toString()).split('\n')
+    partialLine = lines.pop() ?? ''
+    for (const line of lines) {
+      const match = /^METRIC: (.*)$/.exec(line.trim())
+      if (match) {
+        try {
+          runMetrics.push(JSON.parse(match[1]))
+        } catch {
+          console.warn(`Invalid metric: ${line}`)
+        }
+      }
+    }
+  }
+}
+
+export function getRunMetrics() {
+  return runMetrics
+}
+
 function conda(): boolean {
   try {
     const ps = spawnSync('conda info')
@@ -492,8 +529,10 @@ export async function detect(selectedPaths: string[], stream: (txt: string) => v
     subProcess = ps
 
     if (ps && ps.stdout) {
+      const collectMetrics = metricsCollector()
       ps.stdout.on('data', (data) => {
         console.log(`stdout: ${data}`)
+        collectMetrics(data)
         stream(data)
       })
     }
@@ -501,6 +540,7 @@ export async function detect(selectedPaths: string[], stream: (txt: string) => v
     return await new Promise((resolve, reject) => {
       ps.on('close', (code) => {
         console.log(`child process exited with code ${code}`)
+        if (runMetrics.length) console.table(runMetrics)
         fs.remove(tempPath)
         if (code != 0) {
           reject({ ok: false, error: 'ERROR: Detection AI model error, please contact support.' })
@@ -581,7 +621,9 @@ export async function browseDetectImage(
         )
 
         // Step 3: Extract label and confidence from the corresponding JSON file
-        const jsonData = await extractLabelAndConfidence(jsonFilePath)
+        const jsonData =
+          (await lookupDetectionStore(relativeFilePath)) ??
+          (await extractLabelAndConfidence(jsonFilePath))
         if (!jsonData) return null // Skip if the JSON cannot be read
         const { label, confidence } = jsonData
 
@@ -611,6 +653,69 @@ export async function browseDetectImage(
   }
 }
 
+// Detection writes its results as JSON lines into data/image_cropped_json/<user>/detections.jsonl
+// (see python/detection_store.py), one line per image keyed by its path relative to the user
+// folder, the last line winning. Images detected before the store existed have a JSON file each.
+const DETECTION_STORE_FILENAME = 'detections.jsonl'
+let detectionStoreCache: {
+  storePath: string
+  mtimeMs: number
+  size: number
+  records: Promise<Map<string, any>>
+} | null = null
+
+async function readDetectionStore(storePath: string) {
+  const records = new Map<string, any>()
+  const content = await fs.readFile(storePath, 'utf8')
+  for (const line of content.split('\n')) {
+    if (!line.trim()) continue
+    try {
+      const record = JSON.parse(line)
+      records.set(record.path, record)
+    } catch {
+      // A line cut short by a crash
+    }
+  }
+  return records
+}
+
+// Load the detection store of a JSON folder in one read, keeping it until the file changes. The
+// promise is cached, so concurrent lookups share a single read.
+async function loadDetectionStore(jsonDir: string) {
+  const storePath = path.join(jsonDir, DETECTION_STORE_FILENAME)
+  if (!(await fs.pathExists(storePath))) {
+    return new Map<string, any>()
+  }
+  const stat = await fs.stat(storePath)
+  const cache = detectionStoreCache
+  if (
+    cache &&
+    cache.storePath === storePath &&
+    cache.mtimeMs === stat.mtimeMs &&
+    cache.size === stat.size
+  ) {
+    return cache.records
+  }
+  const records = readDetectionStore(storePath)
+  detectionStoreCache = { storePath, mtimeMs: stat.mtimeMs, size: stat.size, records }
+  return records
+}
+
+// Look up the label and confidence of a marked image, given by its path relative to
+// data/image_marked, in the detection store. Returns null if the store does not have it.
+async function lookupDetectionStore(relativeFilePath: string) {
+  try {
+    const [userIdFolder, ...rest] = relativeFilePath.split(path.sep)
+    const jsonDir = path.join(userProfileDir, 'data/image_cropped_json', userIdFolder)
+    const record = (await loadDetectionStore(jsonDir)).get(rest.join('/'))
+    if (!record) return null
+    return { label: record.boxes[0].label, confidence: record.boxes[0].confidence }
+  } catch (error) {
+    console.error('Error reading the detection store:', error)
+    return null
+  }
+}
+
 async function extractLabelAndConfidence(filePath) {
   try {
     // Use fs-extra to read and parse JSON directly
@@ -663,7 +768,9 @@ async function getDetectFilePaths(
       )
 
       // Step 3: Extract label and confidence from the corresponding JSON file
-      const jsonData = await extractLabelAndConfidence(jsonFilePath)
+      const jsonData =
+        (await lookupDetectionStore(relativeFilePath)) ??
+        (await extractLabelAndConfidence(jsonFilePath))
       if (jsonData) {
         const { label, confidence } = jsonData
 
@@ -820,8 +927,10 @@ export async function runReid(selectedPaths: string[], stream: (txt: string) =>
     subProcess = ps
 
     if (ps.stdout) {
+      const collectMetrics = metricsCollector()
       ps.stdout.on('data', (data) => {
         console.log(`stdout: ${data}`)
+        collectMetrics(data)
         stream(data)
       })
     }
@@ -835,6 +944,7 @@ export async function runReid(selectedPaths: string[], stream: (txt: string) =>
     return await new Promise((resolve, reject) => {
       ps.on('close', (code) => {
         console.log(`child process exited with code ${code}`)
+        if (runMetrics.length) console.table(runMetrics)
         fs.remove(tempImagePath)
         if (code != 0) {
           reject({ ok: false, error: 'ERROR: Detection AI model error, please contact support.' })
@@ -16,6 +16,7 @@ import {
   downloadSelectedDetectImages,
   getDetectImagePaths,
   getImagePaths,
+  getRunMetrics,
   renameReidGroup,
   runReid,
   terminateAI,
@@ -128,6 +129,7 @@ app.whenReady().then(() => {
     renameReidGroup(date, time, old_group_id, new_group_id)
   )
   ipcMain.handle('terminateAI', (_) => terminateAI())
+  ipcMain.handle('getRunMetrics', (_) => getRunMetrics())
 
   createWindow()
 
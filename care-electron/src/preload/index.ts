@@ -40,7 +40,8 @@ const api = {
     ipcRenderer.invoke('deleteReidResult', date, time),
   renameReidGroup: (date: string, time: string, old_group_id: string, new_group_id: string) =>
     ipcRenderer.invoke('renameReidGroup', date, time, old_group_id, new_group_id),
-  terminateAI: () => ipcRenderer.invoke('terminateAI')
+  terminateAI: () => ipcRenderer.invoke('terminateAI'),
+  getRunMetrics: () => ipcRenderer.invoke('getRunMetrics')
 }
 
 if (process.contextIsolated) {
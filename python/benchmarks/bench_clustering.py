@@ -0,0 +1,54 @@
+"""
+Benchmark of the ReID grouping.
+
+Times clustering.process_dist_mat_v2 against the original row-by-row
+implementation (reference.reference_process_dist_mat_v2) on random distance
+matrices at several sizes, along with the grouping step on its own. That both
+give the same groupings is checked by tests/test_clustering.py.
+
+Run with:
+
+    python benchmarks/bench_clustering.py --sizes 1000 5000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clustering import CANDIDATE_WINDOW, group_candidates, process_dist_mat_v2    # noqa: E402
+from reference import reference_process_dist_mat_v2    # noqa: E402
+from synthetic import random_dist_mat    # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    print(f"{'n':>7} {'reference s':>12} {'current s':>10} {'grouping only s':>16}")
+    for n in args.sizes:
+        dist_mat = random_dist_mat(rng, n)
+        start = time.perf_counter()
+        reference_process_dist_mat_v2(dist_mat)
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        process_dist_mat_v2(dist_mat)
+        current_time = time.perf_counter() - start
+
+        # The candidate windows alone, as handed over by the streamed or top-k search.
+        candidates = [np.where(row - row.min() <= CANDIDATE_WINDOW)[0] for row in dist_mat]
+        start = time.perf_counter()
+        group_candidates(candidates)
+        grouping_time = time.perf_counter() - start
+        print(f"{n:>7} {reference_time:>12.3f} {current_time:>10.3f} {grouping_time:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Decode time and memory benchmark of full versus reduced-resolution decoding.
+
+Generates synthetic JPEGs at several resolutions and decodes them the way
+detection (the whole image, for YOLO) and ReID (a crop, for the model input)
+do, both at full size and at reduced size with image_decode. Each case runs in
+its own child process, which is sampled for peak RSS.
+
+Run with:
+
+    python benchmarks/bench_decode.py --megapixels 2 12 20 --json bench_decode.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import trap_images    # noqa: E402
+
+CASES = ["detection_full", "detection_reduced", "crop_full", "crop_reduced"]
+DETECTION_MIN_SIDE = 1280
+CROP_SIZE = (128, 256)    # (width, height) of the ReID model input
+
+
+def image_size(megapixels):
+    """
+    The width and height of a 4:3 image of the given size.
+    """
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    return width, width * 3 // 4
+
+
+def crop_box(width, height):
+    """
+    A crop of an animal covering a quarter of the frame's width.
+    """
+    return (width // 3, height // 3, width // 3 + width // 4, height // 3 + height // 4)
+
+
+def run_case(case, image_dir):
+    """
+    Decode every image of image_dir with one strategy, returning the mean
+    milliseconds per image.
+    """
+    import cv2
+    from PIL import Image
+    from image_decode import read_crops_reduced, read_image_reduced
+
+    image_paths = sorted(os.path.join(root, f) for root, _, files in os.walk(image_dir) for f in files)
+    with Image.open(image_paths[0]) as img:
+        bbox = crop_box(*img.size)
+
+    start = time.perf_counter()
+    for image_path in image_paths:
+        if case == "detection_full":
+            cv2.imread(image_path)
+        elif case == "detection_reduced":
+            read_image_reduced(image_path, DETECTION_MIN_SIDE)
+        elif case == "crop_full":
+            Image.open(image_path).convert("RGB").crop(bbox).resize(CROP_SIZE, Image.BILINEAR)
+        else:
+            read_crops_reduced(image_path, [bbox], CROP_SIZE)
+    return (time.perf_counter() - start) * 1000 / len(image_paths)
+
+
+def measure(case, image_dir, result_path, interval=0.01):
+    """
+    Run one case in a child process, sampling its RSS.
+    """
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", case,
+                              "--image-dir", image_dir, "--result", result_path])
+    process = psutil.Process(child.pid)
+    peak_rss = 0
+    while child.poll() is None:
+        try:
+            peak_rss = max(peak_rss, process.memory_info().rss)
+        except psutil.Error:
+            pass
+        time.sleep(interval)
+    if child.returncode != 0:
+        raise RuntimeError(f"The {case} case failed with exit code {child.returncode}.")
+    with open(result_path, "r") as f:
+        ms_per_image = json.load(f)["ms_per_image"]
+    return ms_per_image, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[2, 12, 20])
+    parser.add_argument("--images", type=int, default=20, help="images per resolution")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--child", choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument("--image-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.result, "w") as f:
+            json.dump({"ms_per_image": run_case(args.child, args.image_dir)}, f)
+        return
+
+    results = []
+    print(f"{'MP':>5} {'size':>11} {'case':>18} {'ms/image':>9} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in args.megapixels:
+            image_dir = os.path.join(tmp_dir, f"{megapixels}mp")
+            width, height = image_size(megapixels)
+            trap_images(image_dir, args.images, width, height)
+            for case in args.cases:
+                ms_per_image, peak_rss = measure(case, image_dir, os.path.join(tmp_dir, "result.json"))
+                results.append({"megapixels": megapixels, "width": width, "height": height, "case": case,
+                                "ms_per_image": ms_per_image, "peak_rss_mb": peak_rss / 2**20})
+                r = results[-1]
+                print(f"{r['megapixels']:>5g} {f'{width}x{height}':>11} {r['case']:>18} {r['ms_per_image']:>9.1f} "
+                      f"{r['peak_rss_mb']:>12.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Throughput and memory benchmark of the CPU detection engines.
+
+Generates a folder of synthetic camera-trap-sized JPEGs and runs detection on it
+with the process pool engine (one YOLO model per worker process, one image per
+call) and with the batched engine (one YOLO model, batched inference, a thread
+pool for decoding and writing). Each engine runs in its own child process, whose
+process tree is sampled for peak RSS.
+
+Run with:
+
+    python benchmarks/bench_detection.py --images 1000 --json bench_detection.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import trap_images    # noqa: E402
+
+ENGINES = ["pool", "batched"]
+
+
+def run_engine(engine, image_dir, output_dir):
+    """
+    Run one engine in this process and return its wall time in seconds.
+    """
+    import detection_cpu
+
+    log_file = os.path.join(output_dir, "detection_log.txt")
+    images_dir = os.path.join(output_dir, "images")
+    json_dir = os.path.join(output_dir, "json")
+    start = time.perf_counter()
+    if engine == "pool":
+        from detection_pool import process_images_with_pool
+
+        process_images_with_pool(detection_cpu.MODEL_PATH, image_dir, images_dir, json_dir, log_file)
+    else:
+        yolo_model = detection_cpu.load_model()
+        detection_cpu.process_images_batched(yolo_model, image_dir, images_dir, json_dir, log_file)
+    return time.perf_counter() - start
+
+
+def measure(engine, image_dir, output_dir, interval=0.1):
+    """
+    Run one engine in a child process, sampling the RSS of its process tree.
+    """
+    result_path = os.path.join(output_dir, "result.json")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", engine,
+                              "--image-dir", image_dir, "--output-dir", output_dir],
+                             stdout=subprocess.DEVNULL)
+    process = psutil.Process(child.pid)
+    peak_rss = 0
+    while child.poll() is None:
+        try:
+            processes = [process] + process.children(recursive=True)
+            peak_rss = max(peak_rss, sum(p.memory_info().rss for p in processes if p.is_running()))
+        except psutil.Error:
+            pass
+        time.sleep(interval)
+    if child.returncode != 0:
+        raise RuntimeError(f"The {engine} engine failed with exit code {child.returncode}.")
+    with open(result_path, "r") as f:
+        seconds = json.load(f)["seconds"]
+    return seconds, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=1000)
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--child", choices=ENGINES, help=argparse.SUPPRESS)
+    parser.add_argument("--image-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--output-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        seconds = run_engine(args.child, args.image_dir, args.output_dir)
+        with open(os.path.join(args.output_dir, "result.json"), "w") as f:
+            json.dump({"seconds": seconds}, f)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_dir = os.path.join(tmp_dir, "images")
+        trap_images(image_dir, args.images)
+
+        print(f"{'engine':>8} {'images':>7} {'seconds':>8} {'images/s':>9} {'peak RSS MB':>12}")
+        for engine in args.engines:
+            output_dir = os.path.join(tmp_dir, engine)
+            os.makedirs(output_dir)
+            seconds, peak_rss = measure(engine, image_dir, output_dir)
+            results.append({"engine": engine, "images": args.images, "seconds": seconds,
+                            "images_per_s": args.images / seconds, "peak_rss_mb": peak_rss / 2**20})
+            r = results[-1]
+            print(f"{r['engine']:>8} {r['images']:>7} {r['seconds']:>8.2f} {r['images_per_s']:>9.2f} "
+                  f"{r['peak_rss_mb']:>12.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
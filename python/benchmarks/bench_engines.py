@@ -0,0 +1,165 @@
+"""
+Startup time, throughput and output parity of the torch and onnx engines.
+
+For the detector and the ReID model, each engine (see engines.py) runs in its
+own child process, which reports the time to import its modules and load the
+model, the time of the first call, and the throughput on synthetic inputs:
+camera-trap-sized JPEGs for the detector, preprocessed crops for ReID. The
+outputs of both engines are then compared: box counts, box coordinates and
+confidences for the detector, cosine similarity of the features for ReID. The
+ONNX exports are made up front, so they are not part of the startup time.
+
+Run with:
+
+    python benchmarks/bench_engines.py --images 200 --crops 1000 --json bench_engines.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import trap_images    # noqa: E402
+
+MODELS = ["detector", "reid"]
+ENGINES = ["torch", "onnx"]
+
+
+def run_detector(engine, image_dir, output_path, batch_size, export_dir):
+    start = time.perf_counter()
+    import cv2
+    import detection_cpu
+    yolo_model = detection_cpu.load_model(engine=engine, export_dir=export_dir)
+    load_seconds = time.perf_counter() - start
+
+    image_paths = sorted(detection_cpu.find_images(image_dir))
+    images = [cv2.imread(image_path) for image_path in image_paths]
+    start = time.perf_counter()
+    detection_cpu.predict_batch(yolo_model, images[:1])
+    first_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = []
+    for i in range(0, len(images), batch_size):
+        predictions += detection_cpu.predict_batch(yolo_model, images[i:i + batch_size])
+    seconds = time.perf_counter() - start
+
+    boxes = [np.column_stack([p.boxes.xyxy.cpu().numpy(), p.boxes.conf.cpu().numpy()]) for p in predictions]
+    np.savez(output_path, counts=[len(b) for b in boxes], boxes=np.concatenate(boxes) if boxes else np.zeros((0, 5)))
+    return load_seconds, first_seconds, len(images) / seconds
+
+
+def run_reid(engine, crops, output_path, batch_size, export_dir):
+    start = time.perf_counter()
+    import reid_cpu
+    from engines import load_onnx_reid
+    reid_cpu.load_cfg(reid_cpu.CFG_FILE_PATH)
+    if engine == "onnx":
+        model = load_onnx_reid(reid_cpu.MODEL_PATH, export_dir, tuple(reid_cpu.cfg.INPUT.SIZE_TEST))
+    else:
+        model = reid_cpu.load_model()
+    load_seconds = time.perf_counter() - start
+
+    import torch
+    crops = [torch.from_numpy(crop[None]) for crop in np.load(crops)]
+    start = time.perf_counter()
+    reid_cpu.compute_embeddings(model, crops[:1], "cpu")
+    first_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings = reid_cpu.compute_embeddings(model, crops, "cpu", batch_size)
+    seconds = time.perf_counter() - start
+
+    np.save(output_path, embeddings.numpy())
+    return load_seconds, first_seconds, len(crops) / seconds
+
+
+def measure(model, engine, inputs, output_path, batch_size, export_dir):
+    """
+    Run one model and engine in a child process.
+    """
+    result_path = output_path + ".json"
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--child", model, engine, "--inputs", inputs,
+                    "--output", output_path, "--batch-size", str(batch_size), "--export-dir", export_dir],
+                   stdout=subprocess.DEVNULL, check=True)
+    with open(result_path, "r") as f:
+        return json.load(f)
+
+
+def detector_parity(torch_path, onnx_path):
+    a, b = np.load(torch_path), np.load(onnx_path)
+    same_counts = np.array_equal(a["counts"], b["counts"])
+    result = {"same_box_counts": bool(same_counts)}
+    if same_counts and len(a["boxes"]):
+        result["max_box_diff_px"] = float(np.abs(a["boxes"][:, :4] - b["boxes"][:, :4]).max())
+        result["max_conf_diff"] = float(np.abs(a["boxes"][:, 4] - b["boxes"][:, 4]).max())
+    return result
+
+
+def reid_parity(torch_path, onnx_path):
+    a, b = np.load(torch_path), np.load(onnx_path)
+    cosine = np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {"min_cosine_similarity": float(cosine.min()), "max_abs_diff": float(np.abs(a - b).max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=200, help="synthetic images for the detector")
+    parser.add_argument("--crops", type=int, default=1000, help="synthetic crops for ReID")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--child", nargs=2, metavar=("MODEL", "ENGINE"), help=argparse.SUPPRESS)
+    parser.add_argument("--inputs", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    parser.add_argument("--export-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        model, engine = args.child
+        run = run_detector if model == "detector" else run_reid
+        load_seconds, first_seconds, per_s = run(engine, args.inputs, args.output, args.batch_size, args.export_dir)
+        with open(args.output + ".json", "w") as f:
+            json.dump({"load_seconds": load_seconds, "first_call_seconds": first_seconds, "per_s": per_s}, f)
+        return
+
+    results = []
+    print(f"{'model':>8} {'engine':>6} {'load s':>7} {'first call s':>12} {'per s':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        import engines
+        export_dir = os.path.join(tmp_dir, "onnx")
+        engines.export_models(export_dir)    # export up front, so only loading is timed
+        image_dir = os.path.join(tmp_dir, "images")
+        trap_images(image_dir, args.images)
+        crops_path = os.path.join(tmp_dir, "crops.npy")
+        rng = np.random.default_rng(0)
+        np.save(crops_path, rng.normal(size=(args.crops, 3, 256, 128)).astype(np.float32))
+
+        for model in args.models:
+            inputs = image_dir if model == "detector" else crops_path
+            outputs = dict()
+            for engine in ENGINES:
+                outputs[engine] = os.path.join(tmp_dir, f"{model}_{engine}" + (".npz" if model == "detector" else ".npy"))
+                r = measure(model, engine, inputs, outputs[engine], args.batch_size, export_dir)
+                r.update({"model": model, "engine": engine})
+                results.append(r)
+                print(f"{model:>8} {engine:>6} {r['load_seconds']:>7.2f} {r['first_call_seconds']:>12.3f} "
+                      f"{r['per_s']:>8.1f}")
+            parity = (detector_parity if model == "detector" else reid_parity)(outputs["torch"], outputs["onnx"])
+            results.append({"model": model, "parity": parity})
+            print(f"{model:>8} parity: {parity}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Recall-vs-speed benchmark of the neighbour search backends.
+
+Generates synthetic clustered embeddings shaped like CARE [CLS] features and
+compares the approximate IVF index, at several n_probe settings, against exact
+blocked search: search time, recall@k of the neighbour lists, and whether the
+resulting groupings match.
+
+Run with:
+
+    python benchmarks/bench_neighbors.py --sizes 2000 10000 50000 --json bench_neighbors.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clustering import process_neighbor_lists    # noqa: E402
+from neighbors import IVFIndex, exact_search    # noqa: E402
+
+
+def synthetic_embeddings(n, dim=512, images_per_individual=20, noise=0.6, seed=0):
+    """
+    Embeddings of n crops of n / images_per_individual individuals.
+    """
+    rng = np.random.default_rng(seed)
+    individuals = rng.normal(size=(max(1, n // images_per_individual), dim))
+    labels = rng.integers(0, len(individuals), size=n)
+    return (individuals[labels] + noise * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def recall(exact_indices, approx_indices):
+    hits = [len(np.intersect1d(e, a)) for e, a in zip(exact_indices, approx_indices)]
+    return float(np.sum(hits)) / exact_indices.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 10000, 50000])
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--json", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'n':>7} {'backend':>10} {'n_probe':>7} {'build s':>8} {'search s':>9} {'recall':>7} {'same groups':>11}")
+    for n in args.sizes:
+        embeddings = synthetic_embeddings(n)
+
+        start = time.perf_counter()
+        exact_indices, exact_distances = exact_search(embeddings, args.k)
+        exact_time = time.perf_counter() - start
+        exact_groups = process_neighbor_lists(exact_indices, exact_distances)
+        results.append({"n": n, "backend": "exact", "n_probe": None, "build_s": 0.0,
+                        "search_s": exact_time, "recall": 1.0, "same_groups": True})
+
+        for n_probe in args.n_probe:
+            start = time.perf_counter()
+            index = IVFIndex(n_probe=n_probe).build(embeddings)
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            indices, distances = index.search(args.k)
+            search_time = time.perf_counter() - start
+            results.append({"n": n, "backend": "ivf", "n_probe": n_probe, "build_s": build_time,
+                            "search_s": search_time, "recall": recall(exact_indices, indices),
+                            "same_groups": process_neighbor_lists(indices, distances) == exact_groups})
+
+        for r in results[-len(args.n_probe) - 1:]:
+            print(f"{r['n']:>7} {r['backend']:>10} {str(r['n_probe'] or '-'):>7} {r['build_s']:>8.2f} "
+                  f"{r['search_s']:>9.2f} {r['recall']:>7.3f} {str(r['same_groups']):>11}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
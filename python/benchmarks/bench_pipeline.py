@@ -0,0 +1,305 @@
+"""
+Offline benchmark suite of the detection and ReID stages.
+
+Runs without the real models or data: it generates synthetic camera trap images
+with their detection results, and small random-weight stand-ins for the
+detector and the CARE model (see synthetic.py). Then, at each dataset size, it
+runs every stage in its own child process, sampled for peak RSS, and reports
+the items per second and the latency percentiles of each call:
+
+    detection       decode, infer and write through the detection pipeline
+    detection_pool  the process pool engine (throughput only)
+    crop            decoding the original images and cropping their boxes
+    crop_jpeg       the former round trip of saving each crop as a JPEG and reading it back
+    embed           the stand-in CARE model, per batch
+    distance        the cosine distance matrix of the embeddings
+    cluster         grouping the embeddings into individuals
+
+Results can be saved as JSON and compared against an earlier run, flagging the
+stages which got slower:
+
+    python benchmarks/bench_pipeline.py --sizes 100 1000 --json bench_pipeline.json
+    python benchmarks/bench_pipeline.py --sizes 100 1000 --compare bench_pipeline.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import stub_models, trap_images, write_detections    # noqa: E402
+
+STAGES = ["detection", "detection_pool", "crop", "crop_jpeg", "embed", "distance", "cluster"]
+PERCENTILES = (50, 90, 99)
+
+
+class Timer:
+    """
+    Records the latency of each call of a function.
+    """
+
+    def __init__(self):
+        self.latencies = []
+
+    def wrap(self, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        return timed
+
+
+def stage_detection(data_dir, detector_path, reid_path, batch_size):
+    import detection_cpu
+    from detection_pipeline import run_pipeline
+    from detection_store import DetectionStore
+
+    yolo_model = detection_cpu.load_model(detector_path)
+    image_dir = os.path.join(data_dir, "images")
+    output_dir = os.path.join(data_dir, "detection")
+    store = DetectionStore(os.path.join(output_dir, "json"))
+    log_file = os.path.join(output_dir, "log.txt")
+    os.makedirs(output_dir, exist_ok=True)
+    timers = {"decode": Timer(), "infer": Timer(), "write": Timer()}
+
+    def decode(image_path):
+        return detection_cpu.decode_image(image_path, log_file)
+
+    def infer(decoded):
+        return detection_cpu.predict_batch(yolo_model, [d[0] if d is not None else None for d in decoded])
+
+    def write(image_path, decoded, prediction):
+        image, scale = decoded
+        detection_cpu.write_detection(image, prediction, image_path, os.path.join(output_dir, "images"),
+                                      store.json_dir, image_dir, log_file, scale, store)
+
+    image_paths = detection_cpu.find_images(image_dir)
+    num_io_workers = detection_cpu.default_io_workers()
+    detection_cpu.configure_threads(num_io_workers)
+    start = time.perf_counter()
+    run_pipeline(image_paths, timers["decode"].wrap(decode), timers["infer"].wrap(infer),
+                 timers["write"].wrap(write), batch_size, num_decoders=num_io_workers, num_writers=num_io_workers)
+    store.close()
+    seconds = time.perf_counter() - start
+    return len(image_paths), seconds, {name: timer.latencies for name, timer in timers.items()}
+
+
+def stage_detection_pool(data_dir, detector_path, reid_path, batch_size):
+    import detection_cpu
+    from detection_pool import process_images_with_pool
+
+    image_dir = os.path.join(data_dir, "images")
+    output_dir = os.path.join(data_dir, "detection_pool")
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    process_images_with_pool(detector_path, image_dir, os.path.join(output_dir, "images"),
+                             os.path.join(output_dir, "json"), os.path.join(output_dir, "log.txt"))
+    return len(detection_cpu.find_images(image_dir)), time.perf_counter() - start, {}
+
+
+def _crop_sources(data_dir):
+    import reid_cpu
+
+    reid_cpu.load_cfg(reid_cpu.CFG_FILE_PATH)
+    crop_sources, _ = reid_cpu.process_images_in_folder(os.path.join(data_dir, "images"),
+                                                        os.path.join(data_dir, "json"),
+                                                        os.path.join(data_dir, "crops"), os.devnull)
+    return sorted(crop_sources), crop_sources
+
+
+def stage_crop(data_dir, detector_path, reid_path, batch_size):
+    import reid_cpu
+
+    cropped_image_paths, crop_sources = _crop_sources(data_dir)
+    timer = Timer()
+    start = time.perf_counter()
+    crops = reid_cpu.iter_crop_images(cropped_image_paths, crop_sources)
+    next_crop = timer.wrap(next)
+    for _ in cropped_image_paths:
+        next_crop(crops)
+    return len(cropped_image_paths), time.perf_counter() - start, {"crop": timer.latencies}
+
+
+def stage_crop_jpeg(data_dir, detector_path, reid_path, batch_size):
+    import reid_cpu
+    from PIL import Image
+
+    cropped_image_paths, crop_sources = _crop_sources(data_dir)
+    timer = Timer()
+
+    def round_trip(cropped_img_path, cropped_img):
+        os.makedirs(os.path.dirname(cropped_img_path), exist_ok=True)
+        cropped_img.save(cropped_img_path)
+        return reid_cpu.preprocess_image(Image.open(cropped_img_path).convert("RGB"))
+
+    round_trip = timer.wrap(round_trip)
+    start = time.perf_counter()
+    for cropped_img_path, cropped_img in zip(cropped_image_paths,
+                                             reid_cpu.iter_crop_images(cropped_image_paths, crop_sources)):
+        round_trip(cropped_img_path, cropped_img)
+    return len(cropped_image_paths), time.perf_counter() - start, {"save_and_load": timer.latencies}
+
+
+def stage_embed(data_dir, detector_path, reid_path, batch_size):
+    import reid_cpu
+
+    cropped_image_paths, crop_sources = _crop_sources(data_dir)
+    crops = list(reid_cpu.iter_crop_tensors(cropped_image_paths, crop_sources))
+    model = reid_cpu.load_model(reid_path)
+    timer = Timer()
+    embed_batch = timer.wrap(lambda batch: reid_cpu.compute_embeddings(model, batch, "cpu", batch_size))
+    start = time.perf_counter()
+    embeddings = [embed_batch(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)]
+    seconds = time.perf_counter() - start
+    np.save(os.path.join(data_dir, "embeddings.npy"), np.concatenate([e.numpy() for e in embeddings]))
+    return len(crops), seconds, {"batch": timer.latencies}
+
+
+def stage_distance(data_dir, detector_path, reid_path, batch_size, repeats=5):
+    from reference import compute_distance_matrix
+
+    embeddings = np.load(os.path.join(data_dir, "embeddings.npy"))
+    timer = Timer()
+    distance = timer.wrap(compute_distance_matrix)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        distance(embeddings, True)
+    return len(embeddings) * repeats, time.perf_counter() - start, {"matrix": timer.latencies}
+
+
+def stage_cluster(data_dir, detector_path, reid_path, batch_size, repeats=5):
+    import reid_cpu
+
+    reid_cpu.load_cfg(reid_cpu.CFG_FILE_PATH)
+    embeddings = np.load(os.path.join(data_dir, "embeddings.npy"))
+    timer = Timer()
+    cluster = timer.wrap(reid_cpu.cluster_embeddings)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        cluster(embeddings, os.devnull)
+    return len(embeddings) * repeats, time.perf_counter() - start, {"grouping": timer.latencies}
+
+
+def measure(stage, data_dir, detector_path, reid_path, batch_size, interval=0.02):
+    """
+    Run one stage in a child process, sampling the RSS of its process tree.
+    """
+    result_path = os.path.join(data_dir, f"{stage}.json")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", stage, "--data-dir", data_dir,
+                              "--models", detector_path, reid_path, "--batch-size", str(batch_size)],
+                             stdout=subprocess.DEVNULL)
+    process = psutil.Process(child.pid)
+    peak_rss = 0
+    while child.poll() is None:
+        try:
+            processes = [process] + process.children(recursive=True)
+            peak_rss = max(peak_rss, sum(p.memory_info().rss for p in processes if p.is_running()))
+        except psutil.Error:
+            pass
+        time.sleep(interval)
+    if child.returncode != 0:
+        raise RuntimeError(f"The {stage} stage failed with exit code {child.returncode}.")
+    with open(result_path, "r") as f:
+        result = json.load(f)
+    result["peak_rss_mb"] = peak_rss / 2**20
+    return result
+
+
+def summarize(items, seconds, latencies):
+    """
+    Throughput and latency percentiles (in milliseconds) of each kind of call.
+    """
+    result = {"items": items, "seconds": seconds, "items_per_s": items / seconds if seconds else 0.0}
+    result["latency_ms"] = {
+        name: {f"p{p}": float(np.percentile(values, p)) * 1000 for p in PERCENTILES}
+        for name, values in latencies.items() if values
+    }
+    return result
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Print the change in throughput of each stage against a baseline run, and
+    return the stages which are slower by more than tolerance.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {(r["size"], r["stage"]): r for r in json.load(f)}
+    regressions = []
+    print(f"\n{'size':>6} {'stage':>15} {'baseline/s':>11} {'now/s':>9} {'change':>8}")
+    for r in results:
+        base = baseline.get((r["size"], r["stage"]))
+        if base is None or not base["items_per_s"]:
+            continue
+        change = r["items_per_s"] / base["items_per_s"] - 1
+        flag = " REGRESSION" if change < -tolerance else ""
+        print(f"{r['size']:>6} {r['stage']:>15} {base['items_per_s']:>11.1f} {r['items_per_s']:>9.1f} "
+              f"{change:>+8.0%}{flag}")
+        if flag:
+            regressions.append(r)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500], help="images per dataset")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--model-dir", help="where to keep the stand-in models (default: a temporary folder)")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown flagged as a regression")
+    parser.add_argument("--child", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--models", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        stage = globals()[f"stage_{args.child}"]
+        items, seconds, latencies = stage(args.data_dir, *args.models, args.batch_size)
+        with open(os.path.join(args.data_dir, f"{args.child}.json"), "w") as f:
+            json.dump(summarize(items, seconds, latencies), f)
+        return
+
+    # The stages which need embeddings come after embed.
+    stages = [stage for stage in STAGES if stage in args.stages or
+              (stage == "embed" and {"distance", "cluster"} & set(args.stages))]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        detector_path, reid_path = stub_models(args.model_dir or os.path.join(tmp_dir, "models"))
+        print(f"{'size':>6} {'stage':>15} {'items':>7} {'items/s':>9} {'peak RSS MB':>12}  latency ms (p50/p90/p99)")
+        for size in args.sizes:
+            data_dir = os.path.join(tmp_dir, f"size{size}")
+            boxes = trap_images(os.path.join(data_dir, "images"), size, args.width, args.height)
+            write_detections(os.path.join(data_dir, "json"), boxes)
+            for stage in stages:
+                r = measure(stage, data_dir, detector_path, reid_path, args.batch_size)
+                r.update({"size": size, "stage": stage})
+                if stage in args.stages:
+                    results.append(r)
+                latency = ", ".join(f"{name} {v['p50']:.1f}/{v['p90']:.1f}/{v['p99']:.1f}"
+                                    for name, v in r["latency_ms"].items())
+                print(f"{size:>6} {stage:>15} {r['items']:>7} {r['items_per_s']:>9.1f} "
+                      f"{r['peak_rss_mb']:>12.0f}  {latency}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Accuracy parity and speed of the INT8 quantized CARE model against FP32.
+
+Embeds every crop of a validation folder (images plus their detection JSON, as
+passed to the reid task) with the traced FP32 model and with its INT8 version
+(see reid_quantize), then reports how far the embeddings, the distance matrix,
+the nearest neighbours and the ReID groupings move, and the speedup. Only the
+model is timed: the crops are decoded and preprocessed once, up front.
+
+Run with:
+
+    python benchmarks/bench_quantization.py <image_dir> <json_dir> --json bench_quantization.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reid_cpu    # noqa: E402
+from reid_cpu import cfg    # noqa: E402
+from reid_quantize import quantize_model    # noqa: E402
+from reference import compute_distance_matrix    # noqa: E402
+
+
+def embed(model, crops, batch_size, repeats):
+    """
+    Embed the crops, returning the embeddings and the best of repeats timings.
+    """
+    reid_cpu.compute_embeddings(model, crops[:batch_size], "cpu", batch_size)    # warm up
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embeddings = reid_cpu.compute_embeddings(model, crops, "cpu", batch_size)
+        best = min(best, time.perf_counter() - start)
+    return embeddings, best
+
+
+def same_group_pairs(groups, n):
+    """
+    Whether each pair of crops is in the same group, as an (n, n) bool matrix.
+    """
+    labels = np.empty(n, dtype=np.int64)
+    for label, members in groups.items():
+        labels[members] = label
+    return labels[:, None] == labels[None, :]
+
+
+def parity(fp32, int8, log_file):
+    """
+    Compare the FP32 and INT8 embeddings the way run uses them.
+    """
+    n = len(fp32)
+    cosine = torch.nn.functional.cosine_similarity(fp32.float(), int8.float()).numpy()
+    dist_fp32 = compute_distance_matrix(fp32, is_duplicate=True)
+    dist_int8 = compute_distance_matrix(int8, is_duplicate=True)
+    dist_diff = np.abs(dist_fp32 - dist_int8)[~np.eye(n, dtype=bool)] if n > 1 else np.zeros(1)
+
+    pairs_fp32 = same_group_pairs(reid_cpu.cluster_embeddings(fp32.numpy(), log_file), n)
+    pairs_int8 = same_group_pairs(reid_cpu.cluster_embeddings(int8.numpy(), log_file), n)
+    off_diagonal = ~np.eye(n, dtype=bool)
+    pair_agreement = float(np.mean((pairs_fp32 == pairs_int8)[off_diagonal])) if n > 1 else 1.0
+    return {
+        "crops": n,
+        "min_cosine_similarity": float(cosine.min()),
+        "mean_cosine_similarity": float(cosine.mean()),
+        "max_distance_diff": float(dist_diff.max()),
+        "mean_distance_diff": float(dist_diff.mean()),
+        "nearest_neighbour_agreement": float(np.mean(dist_fp32.argmin(axis=1) == dist_int8.argmin(axis=1))),
+        "groupings_identical": bool((pairs_fp32 == pairs_int8).all()),
+        "pair_agreement": pair_agreement,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir", help="validation images")
+    parser.add_argument("json_dir", help="detection JSON of the validation images")
+    parser.add_argument("--batch-size", type=int, default=None, help="defaults to TEST.IMS_PER_BATCH")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--opts", nargs="+", default=[], help="cfg overrides, as KEY VALUE pairs")
+    args = parser.parse_args()
+
+    reid_cpu.load_cfg(reid_cpu.CFG_FILE_PATH, args.opts)
+    batch_size = args.batch_size or cfg.TEST.IMS_PER_BATCH
+    log_file = os.devnull
+
+    crop_sources, _ = reid_cpu.process_images_in_folder(args.image_dir, args.json_dir, "crops", log_file,
+                                                        dedup=cfg.TEST.DEDUP_IMAGES)
+    cropped_image_paths = sorted(crop_sources)
+    if not cropped_image_paths:
+        sys.exit(f"No crops found in {args.image_dir}.")
+    crops = list(reid_cpu.iter_crop_tensors(cropped_image_paths, crop_sources))
+
+    model = reid_cpu.load_model(reid_cpu.MODEL_PATH)
+    start = time.perf_counter()
+    quantized = quantize_model(reid_cpu.load_model(reid_cpu.MODEL_PATH))
+    quantize_seconds = time.perf_counter() - start
+
+    fp32, fp32_seconds = embed(model, crops, batch_size, args.repeats)
+    int8, int8_seconds = embed(quantized, crops, batch_size, args.repeats)
+
+    result = parity(fp32, int8, log_file)
+    result.update({
+        "fp32_crops_per_s": len(crops) / fp32_seconds,
+        "int8_crops_per_s": len(crops) / int8_seconds,
+        "speedup": fp32_seconds / int8_seconds,
+        "quantize_seconds": quantize_seconds,
+        "torch_threads": torch.get_num_threads(),
+    })
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f"{key:>{width}} {value:.4f}" if isinstance(value, float) else f"{key:>{width}} {value}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Equivalence check and benchmark of the sparse k-reciprocal re-ranking.
+
+Compares reranking.k_reciprocal_rerank with a dense implementation of the same
+re-ranking (kept below as reference_rerank, O(N^2) in memory) on small random
+galleries, then times, at several sizes of synthetic clustered embeddings:
+
+- cosine: the plain N x N cosine distance matrix, as without re-ranking
+- search: the exact top-k neighbour lists which re-ranking starts from
+- rerank: the sparse re-ranking of those lists
+- dense: the dense reference re-ranking, up to --dense-max crops
+
+with the peak memory allocated by each (tracemalloc), and the pairwise F1 of the
+groupings with and without re-ranking against the true individuals. Exits with
+status 1 if the sparse and dense distances differ.
+
+Run with:
+
+    python benchmarks/bench_reranking.py --sizes 1000 5000 20000 --json bench_reranking.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clustering import process_neighbor_lists    # noqa: E402
+from neighbors import exact_search, normalize    # noqa: E402
+from reranking import k_reciprocal_rerank    # noqa: E402
+
+
+def reference_rerank(embeddings, k1=20, k2=6, lambda_value=0.3):
+    """
+    The dense k-reciprocal re-ranking: the full (N, N) re-ranked distance
+    matrix, built row by row as in the original implementation, with the
+    cosine distance in place of the Euclidean one.
+    """
+    gallery = normalize(embeddings)
+    dist = 1 - gallery @ gallery.T
+    n = len(dist)
+    rank = np.lexsort((np.broadcast_to(np.arange(n), dist.shape), dist), axis=1)
+    half = max(1, int(round(k1 / 2)))
+
+    def reciprocal(i, k):
+        forward = rank[i, :k + 1]
+        return forward[(rank[forward, :k + 1] == i).any(axis=1)]
+
+    V = np.zeros((n, n), dtype=np.float32)
+    for i in range(n):
+        members = reciprocal(i, k1)
+        expanded = members
+        for j in members:
+            candidate = reciprocal(j, half)
+            if len(np.intersect1d(candidate, members)) > 2 / 3 * len(candidate):
+                expanded = np.append(expanded, candidate)
+        expanded = np.unique(expanded)
+        weights = np.exp(-dist[i, expanded])
+        V[i, expanded] = weights / weights.sum()
+    if k2 > 1:
+        V = np.stack([V[rank[i, :k2]].mean(axis=0) for i in range(n)])
+
+    jaccard = np.empty_like(dist)
+    for i in range(n):
+        columns = np.nonzero(V[i])[0]
+        shared = np.minimum(V[i, columns], V[:, columns]).sum(axis=1)
+        jaccard[i] = 1 - shared / (2 - shared)
+    return (1 - lambda_value) * jaccard + lambda_value * dist
+
+
+def labelled_embeddings(rng, n, dim=512, images_per_individual=20, noise=0.8):
+    """
+    Embeddings of n crops of n / images_per_individual individuals, and the
+    individual of each.
+    """
+    individuals = rng.normal(size=(max(1, n // images_per_individual), dim))
+    labels = rng.integers(0, len(individuals), size=n)
+    return (individuals[labels] + noise * rng.normal(size=(n, dim))).astype(np.float32), labels
+
+
+def pairwise_f1(groups, labels):
+    """
+    The F1 score of the pairs of crops grouped together, against the true
+    individuals.
+    """
+    predicted = np.empty(len(labels), dtype=np.int64)
+    for group, members in groups.items():
+        predicted[members] = group
+
+    def pairs(counts):
+        return float(np.sum(counts * (counts - 1) / 2))
+
+    _, both = np.unique(np.stack([predicted, labels]), axis=1, return_counts=True)
+    true_positives = pairs(both)
+    precision = true_positives / max(pairs(np.bincount(predicted)), 1)
+    recall = true_positives / max(pairs(np.bincount(labels)), 1)
+    return 2 * precision * recall / max(precision + recall, 1e-12)
+
+
+def measure(fn):
+    """
+    Run fn, returning its result, its time and the peak memory it allocated.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--k1", type=int, default=20)
+    parser.add_argument("--k2", type=int, default=6)
+    parser.add_argument("--lambda-value", type=float, default=0.3)
+    parser.add_argument("--dense-max", type=int, default=2000,
+                        help="largest size to time the dense reference re-ranking at")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    params = dict(k1=args.k1, k2=args.k2, lambda_value=args.lambda_value)
+
+    mismatches = 0
+    for trial in range(args.trials):
+        n = int(rng.integers(2, 300))
+        embeddings, _ = labelled_embeddings(rng, n, dim=32, images_per_individual=int(rng.integers(2, 30)),
+                                            noise=rng.uniform(0.1, 1.5))
+        indices, distances = exact_search(embeddings, n - 1)
+        indices, distances = k_reciprocal_rerank(embeddings, indices, distances, **params)
+        expected = reference_rerank(embeddings, **params)[np.arange(n)[:, None], indices]
+        if not np.allclose(distances, expected, atol=1e-5):
+            mismatches += 1
+            print(f"Trial {trial}: re-ranked distances differ on {n} crops")
+    print(f"{args.trials - mismatches}/{args.trials} random galleries give the dense re-ranked distances")
+
+    results = []
+    print(f"{'n':>7} {'cosine s':>9} {'MB':>7} {'search s':>9} {'MB':>7} {'rerank s':>9} {'MB':>7} "
+          f"{'dense s':>8} {'MB':>7} {'F1 cosine':>10} {'F1 rerank':>10}")
+    for n in args.sizes:
+        embeddings, labels = labelled_embeddings(rng, n)
+        gallery = normalize(embeddings)
+        _, cosine_s, cosine_mb = measure(lambda: 1 - gallery @ gallery.T)
+        (indices, distances), search_s, search_mb = measure(lambda: exact_search(embeddings, args.k))
+        (reranked, reranked_distances), rerank_s, rerank_mb = measure(
+            lambda: k_reciprocal_rerank(embeddings, indices, distances, **params))
+        dense_s = dense_mb = None
+        if n <= args.dense_max:
+            _, dense_s, dense_mb = measure(lambda: reference_rerank(embeddings, **params))
+
+        result = {"n": n, "cosine_s": cosine_s, "cosine_mb": cosine_mb, "search_s": search_s,
+                  "search_mb": search_mb, "rerank_s": rerank_s, "rerank_mb": rerank_mb,
+                  "dense_s": dense_s, "dense_mb": dense_mb,
+                  "f1_cosine": pairwise_f1(process_neighbor_lists(indices, distances), labels),
+                  "f1_rerank": pairwise_f1(process_neighbor_lists(reranked, reranked_distances), labels)}
+        results.append(result)
+        dense = f"{dense_s:>8.2f} {dense_mb:>7.1f}" if dense_s is not None else f"{'-':>8} {'-':>7}"
+        print(f"{n:>7} {cosine_s:>9.2f} {cosine_mb:>7.1f} {search_s:>9.2f} {search_mb:>7.1f} {rerank_s:>9.2f} "
+              f"{rerank_mb:>7.1f} {dense} {result['f1_cosine']:>10.3f} {result['f1_rerank']:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+The process pool detection engine, which batched inference in detection_cpu
+replaced, kept as the baseline of bench_detection and bench_pipeline.
+
+Each worker process loads its own YOLO model and runs one image at a time.
+"""
+
+import multiprocessing as mp
+import os
+import sys
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import detection_cpu    # noqa: E402
+from ultralytics import YOLO    # noqa: E402
+
+
+yolo_model = None    # global variable
+
+
+def init_process(yolo_model_path):
+    global yolo_model
+    DEVICE = "cpu"
+    yolo_model = YOLO(yolo_model_path).to(DEVICE)
+
+
+def make_inference_detection(path_to_img, output_dir, original_root, log_file):
+    global yolo_model
+    image_filename = os.path.basename(path_to_img)
+
+    try:
+        if not os.path.exists(path_to_img):
+            detection_cpu.log_message(log_file, f"The path '{path_to_img}' does not exist.")
+            return None
+
+        image = cv2.imread(path_to_img)
+        if image is None:
+            detection_cpu.log_message(log_file, f"Failed to read image '{path_to_img}'.")
+            return None
+
+        # Pass the decoded image rather than the path, so YOLO does not decode it again.
+        prediction = yolo_model(image, verbose=False)[0]
+        return detection_cpu.annotate_detections(image, prediction, path_to_img, output_dir, original_root, log_file)
+
+    except Exception as e:
+        detection_cpu.log_message(log_file, f"Error processing image '{image_filename}': {str(e)}")
+        return None
+
+
+def worker_process(args):
+    img_path, output_dir, json_output_dir, original_root, log_file, counter, total_images, lock = args
+    try:
+        cropped_info = make_inference_detection(img_path, output_dir, original_root, log_file)
+        detection_cpu.save_detection_json(img_path, cropped_info, json_output_dir, original_root, log_file)
+    except Exception as e:
+        detection_cpu.log_message(log_file, f"Error processing image '{img_path}': {str(e)}")
+    finally:
+        with lock:
+            counter.value += 1
+            print(f"PROCESS: {counter.value}/{total_images}", flush=True)
+
+
+def create_pool(yolo_model_path=detection_cpu.MODEL_PATH):
+    """
+    Create the pool of detection worker processes, each with its own YOLO model.
+    """
+    num_processes = max(1, min(mp.cpu_count() // 2, 12))
+    return mp.Pool(
+        processes=num_processes,
+        initializer=init_process,
+        initargs=(yolo_model_path,),
+    )
+
+
+def process_images_with_pool(yolo_model_path, original_images_dir, output_dir, json_output_dir, log_file, pool=None):
+    """
+    Run detection on every image in original_images_dir with a pool of worker
+    processes. An existing pool can be passed in to reuse its loaded models.
+    """
+    print("STATUS: BEGIN", flush=True)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    if not os.path.exists(json_output_dir):
+        os.makedirs(json_output_dir, exist_ok=True)
+    if not os.path.exists(original_images_dir):
+        detection_cpu.log_message(log_file, f"The path '{original_images_dir}' does not exist.")
+        raise FileNotFoundError(f"The path '{original_images_dir}' does not exist.")
+
+    image_files = detection_cpu.find_images(original_images_dir)
+
+    total_images = len(image_files)
+    if total_images == 0:
+        detection_cpu.log_message(log_file, f"No images found in the folder '{original_images_dir}'.")
+        return
+    print(f"PROCESS: 0/{total_images}")
+
+    mp.freeze_support()
+    manager = mp.Manager()
+    counter = manager.Value('i', 0)
+    lock = manager.Lock()
+
+    args_list = []
+    for img_path in image_files:
+        args_list.append((img_path, output_dir, json_output_dir, original_images_dir, log_file, counter, total_images, lock))
+
+    def map_images(pool):
+        result = pool.map_async(worker_process, args_list)
+        while not result.ready():
+            result.wait(timeout=1)
+
+    if pool is None:
+        with create_pool(yolo_model_path) as pool:
+            map_images(pool)
+    else:
+        map_images(pool)
+
+    print("STATUS: DONE", flush=True)
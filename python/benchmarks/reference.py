@@ -0,0 +1,68 @@
+"""
+Reference implementations which the production modules have replaced, kept as
+baselines for the benchmarks.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from neighbors import normalize    # noqa: E402
+
+
+def compute_distance_matrix(embeddings, is_duplicate):
+    """
+    Compute the dense cosine distance between every pair of embeddings, as ReID
+    did before neighbors.stream_candidates. embeddings can be an array or a CPU
+    tensor.
+    """
+    normed = normalize(np.asarray(embeddings))
+    dist_mat = 1 - normed @ normed.T    # ([N, N])
+
+    # Mask the self-match of each row, as the query image is also in the gallery.
+    if is_duplicate:
+        rows = np.arange(len(dist_mat))
+        dist_mat[rows, np.argmin(dist_mat, axis=1)] = np.max(dist_mat, axis=1) + 1
+    return dist_mat
+
+
+def reference_process_dist_mat_v2(dist_mat):
+    """
+    The original row-by-row implementation of clustering.process_dist_mat_v2.
+    """
+    number_of_images = len(dist_mat)
+    keys = np.array([-1] * number_of_images)
+
+    for r in range(len(dist_mat)):
+        row = dist_mat[r]
+        min_dist = np.min(row)
+        candidates_bool = np.abs(row - min_dist) <= 0.05
+        candidates_index = np.where(candidates_bool)[0]
+        candidates_key = keys[candidates_index]
+        current_counter = np.max(keys)
+
+        if keys[r] != -1:
+            keys[candidates_index] = keys[r]
+
+        elif keys[r] == -1 and np.all(candidates_key == -1):
+            keys[r] = current_counter + 1
+            keys[candidates_index] = current_counter + 1
+
+        elif keys[r] == -1 and np.any(candidates_key != -1):
+            min_pos_key = np.min(candidates_key[candidates_key != -1])
+            selected_indices = candidates_index[np.where(candidates_key != min_pos_key)[0]]
+            keys[r] = min_pos_key
+            keys[selected_indices] = min_pos_key
+
+    aid = 0
+    output_dict = dict()
+    min_key, max_key = np.min(keys), np.max(keys)
+    for k in range(min_key, max_key + 1):
+        if k in keys:
+            if aid not in output_dict:
+                output_dict[aid] = list(np.where(keys == k)[0])
+                aid += 1
+    return output_dict
@@ -0,0 +1,135 @@
+"""
+Synthetic camera trap data and stand-in models for the benchmarks.
+
+The real Detector.pt and CARE_Traced.pt are not in the repo, so the benchmarks
+can run on small random-weight stand-ins with the same inputs and outputs:
+
+    - a YOLOv8n detector built from ultralytics' bundled config, whose head is
+      biased so that it fires on a few anchors, with the CARE class names;
+    - a traced ViT-like ReID model taking [B, 3, 256, 128] crops and returning
+      [B, 1280] features, of which the last 512 are used as the embedding.
+
+Their timings are only comparable with each other, not with the real models,
+but they exercise every stage around the models the same way.
+"""
+
+import os
+
+import numpy as np
+
+
+def trap_images(image_dir, n, width=1920, height=1080, sites=2, individuals=10, seed=0):
+    """
+    Write n JPEGs of an animal-like blob on a noisy background, split over
+    sites, and return the (x1, y1, x2, y2) box of the blob in each, by path
+    relative to image_dir. Each individual has its own colour.
+    """
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    colours = rng.integers(0, 255, size=(individuals, 3))
+    background = rng.integers(60, 120, size=(height, width, 3), dtype=np.uint8)
+    boxes = dict()
+    for i in range(n):
+        image = background.copy()
+        w, h = int(rng.integers(width // 10, width // 4)), int(rng.integers(height // 10, height // 4))
+        x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+        colour = [int(c) for c in colours[rng.integers(0, individuals)]]
+        cv2.ellipse(image, (x + w // 2, y + h // 2), (w // 2, h // 2), 0, 0, 360, colour, -1)
+        relative_path = os.path.join(f"site{i % sites}", f"img{i}.jpg")
+        os.makedirs(os.path.join(image_dir, f"site{i % sites}"), exist_ok=True)
+        cv2.imwrite(os.path.join(image_dir, relative_path), image)
+        boxes[relative_path] = (x, y, x + w, y + h)
+    return boxes
+
+
+def random_dist_mat(rng, n):
+    """
+    A masked cosine distance matrix of n random embeddings, with a random
+    number of individuals, noise level and exact duplicates.
+    """
+    individuals = rng.normal(size=(int(rng.integers(max(1, n // 20), max(2, n // 2))), 32))
+    embeddings = individuals[rng.integers(0, len(individuals), n)]
+    embeddings = embeddings + rng.uniform(0.01, 1.5) * rng.normal(size=embeddings.shape)
+    duplicates = rng.integers(0, n, size=n // 10)
+    embeddings[duplicates] = embeddings[rng.integers(0, n, size=len(duplicates))]
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    dist_mat = (1 - embeddings @ embeddings.T).astype(np.float32)
+    rows = np.arange(n)
+    dist_mat[rows, np.argmin(dist_mat, axis=1)] = np.max(dist_mat, axis=1) + 1
+    return dist_mat
+
+
+def write_detections(json_dir, boxes):
+    """
+    Write the detection results of the images, as detection would, into the
+    detection store of json_dir.
+    """
+    from detection_store import DetectionStore
+
+    store = DetectionStore(json_dir)
+    for relative_path, bbox in boxes.items():
+        store.put(relative_path, {
+            "image": os.path.basename(relative_path),
+            "boxes": [{"label": "Stoat", "confidence": 0.9, "bbox": [float(c) for c in bbox]}],
+        })
+    store.close()
+
+
+def make_stub_detector(path, seed=0):
+    """
+    Save a random-weight YOLOv8n detector with the CARE class names.
+    """
+    import torch
+    from ultralytics import YOLO
+
+    torch.manual_seed(seed)
+    model = YOLO("yolov8n.yaml")
+    for seq in model.model.model[-1].cv3:
+        seq[-1].weight.data.normal_(0, 0.05)
+        seq[-1].bias.data[:] = -6.0
+        seq[-1].bias.data[0] = -1.0    # class 0 fires on a few anchors
+    model.model.names = {0: "Stoat", 1: "Rat"} | {i: f"class{i}" for i in range(2, 80)}
+    model.save(path)
+
+
+def make_stub_reid(path, dim=192, depth=4, seed=0):
+    """
+    Save a traced random-weight ViT-like model with the CARE model's inputs
+    and outputs.
+    """
+    import torch
+
+    class StubCARE(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.patch = torch.nn.Conv2d(3, dim, 16, 16)
+            self.cls = torch.nn.Parameter(torch.zeros(1, 1, dim))
+            layer = torch.nn.TransformerEncoderLayer(dim, 3, 4 * dim, batch_first=True, norm_first=True)
+            self.blocks = torch.nn.TransformerEncoder(layer, depth)
+            self.head = torch.nn.Linear(dim, 1280)
+
+        def forward(self, x):
+            tokens = self.patch(x).flatten(2).transpose(1, 2)
+            tokens = torch.cat([self.cls.expand(tokens.size(0), -1, -1), tokens], dim=1)
+            return self.head(self.blocks(tokens)[:, 0])
+
+    torch.manual_seed(seed)
+    model = StubCARE().eval()
+    with torch.no_grad():
+        torch.jit.trace(model, torch.randn(2, 3, 256, 128)).save(path)
+
+
+def stub_models(model_dir):
+    """
+    Make the stand-in models in model_dir, unless they are already there.
+    Returns the paths of the detector and the ReID model.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    detector_path = os.path.join(model_dir, "Detector_stub.pt")
+    reid_path = os.path.join(model_dir, "CARE_Traced_stub.pt")
+    if not os.path.exists(detector_path):
+        make_stub_detector(detector_path)
+    if not os.path.exists(reid_path):
+        make_stub_reid(reid_path)
+    return detector_path, reid_path
@@ -0,0 +1,192 @@
+"""
+Candidate blocking of ReID crops by site, camera and capture time.
+
+Without blocking every crop is compared with every other crop, N^2 distances
+in all. The images already say where and when they were taken, so with
+TEST.BLOCKING_KEYS crops are partitioned into blocks by any of:
+
+- site: the first folder under the input folder, e.g. <images>/<site>/...
+- camera: the camera model and serial number in the EXIF data
+- time: the window of TEST.BLOCKING_TIME_WINDOW hours of the EXIF capture time
+
+and each crop is only compared with the crops of its own block and of the
+blocks it is allowed to match: with TEST.BLOCKING_ADJACENT_WINDOWS, those of
+the time windows either side of its own (so that a window boundary does not
+split an encounter), and those of the sites paired in
+TEST.BLOCKING_ALLOWED_SITES ("siteA:siteB"). A crop whose image lacks a key
+(e.g. no EXIF date) is compared with every block on that key, so missing data
+never hides a match. The cost is then the sum over blocks of the block size
+times the size of its allowed blocks, rather than N^2.
+
+The candidate matches of each crop are found as in neighbors.stream_candidates,
+but only among its allowed crops, so with a single block the groupings are the
+same as without blocking.
+"""
+
+import math
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+from PIL import Image
+
+from neighbors import normalize
+
+
+BLOCK_KEYS = ("site", "camera", "time")
+
+EXIF_IFD = 0x8769
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_BODY_SERIAL_NUMBER = 0xA431
+
+
+def read_capture_info(image_path):
+    """
+    Return the camera (model and serial number) and the capture time (as a
+    timestamp) of an image from its EXIF data, each None if unknown.
+    """
+    try:
+        with Image.open(image_path) as img:
+            exif = img.getexif()
+    except OSError:
+        return None, None
+    sub_ifd = exif.get_ifd(EXIF_IFD)
+
+    model = str(exif.get(TAG_MODEL, "")).strip("\x00 ")
+    serial = str(sub_ifd.get(TAG_BODY_SERIAL_NUMBER, "")).strip("\x00 ")
+    camera = f"{model}#{serial}" if model or serial else None
+
+    timestamp = None
+    taken = str(sub_ifd.get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME) or "").strip("\x00 ")
+    try:
+        # EXIF times are local to the camera; they are only compared with each other.
+        timestamp = datetime.strptime(taken, "%Y:%m:%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        pass
+    return camera, timestamp
+
+
+def image_site(image_path, image_dir):
+    """
+    The first folder of the image under image_dir, or None if it is at the top.
+    """
+    parts = os.path.relpath(image_path, image_dir).split(os.sep)
+    return parts[0] if len(parts) > 1 else None
+
+
+class Blocks:
+    """
+    The block of every crop, and which blocks may match each other.
+    """
+
+    def __init__(self, labels, keys, adjacent_windows=True, allowed_sites=()):
+        self.labels = list(labels)
+        self.keys = tuple(keys)
+        self.adjacent_windows = adjacent_windows
+        self.allowed_sites = set()
+        for pair in allowed_sites:
+            site_a, site_b = pair.split(":")
+            self.allowed_sites |= {(site_a, site_b), (site_b, site_a)}
+
+        self.rows = dict()    # block label -> indices of its crops
+        for i, label in enumerate(self.labels):
+            self.rows.setdefault(label, []).append(i)
+
+    @classmethod
+    def from_images(cls, image_paths, image_dir, keys, time_window=24.0, adjacent_windows=True, allowed_sites=()):
+        """
+        Label every image (one per crop) with its values of keys.
+        """
+        unknown = set(keys) - set(BLOCK_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown blocking keys {sorted(unknown)}, options: {list(BLOCK_KEYS)}")
+        window_seconds = time_window * 3600
+
+        info = dict()
+        labels = []
+        for image_path in image_paths:
+            if image_path not in info:
+                camera, timestamp = None, None
+                if "camera" in keys or "time" in keys:
+                    camera, timestamp = read_capture_info(image_path)
+                values = {
+                    "site": image_site(image_path, image_dir),
+                    "camera": camera,
+                    "time": None if timestamp is None else math.floor(timestamp / window_seconds),
+                }
+                info[image_path] = tuple(values[key] for key in keys)
+            labels.append(info[image_path])
+        return cls(labels, keys, adjacent_windows, allowed_sites)
+
+    def subset(self, indices):
+        """
+        The blocks of the crops at indices, in that order.
+        """
+        return Blocks([self.labels[i] for i in indices], self.keys, self.adjacent_windows,
+                      [f"{a}:{b}" for a, b in self.allowed_sites])
+
+    def _values_match(self, key, a, b):
+        if a is None or b is None or a == b:
+            return True
+        if key == "time":
+            return self.adjacent_windows and abs(a - b) <= 1
+        if key == "site":
+            return (a, b) in self.allowed_sites
+        return False
+
+    def allowed(self, label_a, label_b):
+        """
+        Whether the crops of two blocks may match.
+        """
+        return all(self._values_match(key, a, b) for key, a, b in zip(self.keys, label_a, label_b))
+
+    def galleries(self):
+        """
+        Yield every block as its crop indices and the sorted indices of the
+        crops it is compared with, its own included.
+        """
+        labels = list(self.rows)
+        for label in labels:
+            gallery = [self.rows[other] for other in labels if self.allowed(label, other)]
+            yield np.asarray(self.rows[label]), np.sort(np.concatenate(gallery))
+
+    def describe(self):
+        return f"{len(self.rows)} blocks on {', '.join(self.keys)}"
+
+
+def stream_blocked_candidates(embeddings, blocks, window, block_size=1024):
+    """
+    Find the candidate matches of every embedding among the crops its block is
+    allowed to match, one block of rows at a time, masking the self-match as
+    stream_candidates does. Returns the candidates of each row and the number
+    of distances computed.
+    """
+    embeddings = normalize(embeddings)
+    candidates_per_row = [None] * len(embeddings)
+    compared = 0
+    for rows, gallery in blocks.galleries():
+        gallery_embeddings = embeddings[gallery]
+        compared += len(rows) * len(gallery)
+        for start in range(0, len(rows), block_size):
+            query_rows = rows[start:start + block_size]
+            dist = 1 - embeddings[query_rows] @ gallery_embeddings.T    # ([B, G])
+            index = np.arange(len(dist))
+            dist[index, np.argmin(dist, axis=1)] = np.max(dist, axis=1) + 1
+
+            min_dist = np.min(dist, axis=1, keepdims=True)
+            candidate_rows, candidate_cols = np.nonzero(np.abs(dist - min_dist) <= window)
+            bounds = np.searchsorted(candidate_rows, np.arange(len(dist) + 1))
+            for row, cols in zip(query_rows, np.split(candidate_cols, bounds[1:-1])):
+                candidates_per_row[row] = gallery[cols]
+    return candidates_per_row, compared
+
+
+def format_blocking_stats(blocks, compared):
+    n = len(blocks.labels)
+    total = n * n
+    avoided = total - compared
+    percent = 100 * avoided / total if total else 0.0
+    return (f"Blocking: {blocks.describe()}, {compared:,} of {total:,} comparisons computed "
+            f"({avoided:,} avoided, {percent:.1f}%).")
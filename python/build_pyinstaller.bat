@@ -31,7 +31,7 @@ if not errorlevel 1 (
     exit /b 1
 )
 
-:: Run PyInstaller
+:: Run PyInstaller. main.py imports the task modules by name, so they are hidden imports.
 pyinstaller ^
     --noconfirm ^
     --name care-detect-reid ^
@@ -41,6 +41,12 @@ pyinstaller ^
     --add-data models\CARE_Traced_GPUv.pt;models ^
     --add-data models\Detector.pt;models ^
     --add-data models\Detector_GPU.pt;models ^
+    --hidden-import detect_reid ^
+    --hidden-import detection_cpu ^
+    --hidden-import detection_gpu ^
+    --hidden-import reid_cpu ^
+    --hidden-import reid_gpu ^
+    --hidden-import serve ^
     main.py
 
 endlocal
\ No newline at end of file
@@ -25,6 +25,8 @@ done
 # Don't use Conda; it's multiprocessing impelementation is broken.
 conda info &> /dev/null && (echo "DO NOT REDISTRIBUTE CONDA PYTHON" ; exit 1)
 
+# main.py imports the task modules by name, once the task is known, so they are
+# listed as hidden imports.
 pyinstaller \
     --noconfirm \
     --name care-detect-reid \
@@ -34,4 +36,10 @@ pyinstaller \
     --add-data models/CARE_Traced_GPUv.pt:models \
     --add-data models/Detector.pt:models \
     --add-data models/Detector_GPU.pt:models \
+    --hidden-import detect_reid \
+    --hidden-import detection_cpu \
+    --hidden-import detection_gpu \
+    --hidden-import reid_cpu \
+    --hidden-import reid_gpu \
+    --hidden-import serve \
     main.py
@@ -0,0 +1,92 @@
+"""
+Grouping of ReID crops into individuals.
+
+Each crop is grouped with its candidate matches: the crops whose distance is
+within CANDIDATE_WINDOW of its nearest neighbour. The candidates can come from a
+dense distance matrix (process_dist_mat_v2), from neighbors.stream_candidates,
+which streams over blocks of the same matrix, or from top-k neighbour lists
+(process_neighbor_lists). All of them feed the same grouping, so they agree
+whenever no row has more than k candidates.
+"""
+
+import numpy as np
+
+
+CANDIDATE_WINDOW = 0.05
+
+
+def group_candidates(candidates_per_row):
+    """
+    Assign a key to every crop from the candidate matches of each row, in row
+    order, and return a dict of individual number to crop indices.
+
+    The assignment is order dependent: a crop which already has a key is
+    re-keyed on its own when a later row claims it, leaving the rest of its
+    group behind. A union-find over the candidate edges would merge both groups
+    instead, so it would not reproduce these groupings. Each row costs
+    O(its candidates), and new keys come from a counter rather than a scan of
+    all the keys, so the whole pass is linear in the number of candidates.
+    """
+    number_of_images = len(candidates_per_row)
+    keys = np.full(number_of_images, -1, dtype=np.int64)
+    next_key = 0
+
+    for r, candidates_index in enumerate(candidates_per_row):
+        if keys[r] != -1:
+            keys[candidates_index] = keys[r]
+            continue
+
+        candidates_key = keys[candidates_index]
+        assigned_keys = candidates_key[candidates_key != -1]
+        if len(assigned_keys) == 0:
+            keys[r] = next_key
+            keys[candidates_index] = next_key
+            next_key += 1
+        else:
+            min_pos_key = assigned_keys.min()
+            keys[r] = min_pos_key
+            keys[candidates_index] = min_pos_key
+
+    # Number the individuals in key order, listing each one's crops in order.
+    _, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+    return {aid: list(group) for aid, group in enumerate(groups)}
+
+
+def process_dist_mat_v2(dist_mat):
+    """
+    Process the distance matrix to count the number of individuals.
+    """
+    candidates_per_row = []
+    for row in dist_mat:
+        min_dist = np.min(row)
+        candidates_bool = np.abs(row - min_dist) <= CANDIDATE_WINDOW
+        candidates_per_row.append(np.where(candidates_bool)[0])
+    return group_candidates(candidates_per_row)
+
+
+def process_neighbor_lists(indices, distances):
+    """
+    Process the (N, k) top-k neighbour lists of every crop, sorted nearest
+    first, to count the number of individuals. Missing neighbours (index -1,
+    infinite distance) are ignored.
+    """
+    candidates_per_row = []
+    for row_indices, row_distances in zip(indices, distances):
+        if len(row_distances) == 0 or not np.isfinite(row_distances[0]):
+            candidates_per_row.append(np.array([], dtype=np.int64))
+            continue
+        candidates_bool = row_distances - row_distances[0] <= CANDIDATE_WINDOW
+        candidates_per_row.append(row_indices[candidates_bool])
+    return group_candidates(candidates_per_row)
+
+
+def count_truncated_rows(distances):
+    """
+    Count the rows whose candidate window may extend past their k-th neighbour,
+    i.e. rows where k was too small to see every candidate.
+    """
+    if distances.shape[1] == 0:
+        return 0
+    return int(np.sum(distances[:, -1] - distances[:, 0] <= CANDIDATE_WINDOW))
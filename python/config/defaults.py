@@ -219,6 +219,12 @@ _C.TEST = CN()
 _C.TEST.IMS_PER_BATCH = 128
 # If test with re-ranking, options: 'True','False'
 _C.TEST.RE_RANKING = False
+# Size of the k-reciprocal neighbourhoods of re-ranking
+_C.TEST.RE_RANKING_K1 = 20
+# Number of neighbours averaged in the query expansion of re-ranking
+_C.TEST.RE_RANKING_K2 = 6
+# Weight of the original distance in the re-ranked distance, against the Jaccard distance
+_C.TEST.RE_RANKING_LAMBDA = 0.3
 # Path to trained model
 _C.TEST.WEIGHT = ""
 # Which feature of BNNeck to be used for test, before or after BNNneck, options: 'before' or 'after'
@@ -230,6 +236,62 @@ _C.TEST.FEAT_NORM = 'yes'
 _C.TEST.DIST_MAT = "dist_mat.npy"
 # Whether calculate the eval score option: 'True', 'False'
 _C.TEST.EVAL = False
+# Whether to cache the embedding of each crop on disk between runs, options: 'True', 'False'
+_C.TEST.EMBEDDING_CACHE = True
+# Data type of the cached embeddings, options: 'float32', 'float16'
+_C.TEST.EMBEDDING_CACHE_DTYPE = 'float32'
+# Size budget of the embedding cache, in MB
+_C.TEST.EMBEDDING_CACHE_MAX_MB = 512
+# Whether to match crops against the persisted gallery of known individuals, so IDs are stable
+# across runs, options: 'True', 'False'
+_C.TEST.INCREMENTAL = False
+# Largest cosine distance at which a crop can match a known individual
+_C.TEST.GALLERY_MAX_DIST = 0.3
+# Number of embeddings kept per known individual
+_C.TEST.GALLERY_EXEMPLARS = 32
+# How to find the candidate matches of each crop, options: 'auto', 'blocked' (exact, streamed over
+# blocks of the distance matrix), 'exact' (top-k), 'ivf' (approximate top-k). 'auto' uses 'blocked'
+# below TEST.ANN_MIN_SIZE crops and 'ivf' above
+_C.TEST.NEIGHBOR_BACKEND = 'auto'
+# Number of distance matrix rows computed at a time
+_C.TEST.DIST_BLOCK_SIZE = 1024
+# Whether to save the full distance matrix to the log folder as TEST.DIST_MAT, for auditing ('blocked' only)
+_C.TEST.SAVE_DIST_MAT = False
+# Number of nearest neighbours considered for each crop
+_C.TEST.NEIGHBOR_K = 50
+# Number of crops from which 'auto' switches to the 'ivf' backend
+_C.TEST.ANN_MIN_SIZE = 20000
+# Number of inverted lists searched for each crop by the 'ivf' backend
+_C.TEST.ANN_N_PROBE = 8
+# Whether to save the crops as JPEGs into the cropped images folder, for debugging; crops are
+# otherwise only kept in memory, options: 'True', 'False'
+_C.TEST.DUMP_CROPS = False
+# Whether to decode JPEGs at a reduced scale which still leaves every crop at least the model input
+# size, which is faster but changes the embeddings slightly, options: 'True', 'False'
+_C.TEST.REDUCED_DECODE = False
+# Whether to only embed one of each set of identical images and give its duplicates the same IDs,
+# options: 'True', 'False'
+_C.TEST.DEDUP_IMAGES = True
+# Whether to run the ReID model with INT8 quantized Linear layers on CPU (ignored on GPU), which is
+# faster but changes the embeddings slightly, options: 'True', 'False'
+_C.TEST.QUANTIZE = False
+# Inference engine of the ReID model on CPU (ignored on GPU), '' to use the CARE_ENGINE environment
+# variable or else 'torch', options: 'torch', 'onnx'
+_C.TEST.ENGINE = ''
+# Keys to partition the crops by before looking for matches, so that crops are only compared within
+# the same (or an allowed) block; [] compares every crop with every other, options: 'site', 'camera', 'time'
+_C.TEST.BLOCKING_KEYS = []
+# Length of the capture time windows of the 'time' blocking key, in hours
+_C.TEST.BLOCKING_TIME_WINDOW = 24.0
+# Whether crops may also match the crops of the neighbouring time windows, options: 'True', 'False'
+_C.TEST.BLOCKING_ADJACENT_WINDOWS = True
+# Pairs of sites whose crops may match each other, e.g. ['north:south']
+_C.TEST.BLOCKING_ALLOWED_SITES = []
+# Whether to keep the resized crops on disk as uint8 between runs, so that later runs (e.g. with other
+# clustering settings or model variants) read them rather than decode the images, options: 'True', 'False'
+_C.TEST.CROP_SHARDS = False
+# Size budget of the crop shards, in MB
+_C.TEST.CROP_SHARDS_MAX_MB = 2048
 # ---------------------------------------------------------------------------- #
 # Misc options
 # ---------------------------------------------------------------------------- #
@@ -0,0 +1,131 @@
+"""
+Persistent on-disk store of ReID crops, resized and ready to normalize.
+
+Every ReID run otherwise decodes the original images again to cut out their
+crops, even when only the clustering settings changed. With TEST.CROP_SHARDS,
+each crop is stored once, resized to the model input size, as uint8 pixels in
+a single flat file:
+
+    crops.u8      N records of H x W x 3 uint8 (98 KB each at 256 x 128)
+    crops.json    crop key -> record number, and the record shape
+
+Record i starts at byte i * H * W * 3, so the file is memory-mapped and a crop
+is paged in only when it is read. The pixels are stored before ToTensor and
+Normalize, which are applied as the crops are read, so a crop read from the
+store gives exactly the tensor of a fresh decode, at a quarter of the size of
+a float32 tensor.
+
+Crops are keyed like the embedding cache (the hash of the original image
+content plus the bbox, see embedding_cache.py), with the decode as a suffix of
+the image hash. Records are only ever appended; once the store reaches its size
+budget no more crops are added, and a store found over budget (e.g. after the
+budget was lowered) is started over.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+INDEX_FILENAME = "crops.json"
+PIXELS_FILENAME = "crops.u8"
+SHARDS_VERSION = 1
+
+
+def default_shard_dir(reid_output_dir):
+    """
+    Place the crop store next to the ReID output folder, e.g.
+    data/image_reid_output/1 -> data/image_reid_output_crops/1.
+    """
+    reid_output_dir = os.path.normpath(reid_output_dir)
+    parent_dir, user_dir = os.path.split(reid_output_dir)
+    return os.path.join(parent_dir + "_crops", user_dir)
+
+
+class CropShards:
+    """
+    Append-only store of uint8 crops of one size, bounded by a size budget.
+    """
+
+    key = staticmethod(EmbeddingCache.key)
+
+    def __init__(self, shard_dir, size, max_bytes=2048 << 20):
+        height, width = size
+        self.shard_dir = shard_dir
+        self.shape = (height, width, 3)
+        self.record_bytes = height * width * 3
+        self.max_records = max_bytes // self.record_bytes
+        self.index_path = os.path.join(shard_dir, INDEX_FILENAME)
+        self.pixels_path = os.path.join(shard_dir, PIXELS_FILENAME)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        self.index = self._load_index()
+        if (self.index.get("version") != SHARDS_VERSION
+                or self.index.get("shape") != list(self.shape)
+                or len(self.index.get("entries", {})) > self.max_records
+                or not os.path.exists(self.pixels_path)
+                or os.path.getsize(self.pixels_path) < len(self.index["entries"]) * self.record_bytes):
+            self.index = {"version": SHARDS_VERSION, "shape": list(self.shape), "entries": {}}
+
+        # Drop any records appended after the index was last saved (e.g. by a
+        # run which was killed), then map the records which are indexed.
+        self.mapped = len(self.index["entries"])
+        with open(self.pixels_path, "a+b") as f:
+            f.truncate(self.mapped * self.record_bytes)
+        self.pixels = None
+        if self.mapped:
+            self.pixels = np.memmap(self.pixels_path, dtype=np.uint8, mode="r", shape=(self.mapped,) + self.shape)
+        self.appending = None
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __len__(self):
+        return len(self.index["entries"])
+
+    def __contains__(self, key):
+        return self.index["entries"].get(key, self.mapped) < self.mapped
+
+    def get(self, key):
+        """
+        Return the H x W x 3 uint8 pixels of a crop, or None if it is not in
+        the store. Crops added by this run are not read back.
+        """
+        record = self.index["entries"].get(key, self.mapped)
+        if record >= self.mapped:
+            return None
+        return np.array(self.pixels[record])
+
+    def put(self, key, pixels):
+        """
+        Append a crop unless it is already stored or the store is full.
+        """
+        entries = self.index["entries"]
+        if key in entries or len(entries) >= self.max_records:
+            return
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        if pixels.shape != self.shape:
+            raise ValueError(f"Crop of shape {pixels.shape} does not fit the store of shape {self.shape}.")
+        if self.appending is None:
+            self.appending = open(self.pixels_path, "ab")
+        self.appending.write(pixels.tobytes())
+        entries[key] = len(entries)
+
+    def save(self):
+        """
+        Flush the appended crops, then atomically rewrite the index.
+        """
+        if self.appending is not None:
+            self.appending.close()
+            self.appending = None
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,153 @@
+"""
+Detection and ReID in a single pass over the images.
+
+Run separately, detection decodes every image, and ReID later decodes every
+image again to crop its boxes. `python main.py detect-reid` embeds the crops of
+each image during detection instead, while its decoded image is still in
+memory, and then groups them as soon as detection finishes:
+
+    decode -> detect -> mark and save -> crop and embed -> [embedding cache]
+                                                               |
+                                  after the last image: group the crops
+
+The embeddings are persisted in the ReID embedding cache (see
+embedding_cache.py), keyed like any other crop, rather than in the detection
+record, which keeps the schema of the detection store unchanged; the ReID step
+reads them back rather than decoding the images. Crops cut from detection's decode are
+keyed as their own variant ("detect"), since they can differ slightly from
+ReID's own decode of the same image (e.g. cv2 applies the EXIF orientation and
+PIL does not). Images which detection skips (see detection_manifest) are
+embedded from the cache of an earlier run, or else decoded by the ReID step as
+usual and cached under the usual ReID keys. The embedding cache is always on in this mode, and TEST.REDUCED_DECODE
+does not apply.
+"""
+
+import sys
+import threading
+import time
+
+import cv2
+import torch
+
+from embedding_cache import EmbeddingCache, default_cache_dir, hash_file
+from PIL import Image
+from tracing import span, trace
+
+
+class CropEmbedder:
+    """
+    Embeds the crops of the images as detection writes them, in batches
+    across images, into the embedding cache. Safe to call from several
+    writer threads; one batch runs at a time.
+    """
+
+    def __init__(self, reid, model, detected_variant, cache, device, original_root, output_dir, log_file):
+        self.reid = reid
+        self.model = model
+        self.variant = reid.embedding_variant(detected_variant)
+        self.cache = cache
+        self.device = device
+        self.original_root = original_root
+        self.output_dir = output_dir
+        self.log_file = log_file
+        self.batch_size = reid.cfg.TEST.IMS_PER_BATCH
+        self.lock = threading.Lock()
+        self.keys = []
+        self.crops = []
+        self.embedded = 0
+
+    def on_detected(self, image_path, image, scale, detection):
+        """
+        Crop and preprocess the boxes of a detected image, queueing the crops
+        which are not already in the cache.
+        """
+        if detection is None or scale != (1.0, 1.0):
+            return
+        crops = self.reid.crop_boxes_from_detection(image_path, detection, self.output_dir, self.original_root,
+                                                    self.log_file)
+        if not crops:
+            return
+        image_hash = hash_file(image_path) + self.variant
+        keys = [self.cache.key(image_hash, bbox) for _, bbox in crops]
+        with self.lock:
+            _, missing = self.cache.lookup(keys)
+        if not missing:
+            return
+
+        with span("crop", items=len(missing)):
+            rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            tensors = [self.reid.preprocess_image(rgb.crop(crops[i][1])) for i in missing]
+        with self.lock:
+            self.keys.extend(keys[i] for i in missing)
+            self.crops.extend(tensors)
+            if len(self.crops) >= self.batch_size:
+                self._embed()
+
+    def _embed(self):
+        embeddings = self.reid.compute_embeddings(self.model, self.crops, self.device, self.batch_size)
+        self.cache.insert(self.keys, embeddings.numpy())
+        self.embedded += len(self.keys)
+        self.keys = []
+        self.crops = []
+
+    def flush(self):
+        """
+        Embed the remaining crops and save the cache.
+        """
+        with self.lock:
+            if self.crops:
+                self._embed()
+            self.cache.save()
+
+
+def run(original_images_dir, output_images_dir, json_output_dir, output_dir, reid_output_dir, log_dir='',
+        opts=None):
+    with trace("detect-reid"):
+        detect_and_reidentify(original_images_dir, output_images_dir, json_output_dir, output_dir, reid_output_dir,
+                              log_dir, opts)
+
+
+def detect_and_reidentify(original_images_dir, output_images_dir, json_output_dir, output_dir, reid_output_dir,
+                          log_dir='', opts=None):
+    if torch.cuda.is_available():
+        import detection_gpu as detection
+        import reid_gpu as reid
+        device = "cuda"
+    else:
+        import detection_cpu as detection
+        import reid_cpu as reid
+        device = "cpu"
+
+    opts = list(opts or []) + ["TEST.EMBEDDING_CACHE", "True", "TEST.REDUCED_DECODE", "False"]
+    reid.load_cfg(reid.CFG_FILE_PATH, opts)
+    log_file = reid.create_log_file(log_dir)
+    start_time = time.time()
+
+    model, model_variant = reid.load_reid_model(reid.MODEL_PATH, reid_output_dir, log_file)
+    detected_variant = model_variant + ":detect" if model_variant else "detect"
+    cache = EmbeddingCache(default_cache_dir(reid_output_dir), [reid.MODEL_PATH, reid.CFG_FILE_PATH],
+                           dtype=reid.cfg.TEST.EMBEDDING_CACHE_DTYPE,
+                           max_bytes=reid.cfg.TEST.EMBEDDING_CACHE_MAX_MB << 20)
+    embedder = CropEmbedder(reid, model, detected_variant, cache, device, original_images_dir, output_dir, log_file)
+    try:
+        detection.run(original_images_dir, output_images_dir, json_output_dir, log_dir,
+                      on_detected=embedder.on_detected)
+    finally:
+        embedder.flush()
+    reid.log_message(log_file, f"Embedded {embedder.embedded} crops during detection.")
+
+    reid.run(original_images_dir, json_output_dir, output_dir, reid_output_dir, log_dir, opts, model=model,
+             model_variant=model_variant, detected_variant=detected_variant)
+    reid.log_message(log_file, f"Total processing time: {time.time() - start_time:.2f} seconds")
+
+
+def main():
+    if len(sys.argv) != 6:
+        print("Usage: python detect_reid.py <input_folder> <output_folder> <json_output_folder> <crop_folder> "
+              "<reid_output_folder>", flush=True)
+        sys.exit(1)
+    run(*sys.argv[1:6])
+
+
+if __name__ == "__main__":
+    main()
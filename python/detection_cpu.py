@@ -1,22 +1,26 @@
 import cv2
 import json
-import multiprocessing as mp
 import os
 import sys
 import time
 import signal
+import torch
 
 from datetime import datetime
+from detection_manifest import DetectionManifest, default_manifest_dir, skip_up_to_date
+from detection_pipeline import format_decode_stats, format_stats, run_pipeline
+from detection_store import DetectionStore, legacy_json_path
+from embedding_cache import default_cache_dir
+from engines import load_onnx_detector, onnx_path, resolve_engine
+from image_decode import read_image_reduced, scale_box
+from image_dedup import copy_detection_outputs, find_duplicates, format_dedup_stats
+from tracing import span, trace
 from ultralytics import YOLO
 from pathlib import Path
 
-
-yolo_model = None    # global variable
-
-def init_process(yolo_model_path):
-    global yolo_model
-    DEVICE = "cpu"
-    yolo_model = YOLO(yolo_model_path).to(DEVICE)
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "Detector.pt")
+BATCH_SIZE = 8
+DECODE_MIN_SIDE = 1280    # long side of reduced decodes, twice the YOLO input size
 
 
 def create_log_file(log_dir: str = '') -> str:
@@ -36,136 +40,228 @@ def log_message(log_file, message):
         f.write(f"[{current_time}] {message}\n")
 
 
-def make_inference_detection(path_to_img, output_dir, original_root, log_file):
-    global yolo_model
+def annotate_detections(image, prediction, path_to_img, output_dir, original_root, log_file, scale=(1.0, 1.0)):
+    """
+    Read the boxes of a YOLO prediction, draw them on the decoded image and save
+    the marked image under output_dir. For an image decoded at reduced size,
+    scale maps the boxes back to the full image, and the marks are scaled down
+    to match the marked image.
+    """
+    draw_scale = 1 / scale[0]
     image_filename = os.path.basename(path_to_img)
+    class_dict = prediction.names
+    array_of_confidences = prediction.boxes.conf.numpy()
+    array_of_labels = prediction.boxes.cls.numpy()
+
+    bounding_boxes = []
+
+    if output_dir:
+        relative_path = os.path.relpath(path_to_img, original_root)
+        output_path = os.path.join(output_dir, relative_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    if len(array_of_confidences) == 0:
+        log_message(log_file, f"No Detection in image '{image_filename}'.")
+        bounding_boxes.append({
+            "label": None,
+            "confidence": 0,
+            "bbox": []
+        })
+        image_to_save = image
+        save_message = f"Original image '{image_filename}' has been saved to '{output_path}'."
+    else:
+        for i in range(len(array_of_confidences)):
+            conf = round(array_of_confidences[i], 2)
+            label = class_dict[int(array_of_labels[i])]
+            bounding_box = prediction.boxes.xyxy.numpy()[i]
+            bounding_boxes.append({
+                "label": label,
+                "confidence": float(conf),
+                "bbox": [float(coord) for coord in scale_box(bounding_box.tolist(), scale)]
+            })
 
-    try:
-        if not os.path.exists(path_to_img):
-            log_message(log_file, f"The path '{path_to_img}' does not exist.")
-            return None
-
-        image = cv2.imread(path_to_img)
-        if image is None:
-            log_message(log_file, f"Failed to read image '{path_to_img}'.")
-            return None
-
-        prediction = yolo_model(path_to_img, verbose=False)[0]
-        class_dict = prediction.names
-        array_of_confidences = prediction.boxes.conf.numpy()
-        array_of_labels = prediction.boxes.cls.numpy()
+            x1, y1, x2, y2 = list(map(int, bounding_box))
+            cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), max(1, round(15 * draw_scale)))
+            label_text = f"{label} ({conf:.2f})"
+            font = cv2.FONT_HERSHEY_SIMPLEX
+            font_scale = 3.5 * draw_scale
+            thickness = max(1, round(10 * draw_scale))
+            margin = max(1, round(10 * draw_scale))
+            text_size = cv2.getTextSize(label_text, font, font_scale, thickness)[0]
+            text_x = x1
+            text_y = y1 - margin if y1 - text_size[1] - margin >= 0 else y2 + text_size[1] + margin
+            cv2.rectangle(image, (text_x, text_y - text_size[1] - margin),
+                          (text_x + text_size[0], text_y + margin), (0, 0, 255), -1)
+            cv2.putText(image, label_text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
+        image_to_save = image
+        save_message = f"Marked image '{image_filename}' has been saved to '{output_path}'."
+
+    if output_dir:
+        cv2.imwrite(output_path, image_to_save)
+        log_message(log_file, save_message)
+
+    return {
+        "image": image_filename,
+        "boxes": bounding_boxes
+    }
+
+
+def save_detection_json(img_path, cropped_info, json_output_dir, original_root, log_file, store=None):
+    """
+    Save the selected detection of an image (the most confident Stoat, else the
+    most confident detection), or an empty detection if cropped_info is None,
+    into the detection store if given, else as a JSON file.
+    """
+    relative_path = os.path.relpath(img_path, original_root)
 
-        bounding_boxes = []
+    if cropped_info:
+        detections = cropped_info['boxes']
+        selected_detection = None
 
-        if output_dir:
-            relative_path = os.path.relpath(path_to_img, original_root)
-            output_path = os.path.join(output_dir, relative_path)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        stoat_detections = [d for d in detections if d['label'] == 'Stoat']
 
-        if len(array_of_confidences) == 0:
-            log_message(log_file, f"No Detection in image '{image_filename}'.")
-            bounding_boxes.append({
+        if stoat_detections:
+            selected_detection = max(stoat_detections, key=lambda x: x['confidence'])
+        else:
+            valid_detections = [d for d in detections if d['label'] is not None]
+            selected_detection = max(valid_detections, key=lambda x: x['confidence']) if valid_detections else {
                 "label": None,
                 "confidence": 0,
                 "bbox": []
-            })
-            image_to_save = image
-            save_message = f"Original image '{image_filename}' has been saved to '{output_path}'."
-        else:
-            for i in range(len(array_of_confidences)):
-                conf = round(array_of_confidences[i], 2)
-                label = class_dict[int(array_of_labels[i])]
-                bounding_box = prediction.boxes.xyxy.numpy()[i]
-                bounding_boxes.append({
-                    "label": label,
-                    "confidence": float(conf),
-                    "bbox": [float(coord) for coord in bounding_box.tolist()]
-                })
-
-                x1, y1, x2, y2 = list(map(int, bounding_box))
-                cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 15)
-                label_text = f"{label} ({conf:.2f})"
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                font_scale = 3.5
-                thickness = 10
-                text_size = cv2.getTextSize(label_text, font, font_scale, thickness)[0]
-                text_x = x1
-                text_y = y1 - 10 if y1 - text_size[1] - 10 >= 0 else y2 + text_size[1] + 10
-                cv2.rectangle(image, (text_x, text_y - text_size[1] - 10),
-                              (text_x + text_size[0], text_y + 10), (0, 0, 255), -1)
-                cv2.putText(image, label_text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
-            image_to_save = image
-            save_message = f"Marked image '{image_filename}' has been saved to '{output_path}'."
-
-        if output_dir:
-            cv2.imwrite(output_path, image_to_save)
-            log_message(log_file, save_message)
-
-        return {
-            "image": image_filename,
-            "boxes": bounding_boxes
+            }
+
+        json_output = {
+            "image": cropped_info['image'],
+            "boxes": [selected_detection]
+        }
+    else:
+        json_output = {
+            "image": os.path.basename(img_path),
+            "boxes": [{"label": None, "confidence": 0, "bbox": []}]
         }
 
-    except Exception as e:
-        log_message(log_file, f"Error processing image '{image_filename}': {str(e)}")
-        return None
+    if store is not None:
+        store.put(relative_path, json_output)
+        json_output_path = store.path
+    else:
+        json_output_path = legacy_json_path(json_output_dir, relative_path)
+        os.makedirs(os.path.dirname(json_output_path), exist_ok=True)
+        with open(json_output_path, "w") as f:
+            json.dump(json_output, f, indent=4)
 
+    if cropped_info:
+        log_message(log_file, f"Cropped info for '{cropped_info['image']}' has been saved to '{json_output_path}'.")
+    else:
+        log_message(log_file, f"No detections for '{img_path}'. Empty JSON saved to '{json_output_path}'.")
 
-def worker_process(args):
-    img_path, output_dir, json_output_dir, original_root, log_file, counter, total_images, lock = args
-    try:
-        cropped_info = make_inference_detection(img_path, output_dir, original_root, log_file)
-        if cropped_info:
-            relative_path = os.path.relpath(img_path, original_root)
-            json_filename = os.path.splitext(relative_path)[0] + ".json"
-            json_output_path = os.path.join(json_output_dir, json_filename)
-            os.makedirs(os.path.dirname(json_output_path), exist_ok=True)
-
-            detections = cropped_info['boxes']
-            selected_detection = None
-
-            stoat_detections = [d for d in detections if d['label'] == 'Stoat']
-
-            if stoat_detections:
-                selected_detection = max(stoat_detections, key=lambda x: x['confidence'])
-            else:
-                valid_detections = [d for d in detections if d['label'] is not None]
-                selected_detection = max(valid_detections, key=lambda x: x['confidence']) if valid_detections else {
-                    "label": None,
-                    "confidence": 0,
-                    "bbox": []
-                }
-
-            json_output = {
-                "image": cropped_info['image'],
-                "boxes": [selected_detection]
-            }
 
-            with open(json_output_path, "w") as f:
-                json.dump(json_output, f, indent=4)
+def find_images(original_images_dir):
+    image_files = []
+    for root, dirs, files in os.walk(original_images_dir):
+        for file in files:
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                image_files.append(os.path.join(root, file))
+    return image_files
+
 
-            log_message(log_file, f"Cropped info for '{cropped_info['image']}' has been saved to '{json_output_path}'.")
-        else:
-            relative_path = os.path.relpath(img_path, original_root)
-            json_filename = os.path.splitext(relative_path)[0] + ".json"
-            json_output_path = os.path.join(json_output_dir, json_filename)
-            os.makedirs(os.path.dirname(json_output_path), exist_ok=True)
-            json_output = {
-                "image": os.path.basename(img_path),
-                "boxes": [{"label": None, "confidence": 0, "bbox": []}]
-            }
-            with open(json_output_path, "w") as f:
-                json.dump(json_output, f, indent=4)
-            log_message(log_file, f"No detections for '{img_path}'. Empty JSON saved to '{json_output_path}'.")
+def load_model(model_path=MODEL_PATH, device="cpu", engine=None, export_dir=None):
+    """
+    Load the YOLO detector, or with the onnx engine its ONNX export in
+    export_dir (see engines).
+    """
+    if resolve_engine(engine) == "onnx":
+        if export_dir is None:
+            raise ValueError("The onnx engine needs a folder for the ONNX export of the detector.")
+        return load_onnx_detector(model_path, export_dir)[0]
+    return YOLO(model_path).to(device)
+
+
+def default_io_workers():
+    return max(1, min((os.cpu_count() or 1) // 4, 4))
+
+
+def configure_threads(num_io_workers):
+    """
+    Give torch's intra-op thread pool the cores which the I/O workers do not use.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) - num_io_workers)
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def decode_image(path_to_img, log_file, reduced_decode=False):
+    """
+    Decode an image, returning it with the scale from its coordinates to those
+    of the full image, or None if it cannot be read. With reduced_decode, JPEGs
+    are decoded at the smallest DCT scale which keeps DECODE_MIN_SIDE pixels.
+    """
+    if reduced_decode:
+        image, scale = read_image_reduced(path_to_img, DECODE_MIN_SIDE)
+    else:
+        image, scale = cv2.imread(path_to_img), (1.0, 1.0)
+    if image is None:
+        log_message(log_file, f"Failed to read image '{path_to_img}'.")
+        return None
+    return image, scale
+
+
+def predict_batch(yolo_model, images):
+    """
+    Run YOLO on a batch of decoded images, returning None for the images which
+    could not be decoded. Images are batched by shape: YOLO letterboxes a batch
+    of mixed shapes to a square, which changes the predicted boxes slightly.
+    """
+    predictions = [None] * len(images)
+    by_shape = dict()
+    for i, image in enumerate(images):
+        if image is not None:
+            by_shape.setdefault(image.shape, []).append(i)
+    for indices in by_shape.values():
+        preds = yolo_model([images[i] for i in indices], verbose=False)
+        for i, pred in zip(indices, preds):
+            predictions[i] = pred
+    return predictions
+
+
+def write_detection(image, prediction, img_path, output_dir, json_output_dir, original_root, log_file, scale=(1.0, 1.0),
+                    store=None):
+    """
+    Save the marked image and the detection of one image. Returns whether the
+    prediction was annotated and saved.
+    """
+    try:
+        cropped_info = None
+        if prediction is not None:
+            try:
+                with span("annotate"):
+                    cropped_info = annotate_detections(image, prediction, img_path, output_dir, original_root,
+                                                       log_file, scale)
+            except Exception as e:
+                log_message(log_file, f"Error processing image '{os.path.basename(img_path)}': {str(e)}")
+        with span("write"):
+            save_detection_json(img_path, cropped_info, json_output_dir, original_root, log_file, store)
+        return cropped_info is not None
     except Exception as e:
         log_message(log_file, f"Error processing image '{img_path}': {str(e)}")
-    finally:
-        with lock:
-            counter.value += 1
-            print(f"PROCESS: {counter.value}/{total_images}", flush=True)
+        return False
 
 
-def process_images_with_pool(yolo_model_path, original_images_dir, output_dir, json_output_dir, log_file):
+def process_images_batched(yolo_model, original_images_dir, output_dir, json_output_dir, log_file,
+                           batch_size=BATCH_SIZE, num_io_workers=None, reduced_decode=False, manifest=None,
+                           on_detected=None):
+    """
+    Run detection on every image in original_images_dir with a single YOLO
+    model, in batches, using the spare cores for torch's intra-op threads.
+    Decoding and writing run in their own threads, overlapping with inference
+    (see detection_pipeline). With reduced_decode, JPEGs are decoded at reduced
+    size (see image_decode): the JSON boxes are mapped back to the full image,
+    but the marked images are saved at the reduced size. The detections go to
+    the detection store of json_output_dir (see detection_store). With a
+    manifest, the images which are up to date in it are skipped. Duplicate
+    images (see image_dedup) are only detected on once. on_detected(path,
+    image, scale, detection) is called from the writer threads for every image
+    detected on, with the image as decoded (before it is marked).
+    """
     print("STATUS: BEGIN", flush=True)
 
     if not os.path.exists(output_dir):
@@ -176,36 +272,81 @@ def process_images_with_pool(yolo_model_path, original_images_dir, output_dir, j
         log_message(log_file, f"The path '{original_images_dir}' does not exist.")
         raise FileNotFoundError(f"The path '{original_images_dir}' does not exist.")
 
-    image_files = []
-    for root, dirs, files in os.walk(original_images_dir):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                image_files.append(os.path.join(root, file))
-
-    total_images = len(image_files)
-    if total_images == 0:
-        log_message(log_file, f"No images found in the folder '{original_images_dir}'.")
+    with span("scan") as scan:
+        image_files = find_images(original_images_dir)
+        scan["items"] = total_images = len(image_files)
+        if total_images == 0:
+            log_message(log_file, f"No images found in the folder '{original_images_dir}'.")
+            return
+        store = DetectionStore(json_output_dir)
+        skipped = 0
+        if manifest is not None:
+            image_files, skipped = skip_up_to_date(manifest, image_files, original_images_dir, output_dir, store)
+            log_message(log_file, f"Detection manifest: {skipped} images up to date, {len(image_files)} to process.")
+        # Only detect on one of each set of identical images, and copy its results to the others.
+        unique_files, aliases = find_duplicates(image_files)
+        log_message(log_file, format_dedup_stats(image_files, unique_files))
+        skipped += len(image_files) - len(unique_files)
+        image_files = unique_files
+    print(f"PROCESS: {skipped}/{total_images} (skipped {skipped}, processed 0)", flush=True)
+    if not image_files:
+        print("STATUS: DONE", flush=True)
         return
-    print(f"PROCESS: 0/{total_images}")
-
-    mp.freeze_support()
-    manager = mp.Manager()
-    counter = manager.Value('i', 0)
-    lock = manager.Lock()
-
-    args_list = []
-    for img_path in image_files:
-        args_list.append((img_path, output_dir, json_output_dir, original_images_dir, log_file, counter, total_images, lock))
-
-    num_processes = max(1, min(mp.cpu_count() // 2, 12))
-    with mp.Pool(
-        processes=num_processes,
-        initializer=init_process,
-        initargs=(yolo_model_path,),
-    ) as pool:
-        result = pool.map_async(worker_process, args_list)
-        while not result.ready():
-            result.wait(timeout=1)
+
+    num_io_workers = num_io_workers or default_io_workers()
+    num_threads = configure_threads(num_io_workers)
+    log_message(log_file, f"Batched detection with {num_threads} torch threads, {num_io_workers} I/O workers "
+                          f"and batches of {batch_size}.")
+
+    def decode(img_path):
+        with span("decode"):
+            return decode_image(img_path, log_file, reduced_decode)
+
+    def infer(decoded):
+        images = [d[0] if d is not None else None for d in decoded]
+        try:
+            with span("infer", items=len(images)):
+                return predict_batch(yolo_model, images)
+        except Exception as e:
+            log_message(log_file, f"Error processing batch of {len(images)} images: {str(e)}")
+            return [None] * len(images)
+
+    def write(img_path, decoded, prediction):
+        image, scale = decoded if decoded is not None else (None, None)
+        unmarked = image.copy() if on_detected is not None and prediction is not None else None
+        saved = write_detection(image, prediction, img_path, output_dir, json_output_dir, original_images_dir,
+                                log_file, scale, store)
+        if unmarked is not None:
+            detection = store.get(os.path.relpath(img_path, original_images_dir))
+            try:
+                on_detected(img_path, unmarked, scale, detection)
+            except Exception as e:
+                log_message(log_file, f"Error handling the detection of '{img_path}': {str(e)}")
+        with span("write", items=0):
+            if img_path in aliases:
+                try:
+                    copy_detection_outputs(img_path, aliases[img_path], original_images_dir, output_dir, store)
+                except Exception as e:
+                    log_message(log_file, f"Error copying the results of '{img_path}' to its duplicates: {str(e)}")
+            # Only record images whose detection was saved, so that failed ones are retried.
+            if manifest is not None and saved:
+                for path in [img_path] + aliases.get(img_path, []):
+                    manifest.record(os.path.relpath(path, original_images_dir), path)
+
+    def report_progress(processed, total):
+        print(f"PROCESS: {skipped + processed}/{total_images} (skipped {skipped}, processed {processed})", flush=True)
+
+    try:
+        stats = run_pipeline(image_files, decode, infer, write, batch_size, num_decoders=num_io_workers,
+                             num_writers=num_io_workers, progress_callback=report_progress)
+    finally:
+        # Commit what was written, so a cancelled run resumes from here. The
+        # store goes first, as the manifest only records images it holds.
+        store.close()
+        if manifest is not None:
+            manifest.save()
+    log_message(log_file, format_stats(stats))
+    log_message(log_file, format_decode_stats(stats))
 
     print("STATUS: DONE", flush=True)
 
@@ -215,15 +356,27 @@ def signal_handler(signum, frame):
     sys.exit(0)
 
 
-def run(original_images_dir, output_images_dir, json_output_dir, log_dir):
+def run(original_images_dir, output_images_dir, json_output_dir, log_dir, yolo_model=None, reduced_decode=False,
+        engine=None, on_detected=None):
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
     log_file = create_log_file(log_dir)
-    model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "Detector.pt")
+    model_path = MODEL_PATH
 
     start_time = time.time()
-    process_images_with_pool(model_path, original_images_dir, output_images_dir, json_output_dir, log_file)
+    with trace("detection"):
+        engine = resolve_engine(engine)
+        # The ONNX export is cached next to the JSON folder, as the models folder may be read-only.
+        export_dir = default_cache_dir(json_output_dir)
+        if yolo_model is None:
+            yolo_model = load_model(model_path, engine=engine, export_dir=export_dir)
+        # The ONNX export detects slightly differently, so the manifest is tied to the model actually run.
+        manifest_model_path = onnx_path(model_path, export_dir) if engine == "onnx" else model_path
+        log_message(log_file, f"Detection with the {engine} engine.")
+        manifest = DetectionManifest(default_manifest_dir(json_output_dir), [manifest_model_path], reduced_decode)
+        process_images_batched(yolo_model, original_images_dir, output_images_dir, json_output_dir, log_file,
+                               reduced_decode=reduced_decode, manifest=manifest, on_detected=on_detected)
     end_time = time.time()
 
     total_time = end_time - start_time
@@ -1,14 +1,23 @@
 import cv2
-import json
 import os
 import sys
 import time
 import torch
 
 from datetime import datetime
+from detection_manifest import DetectionManifest, default_manifest_dir, skip_up_to_date
+from detection_pipeline import format_decode_stats, format_stats, run_pipeline
+from detection_store import DetectionStore
+from image_decode import read_image_reduced, scale_box
+from image_dedup import copy_detection_outputs, find_duplicates, format_dedup_stats
+from tracing import span, trace
 from ultralytics import YOLO
 from pathlib import Path
 
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "Detector_GPU.pt")
+BATCH_SIZE = 16
+DECODE_MIN_SIDE = 1280    # long side of reduced decodes, twice the YOLO input size
+
 
 def create_log_file(log_dir: str = '') -> str:
     """
@@ -27,124 +36,176 @@ def log_message(log_file, message):
         f.write(f"[{current_time}] {message}\n")
 
 
-def save_detection_results(image_paths, predictions, image_output_path, original_images_dir, json_output_path, log_file):
-    for index, (image_path, result) in enumerate(zip(image_paths, predictions)):
-        try:
-            image_filename = os.path.basename(image_path)
+def decode_image(image_path, log_file, reduced_decode=False):
+    """
+    Decode an image, returning it with the scale from its coordinates to those
+    of the full image, or None if it cannot be read. With reduced_decode, JPEGs
+    are decoded at the smallest DCT scale which keeps DECODE_MIN_SIDE pixels.
+    """
+    if reduced_decode:
+        image, scale = read_image_reduced(image_path, DECODE_MIN_SIDE)
+    else:
+        image, scale = cv2.imread(image_path), (1.0, 1.0)
+    if image is None:
+        log_message(log_file, f"Failed to read image '{image_path}'.")
+        return None
+    return image, scale
 
-            if not os.path.exists(image_path):
-                log_message(log_file, f"The path '{image_path}' does not exist.")
-                return None
 
-            image = cv2.imread(image_path)
-            if image is None:
-                log_message(log_file, f"Failed to read image '{image_path}'.")
-                return None
+def predict_batch(yolo_model, images):
+    """
+    Run YOLO on a batch of decoded images, returning None for the images which
+    could not be decoded. The results are moved to the CPU for the writers.
+    """
+    predictions = [None] * len(images)
+    indices = [i for i, image in enumerate(images) if image is not None]
+    if indices:
+        preds = yolo_model([images[i] for i in indices], verbose = False)
+        for i, pred in zip(indices, preds):
+            predictions[i] = pred.cpu()
+    return predictions
+
+
+def save_empty_detection(image_path, original_images_dir, store, log_file):
+    relative_path = os.path.relpath(image_path, original_images_dir)
+    json_results = {
+        "image": os.path.basename(image_path),
+        "boxes": [{"label": None, "confidence": 0, "bbox": []}]
+    }
+    store.put(relative_path, json_results)
+    log_message(log_file, f"No detections for '{image_path}'. Empty JSON saved to '{store.path}'.")
+
+
+def save_detection_result(image_path, image, result, image_output_path, original_images_dir, store, log_file,
+                          scale=(1.0, 1.0)):
+    """
+    Save the marked image of one decoded image, and its detection into the
+    detection store. For an image decoded at reduced size, scale maps the boxes
+    back to the full image, and the marks are scaled down to match the marked
+    image. Returns whether the result was saved.
+    """
+    draw_scale = 1 / scale[0]
+    try:
+        image_filename = os.path.basename(image_path)
+
+        if result is None:
+            save_empty_detection(image_path, original_images_dir, store, log_file)
+            return False
+
+        image_name = os.path.splitext(os.path.basename(image_path))[0]
+        class_dict = result.names
+        confidences, labels, coordinates = result.boxes.conf.cpu().numpy(), result.boxes.cls.cpu().numpy(), result.boxes.xyxy.cpu().numpy()
+
+
+        json_results = {}
+        json_results["image"] = os.path.basename(image_path)
+        json_results["boxes"] = []
+
+        if image_output_path:
+            relative_path = os.path.relpath(image_path, original_images_dir)
+            output_path = os.path.join(image_output_path, relative_path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        if len(confidences) == 0:
+            log_message(log_file, f"No Detection in image '{image_filename}'.")
+            json_results["boxes"].append({
+                "label": None,
+                "confidence": 0,
+                "bbox": []
+            })
+            image_to_save = image
+            save_message = f"Original image '{image_filename}' has been saved to '{output_path}'."
+
+        else:
+            for i in range(len(confidences)):
+                conf = round(confidences[i], 2)
+                label = class_dict[int(labels[i])]
+                bounding_box = coordinates[i]
+                json_results["boxes"].append({
+                    "label": label,
+                    "confidence": float(conf),
+                    "bbox": [float(coord) for coord in scale_box(bounding_box.tolist(), scale)]
+                })
 
-            image_name = os.path.splitext(os.path.basename(image_path))[0]
-            class_dict = result.names
-            confidences, labels, coordinates = result.boxes.conf.cpu().numpy(), result.boxes.cls.cpu().numpy(), result.boxes.xyxy.cpu().numpy()
+                x1, y1, x2, y2 = list(map(int, bounding_box))
+                cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), max(1, round(15 * draw_scale)))
+                label_text = f"{label} ({conf:.2f})"
+                font = cv2.FONT_HERSHEY_SIMPLEX
+                font_scale = 3.5 * draw_scale
+                thickness = max(1, round(10 * draw_scale))
+                margin = max(1, round(10 * draw_scale))
+                text_size = cv2.getTextSize(label_text, font, font_scale, thickness)[0]
+                text_x = x1
+                text_y = y1 - margin if y1 - text_size[1] - margin >= 0 else y2 + text_size[1] + margin
+                cv2.rectangle(image, (text_x, text_y - text_size[1] - margin),
+                            (text_x + text_size[0], text_y + margin), (0, 0, 255), -1)
+                cv2.putText(image, label_text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
+            image_to_save = image
+            save_message = f"Marked image '{image_filename}' has been saved to '{output_path}'."
+
+        if image_output_path:
+            cv2.imwrite(output_path, image_to_save)
+            log_message(log_file, save_message)
+
+        if json_results:
+            relative_path = os.path.relpath(image_path, original_images_dir)
+
+            detections = json_results['boxes']
+            selected_detection = None
+
+            stoat_detections = [d for d in detections if d['label'] == 'Stoat']
+
+            if stoat_detections:
+                selected_detection = max(stoat_detections, key=lambda x: x['confidence'])
+            else:
+                valid_detections = [d for d in detections if d['label'] is not None]
+                selected_detection = max(valid_detections, key=lambda x: x['confidence']) if valid_detections else {
+                    "label": None,
+                    "confidence": 0,
+                    "bbox": []
+                }
 
+            json_results['boxes'] = [selected_detection]
+            store.put(relative_path, json_results)
 
-            json_results = {}
-            json_results["image"] = os.path.basename(image_path)
-            json_results["boxes"] = []
+            log_message(log_file, f"Cropped info for '{json_results['image']}' has been saved to '{store.path}'.")
 
-            if image_output_path:
-                relative_path = os.path.relpath(image_path, original_images_dir)
-                output_path = os.path.join(image_output_path, relative_path)
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        else:
+            save_empty_detection(image_path, original_images_dir, store, log_file)
+        return True
 
-            if len(confidences) == 0:
-                log_message(log_file, f"No Detection in image '{image_filename}'.")
-                json_results["boxes"].append({
-                    "label": None,
-                    "confidence": 0,
-                    "bbox": []
-                })
-                image_to_save = image
-                save_message = f"Original image '{image_filename}' has been saved to '{output_path}'."
+    except Exception as e:
+        log_message(log_file, f"Error processing image: {str(e)}")
+        return False
 
-            else:
-                for i in range(len(confidences)):
-                    conf = round(confidences[i], 2)
-                    label = class_dict[int(labels[i])]
-                    bounding_box = coordinates[i]
-                    json_results["boxes"].append({
-                        "label": label,
-                        "confidence": float(conf),
-                        "bbox": [float(coord) for coord in bounding_box.tolist()]
-                    })
-
-                    x1, y1, x2, y2 = list(map(int, bounding_box))
-                    cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 15)
-                    label_text = f"{label} ({conf:.2f})"
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_scale = 3.5
-                    thickness = 10
-                    text_size = cv2.getTextSize(label_text, font, font_scale, thickness)[0]
-                    text_x = x1
-                    text_y = y1 - 10 if y1 - text_size[1] - 10 >= 0 else y2 + text_size[1] + 10
-                    cv2.rectangle(image, (text_x, text_y - text_size[1] - 10),
-                                (text_x + text_size[0], text_y + 10), (0, 0, 255), -1)
-                    cv2.putText(image, label_text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
-                image_to_save = image
-                save_message = f"Marked image '{image_filename}' has been saved to '{output_path}'."
-
-            if image_output_path:
-                cv2.imwrite(output_path, image_to_save)
-                log_message(log_file, save_message)
-
-            if json_results:
-                relative_path = os.path.relpath(image_path, original_images_dir)
-                json_filename = os.path.splitext(relative_path)[0] + ".json"
-                fin_json_output_path = os.path.join(json_output_path, json_filename)
-                os.makedirs(os.path.dirname(fin_json_output_path), exist_ok=True)
-
-                detections = json_results['boxes']
-                selected_detection = None
-
-                stoat_detections = [d for d in detections if d['label'] == 'Stoat']
-
-                if stoat_detections:
-                    selected_detection = max(stoat_detections, key=lambda x: x['confidence'])
-                else:
-                    valid_detections = [d for d in detections if d['label'] is not None]
-                    selected_detection = max(valid_detections, key=lambda x: x['confidence']) if valid_detections else {
-                        "label": None,
-                        "confidence": 0,
-                        "bbox": []
-                    }
-
-                json_results['boxes'] = [selected_detection]
-                with open(fin_json_output_path, "w") as f:
-                    json.dump(json_results, f, indent=4)
-
-                log_message(log_file, f"Cropped info for '{json_results['image']}' has been saved to '{fin_json_output_path}'.")
 
-            else:
-                relative_path = os.path.relpath(image_path, original_images_dir)
-                json_filename = os.path.splitext(relative_path)[0] + ".json"
-                fin_json_output_path = os.path.join(json_output_path, json_filename)
-                os.makedirs(os.path.dirname(fin_json_output_path), exist_ok=True)
-                json_results = {
-                    "image": os.path.basename(image_path),
-                    "boxes": [{"label": None, "confidence": 0, "bbox": []}]
-                }
-                with open(fin_json_output_path, "w") as f:
-                    json.dump(json_results, f, indent=4)
-                log_message(log_file, f"No detections for '{image_path}'. Empty JSON saved to '{fin_json_output_path}'.")
+def load_model(model_path=MODEL_PATH, device="cuda"):
+    """
+    Load the YOLO detector.
+    """
+    return YOLO(model_path).to(device)
 
-        except Exception as e:
-            log_message(log_file, f"Error processing image: {str(e)}")
+
+def run(original_images_dir, output_images_dir, json_output_dir, log_dir='', yolo_model=None, reduced_decode=False,
+        on_detected=None):
+    with trace("detection"):
+        process_images(original_images_dir, output_images_dir, json_output_dir, log_dir, yolo_model, reduced_decode,
+                       on_detected)
 
 
-def run(original_images_dir, output_images_dir, json_output_dir, log_dir=''):
-    model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "Detector_GPU.pt")
+def process_images(original_images_dir, output_images_dir, json_output_dir, log_dir='', yolo_model=None,
+                   reduced_decode=False, on_detected=None):
+    """
+    Run detection on every image in original_images_dir. on_detected(path,
+    image, scale, detection) is called from the writer threads for every image
+    detected on, with the image as decoded (before it is marked).
+    """
+    model_path = MODEL_PATH
     log_file = create_log_file(log_dir)
     try:
         DEVICE = "cuda"
-        yolo_model = YOLO(model_path).to(DEVICE)
+        if yolo_model is None:
+            yolo_model = load_model(model_path, DEVICE)
     except Exception as e:
         log_message(log_file, f"Error processing image: {str(e)}")
         raise e
@@ -157,34 +218,93 @@ def run(original_images_dir, output_images_dir, json_output_dir, log_dir=''):
         log_message(log_file, f"The path '{original_images_dir}' does not exist.")
         raise FileNotFoundError(f"The path '{original_images_dir}' does not exist.")
 
-    image_paths_list = []
-    for root, dirs, files in os.walk(original_images_dir):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                image_paths_list.append(os.path.join(root, file))
-
-    num_of_images = len(image_paths_list)
-    print(f"PROCESS: 0/{num_of_images}")
-    if num_of_images == 0:
-        log_message(log_file, f"No images found in the folder '{original_images_dir}'.")
+    with span("scan") as scan:
+        image_paths_list = []
+        for root, dirs, files in os.walk(original_images_dir):
+            for file in files:
+                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    image_paths_list.append(os.path.join(root, file))
+
+        scan["items"] = num_of_images = len(image_paths_list)
+        if num_of_images == 0:
+            print(f"PROCESS: 0/{num_of_images}")
+            log_message(log_file, f"No images found in the folder '{original_images_dir}'.")
+            return
+
+        store = DetectionStore(json_output_dir)
+        manifest = DetectionManifest(default_manifest_dir(json_output_dir), [model_path], reduced_decode)
+        image_paths_list, skipped = skip_up_to_date(manifest, image_paths_list, original_images_dir,
+                                                    output_images_dir, store)
+        log_message(log_file, f"Detection manifest: {skipped} images up to date, {len(image_paths_list)} to process.")
+        # Only detect on one of each set of identical images, and copy its results to the others.
+        unique_paths, aliases = find_duplicates(image_paths_list)
+        log_message(log_file, format_dedup_stats(image_paths_list, unique_paths))
+        skipped += len(image_paths_list) - len(unique_paths)
+        image_paths_list = unique_paths
+    print("STATUS: BEGIN", flush=True)
+    print(f"PROCESS: {skipped}/{num_of_images} (skipped {skipped}, processed 0)", flush=True)
+    if not image_paths_list:
+        print("STATUS: DONE", flush=True)
         return
 
     start_time = time.time()
 
-    counter = 0
-    batch_size = 16
-
-    print("STATUS: BEGIN", flush=True)
-
-    while counter < num_of_images:
-        process_images = image_paths_list[counter:min(counter + batch_size, num_of_images)]
-        preds = yolo_model(process_images, verbose = False)
-        save_detection_results(image_paths = process_images, predictions = preds,
-                               image_output_path = output_images_dir, original_images_dir = original_images_dir,
-                               json_output_path = json_output_dir, log_file = log_file)
+    def decode(image_path):
+        with span("decode"):
+            return decode_image(image_path, log_file, reduced_decode)
 
-        print(f"PROCESS: {min(counter + batch_size, num_of_images)}/{num_of_images}", flush=True)
-        counter += batch_size
+    def infer(decoded):
+        images = [d[0] if d is not None else None for d in decoded]
+        try:
+            with span("infer", items=len(images)):
+                return predict_batch(yolo_model, images)
+        except Exception as e:
+            log_message(log_file, f"Error processing batch of {len(images)} images: {str(e)}")
+            return [None] * len(images)
+
+    def write(image_path, decoded, result):
+        image, scale = decoded if decoded is not None else (None, None)
+        unmarked = image.copy() if on_detected is not None and result is not None else None
+        # Marking the image and saving it and its detection are a single step here.
+        with span("annotate"):
+            saved = save_detection_result(image_path = image_path, image = image, result = result,
+                                          image_output_path = output_images_dir,
+                                          original_images_dir = original_images_dir, store = store,
+                                          log_file = log_file, scale = scale)
+        with span("write", items=0):
+            if image_path in aliases:
+                try:
+                    copy_detection_outputs(image_path, aliases[image_path], original_images_dir, output_images_dir,
+                                           store)
+                except Exception as e:
+                    log_message(log_file, f"Error copying the results of '{image_path}' to its duplicates: {str(e)}")
+            # Only record images whose detection was saved, so that failed ones are retried.
+            if saved:
+                for path in [image_path] + aliases.get(image_path, []):
+                    manifest.record(os.path.relpath(path, original_images_dir), path)
+        if unmarked is not None:
+            detection = store.get(os.path.relpath(image_path, original_images_dir))
+            try:
+                on_detected(image_path, unmarked, scale, detection)
+            except Exception as e:
+                log_message(log_file, f"Error handling the detection of '{image_path}': {str(e)}")
+
+    def report_progress(processed, total):
+        if processed % BATCH_SIZE == 0 or processed == total:
+            print(f"PROCESS: {skipped + processed}/{num_of_images} (skipped {skipped}, processed {processed})",
+                  flush=True)
+
+    num_io_workers = max(1, min(os.cpu_count() or 1, 4))
+    try:
+        stats = run_pipeline(image_paths_list, decode, infer, write, BATCH_SIZE, num_decoders = num_io_workers,
+                             num_writers = num_io_workers, progress_callback = report_progress)
+    finally:
+        # Commit what was written, so a cancelled run resumes from here. The
+        # store goes first, as the manifest only records images it holds.
+        store.close()
+        manifest.save()
+    log_message(log_file, format_stats(stats))
+    log_message(log_file, format_decode_stats(stats))
 
     end_time = time.time()
     total_time = end_time - start_time
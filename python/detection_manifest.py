@@ -0,0 +1,140 @@
+"""
+Manifest of the images already processed by detection.
+
+For every image whose results have been written, the manifest records its
+relative path, size, modification time and content hash, together with the
+hash of the detector model and the decode used. A later run skips the images
+whose entry is still up to date and whose outputs still exist, so re-running
+detection on the same images only processes the new or changed ones.
+
+The manifest is committed to disk every few images and when the run stops,
+including when it is cancelled, so an interrupted run resumes from where it
+left off rather than from scratch.
+"""
+
+import json
+import os
+import threading
+
+from embedding_cache import hash_file, model_fingerprint
+
+
+MANIFEST_FILENAME = "detection_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def default_manifest_dir(json_output_dir):
+    """
+    Place the manifest next to the detection JSON folder, e.g.
+    data/image_cropped_json/1 -> data/image_cropped_json_manifest/1.
+    """
+    json_output_dir = os.path.normpath(json_output_dir)
+    parent_dir, user_dir = os.path.split(json_output_dir)
+    return os.path.join(parent_dir + "_manifest", user_dir)
+
+
+def output_paths(image_path, original_root, output_dir):
+    """
+    The marked image written for an image, if output_dir is set.
+    """
+    if not output_dir:
+        return []
+    return [os.path.join(output_dir, os.path.relpath(image_path, original_root))]
+
+
+def skip_up_to_date(manifest, image_files, original_root, output_dir, store):
+    """
+    Split off the images which are up to date in the manifest and have their
+    results in the detection store. Returns the images left to process and the
+    number skipped.
+    """
+    pending = []
+    for image_path in image_files:
+        relative_path = os.path.relpath(image_path, original_root)
+        outputs = output_paths(image_path, original_root, output_dir)
+        if relative_path not in store or not manifest.is_up_to_date(relative_path, image_path, outputs):
+            pending.append(image_path)
+    return pending, len(image_files) - len(pending)
+
+
+class DetectionManifest:
+    """
+    Processed images of one detection output folder, keyed by their path
+    relative to the input folder. Safe to update from several writer threads.
+    """
+
+    def __init__(self, manifest_dir, model_files, reduced_decode=False, commit_every=16):
+        self.manifest_path = os.path.join(manifest_dir, MANIFEST_FILENAME)
+        self.reduced_decode = reduced_decode
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        os.makedirs(manifest_dir, exist_ok=True)
+
+        self.manifest = self._load()
+        self.model_hash, self.model_files = model_fingerprint(model_files, self.manifest.get("model_files", {}))
+        if (self.manifest.get("version") != MANIFEST_VERSION
+                or self.manifest.get("model_hash") != self.model_hash):
+            self.manifest = {"version": MANIFEST_VERSION, "model_hash": self.model_hash, "entries": {}}
+        self.entries = self.manifest["entries"]
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_up_to_date(self, relative_path, image_path, outputs):
+        """
+        Whether the image was processed with the same model and decode, and is
+        unchanged since. A changed modification time alone (e.g. the image was
+        copied again) falls back to comparing the content hash.
+        """
+        entry = self.entries.get(relative_path)
+        if entry is None or entry["reduced_decode"] != self.reduced_decode:
+            return False
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        stat = os.stat(image_path)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if hash_file(image_path) != entry["hash"]:
+            return False
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def record(self, relative_path, image_path):
+        """
+        Record that the results of an image have been written, committing the
+        manifest every commit_every images.
+        """
+        stat = os.stat(image_path)
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": hash_file(image_path),
+            "reduced_decode": self.reduced_decode,
+        }
+        with self.lock:
+            self.entries[relative_path] = entry
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.manifest["model_files"] = self.model_files
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.uncommitted = 0
+
+    def __len__(self):
+        return len(self.entries)
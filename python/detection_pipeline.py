@@ -0,0 +1,200 @@
+"""
+Pipelined detection.
+
+Detection alternates between disk I/O (decoding the original images, writing
+the marked images and the JSON) and inference. Run one after the other, the
+model sits idle during the I/O and the disk during inference. run_pipeline
+overlaps them in three stages:
+
+    decoder -> [decoded batches] -> inference -> [predictions] -> writers
+
+The decoder prefetches batches with a pool of decode threads, inference runs on
+the calling thread, and a pool of writer threads saves the results. The stages
+are joined by bounded queues, so memory stays bounded and throughput is set by
+the slowest stage alone. OpenCV and torch release the GIL for the heavy work,
+so threads are enough.
+
+Each image is decoded exactly once: the decoded array is fed to YOLO and reused
+by the writer for the marked image, rather than YOLO and the writer each
+reading the file. The stats count the decodes, and format_decode_stats
+estimates the decode time this saves.
+
+The stats also give each stage's occupancy (the fraction of the wall time
+its threads were busy) and the mean fill of each queue. The bottleneck is the
+stage which is nearly always busy, with a full queue before it and an empty one
+after it.
+"""
+
+import queue
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+_DONE = object()    # end of stream marker
+
+
+def _put(q, item, stop):
+    """
+    Put an item on a bounded queue, giving up if the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    """
+    Get an item from a queue, returning _DONE if the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_pipeline(image_paths, decode, infer, write, batch_size, num_decoders=1, num_writers=1, queue_size=2,
+                 progress_callback=None):
+    """
+    Run detection on image_paths, batch_size images at a time.
+
+    decode(path) returns the decoded image, or None if it cannot be read.
+    infer(images) returns one prediction per image of a batch.
+    write(path, image, prediction) saves the results of one image.
+    progress_callback(processed, total) is called after every write.
+
+    Up to queue_size decoded batches wait for inference, and up to
+    queue_size * batch_size predictions wait for the writers. An exception in
+    any stage stops the pipeline and is raised here.
+    """
+    decoded = queue.Queue(maxsize=queue_size)
+    predicted = queue.Queue(maxsize=queue_size * batch_size)
+    stop = threading.Event()
+    lock = threading.Lock()
+    errors = []
+    busy = {"decode": 0.0, "infer": 0.0, "write": 0.0}
+    fill = {"decoded": [], "predicted": []}
+    decode_counts = Counter()
+    processed = 0
+
+    def add_busy(stage, seconds):
+        with lock:
+            busy[stage] += seconds
+
+    def timed_decode(path):
+        start = time.perf_counter()
+        try:
+            return decode(path)
+        finally:
+            add_busy("decode", time.perf_counter() - start)
+            with lock:
+                decode_counts[path] += 1
+
+    def decoder():
+        try:
+            with ThreadPoolExecutor(max_workers=num_decoders) as decode_pool:
+                for start in range(0, len(image_paths), batch_size):
+                    batch = image_paths[start:start + batch_size]
+                    if not _put(decoded, (batch, list(decode_pool.map(timed_decode, batch))), stop):
+                        return
+            _put(decoded, _DONE, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def writer():
+        nonlocal processed
+        try:
+            while True:
+                item = _get(predicted, stop)
+                if item is _DONE:
+                    return
+                start = time.perf_counter()
+                write(*item)
+                add_busy("write", time.perf_counter() - start)
+                with lock:
+                    processed += 1
+                    if progress_callback:
+                        progress_callback(processed, len(image_paths))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=decoder, daemon=True)]
+    threads += [threading.Thread(target=writer, daemon=True) for _ in range(num_writers)]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            fill["decoded"].append(decoded.qsize())
+            item = _get(decoded, stop)
+            if item is _DONE:
+                break
+            batch, images = item
+
+            start = time.perf_counter()
+            predictions = infer(images)
+            busy["infer"] += time.perf_counter() - start
+
+            for path, image, prediction in zip(batch, images, predictions):
+                if not _put(predicted, (path, image, prediction), stop):
+                    break
+            fill["predicted"].append(predicted.qsize())
+
+        for _ in range(num_writers):
+            _put(predicted, _DONE, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+    wall = max(time.perf_counter() - wall_start, 1e-9)
+    return {
+        "seconds": wall,
+        "decode_busy": busy["decode"] / (wall * num_decoders),
+        "infer_busy": busy["infer"] / wall,
+        "write_busy": busy["write"] / (wall * num_writers),
+        "decoded_queue_fill": _mean(fill["decoded"]) / queue_size,
+        "predicted_queue_fill": _mean(fill["predicted"]) / (queue_size * batch_size),
+        "images_decoded": len(decode_counts),
+        "decodes": sum(decode_counts.values()),
+        "decode_seconds": busy["decode"],
+    }
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def format_stats(stats):
+    return (f"Pipeline occupancy: decode {stats['decode_busy']:.0%}, inference {stats['infer_busy']:.0%}, "
+            f"write {stats['write_busy']:.0%}; queue fill: decoded {stats['decoded_queue_fill']:.0%}, "
+            f"predicted {stats['predicted_queue_fill']:.0%}.")
+
+
+def format_decode_stats(stats, previous_decodes_per_image=2):
+    """
+    Describe the decodes of a run, and the decode time saved compared with
+    decoding every image previous_decodes_per_image times, as detection did
+    when YOLO and the annotation each read the file.
+    """
+    images = max(stats["images_decoded"], 1)
+    decode_time = stats["decode_seconds"] / max(stats["decodes"], 1)
+    saved = (previous_decodes_per_image * images - stats["decodes"]) * decode_time
+    return (f"Decoded {stats['images_decoded']} images {stats['decodes'] / images:.2f} times each "
+            f"({stats['decode_seconds']:.2f} seconds); decoding each {previous_decodes_per_image} times "
+            f"would have taken {saved:.2f} seconds more.")
@@ -0,0 +1,171 @@
+"""
+Consolidated store of detection results.
+
+Rather than one pretty-printed JSON file per image, detection appends the
+results of each image to a single JSON lines file in the JSON output folder:
+
+    data/image_cropped_json/1/detections.jsonl
+
+One line per image, {"path": <relative path>, "image": ..., "boxes": [...]},
+where image and boxes are as in the per-image JSON files. The file is append
+only: writers buffer records and append them in batches, and when an image is
+processed again the later line wins. Readers load the whole file in one pass
+into an index by path. The file is compacted (rewritten with only the latest
+line of each image) when most of its lines are stale.
+
+ReID and the app fall back to the per-image JSON files for images which are
+not in the store, so folders processed before the store existed keep working.
+To produce the per-image layout from a store, e.g. for external tools, run:
+
+    python detection_store.py export <json_dir> [<output_dir>]
+"""
+
+import json
+import os
+import sys
+import threading
+
+
+STORE_FILENAME = "detections.jsonl"
+
+
+def store_key(relative_path):
+    """
+    Paths are stored with forward slashes, whatever the platform.
+    """
+    return relative_path.replace(os.sep, "/")
+
+
+def legacy_json_path(json_dir, relative_path):
+    return os.path.join(json_dir, os.path.splitext(relative_path)[0] + ".json")
+
+
+class DetectionStore:
+    """
+    The detection results of one JSON output folder, indexed by the path of
+    each image relative to the input folder. Safe to write from several
+    threads.
+    """
+
+    def __init__(self, json_dir, flush_every=64):
+        self.json_dir = json_dir
+        self.path = os.path.join(json_dir, STORE_FILENAME)
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = []
+        self.records = dict()
+        self.lines = 0
+        self.needs_newline = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self.needs_newline = not line.endswith("\n")
+                    self.lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # a line cut short by a crash
+                    self.records[record.pop("path")] = record
+        except FileNotFoundError:
+            pass
+
+    def get(self, relative_path):
+        """
+        The {"image", "boxes"} results of an image, or None.
+        """
+        return self.records.get(store_key(relative_path))
+
+    def __contains__(self, relative_path):
+        return store_key(relative_path) in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def put(self, relative_path, result):
+        """
+        Add or replace the results of an image. Appended to the file in batches.
+        """
+        key = store_key(relative_path)
+        with self.lock:
+            self.records[key] = result
+            self.pending.append(json.dumps({"path": key, **result}))
+            if len(self.pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        os.makedirs(self.json_dir, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            if self.needs_newline:
+                f.write("\n")
+                self.needs_newline = False
+            f.write("\n".join(self.pending) + "\n")
+        self.lines += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        """
+        Append the remaining records, and compact the file if most of its lines
+        are stale.
+        """
+        with self.lock:
+            self._flush()
+            if self.lines > 2 * len(self.records):
+                self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, record in self.records.items():
+                f.write(json.dumps({"path": key, **record}) + "\n")
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.records)
+
+
+def read_detection(store, json_dir, relative_path):
+    """
+    The results of an image from the store, or else from its per-image JSON
+    file, or None if it has neither.
+    """
+    result = store.get(relative_path) if store is not None else None
+    if result is None:
+        json_path = legacy_json_path(json_dir, relative_path)
+        if os.path.exists(json_path):
+            with open(json_path, "r") as f:
+                result = json.load(f)
+    return result
+
+
+def export_legacy(json_dir, output_dir=None):
+    """
+    Write the per-image JSON files of every image in the store of json_dir into
+    output_dir (by default json_dir itself). Returns the number written.
+    """
+    store = DetectionStore(json_dir)
+    output_dir = output_dir or json_dir
+    for key, result in store.records.items():
+        json_path = legacy_json_path(output_dir, key.replace("/", os.sep))
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        with open(json_path, "w") as f:
+            json.dump(result, f, indent=4)
+    return len(store)
+
+
+def main():
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != "export":
+        print("Usage: python detection_store.py export <json_dir> [<output_dir>]")
+        sys.exit(1)
+    count = export_legacy(*sys.argv[2:])
+    print(f"Exported the detections of {count} images.")
+
+
+if __name__ == "__main__":
+    main()
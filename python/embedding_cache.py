@@ -0,0 +1,209 @@
+"""
+Persistent on-disk cache of ReID embeddings.
+
+Embeddings are stored in a single memory-mapped .npy array, one row per cached
+crop, alongside a JSON index mapping each crop key to its row. A crop key is the
+hash of the original image content plus the bounding box of the crop, so the
+same detection is only ever embedded once, whatever the file is called.
+
+The whole cache is tied to a fingerprint of the model files (the traced model
+and its cfg); when any of them changes the cache is discarded and rebuilt.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+INDEX_FILENAME = "index.json"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+CACHE_VERSION = 2    # 2: crops are taken from the original image rather than a saved JPEG
+
+
+def default_cache_dir(reid_output_dir):
+    """
+    Place the cache next to the ReID output folder, e.g.
+    data/image_reid_output/1 -> data/image_reid_output_cache/1.
+    """
+    reid_output_dir = os.path.normpath(reid_output_dir)
+    parent_dir, user_dir = os.path.split(reid_output_dir)
+    return os.path.join(parent_dir + "_cache", user_dir)
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hash of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_files, known_hashes=None):
+    """
+    Hash the model files together. The previous hash of a file (from
+    known_hashes) is reused if its size and modification time are unchanged,
+    as the traced model is large. Returns the combined hash and the per-file
+    records to pass back in as known_hashes next time.
+    """
+    known_hashes = known_hashes or {}
+    model_hashes = {}
+    for file_path in model_files:
+        stat = os.stat(file_path)
+        known = known_hashes.get(file_path)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            file_hash = known["hash"]
+        else:
+            file_hash = hash_file(file_path)
+        model_hashes[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash}
+    combined = "".join(model_hashes[file_path]["hash"] for file_path in model_files)
+    return hashlib.sha256(combined.encode()).hexdigest(), model_hashes
+
+
+class EmbeddingCache:
+    """
+    Embedding store keyed by crop content, bounded by a size budget.
+
+    Entries are evicted least-recently-used first once the store would exceed
+    max_bytes. Recency is tracked per run (a generation counter) rather than per
+    lookup, which keeps the index small.
+    """
+
+    def __init__(self, cache_dir, model_files, dim=512, dtype="float32", max_bytes=512 << 20):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.max_entries = max(1, max_bytes // (dim * self.dtype.itemsize))
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self.embeddings_path = os.path.join(cache_dir, EMBEDDINGS_FILENAME)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.index = self._load_index()
+        self.model_hash, self.model_files = model_fingerprint(model_files, self.index.get("model_files", {}))
+        if (self.index.get("version") != CACHE_VERSION
+                or self.index.get("model_hash") != self.model_hash
+                or self.index.get("dim") != dim
+                or self.index.get("dtype") != self.dtype.name
+                or not os.path.exists(self.embeddings_path)):
+            self._reset()
+        else:
+            self.embeddings = np.load(self.embeddings_path, mmap_mode="r+")
+            if len(self.embeddings) > self.max_entries:    # the size budget was lowered
+                self.embeddings = None
+                self._reset()
+        self.index["generation"] += 1
+        self.generation = self.index["generation"]
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _reset(self):
+        self.index = {
+            "version": CACHE_VERSION,
+            "model_hash": self.model_hash,
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "generation": 0,
+            "entries": {},
+            "free_slots": [],
+        }
+        self.embeddings = None
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        """
+        (Re)create the embeddings file with the given number of rows, keeping the
+        existing rows.
+        """
+        tmp_path = self.embeddings_path + ".tmp"
+        resized = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(capacity, self.dim))
+        if self.embeddings is not None:
+            rows = min(capacity, len(self.embeddings))
+            resized[:rows] = self.embeddings[:rows]
+        resized.flush()
+        # Memory maps must be closed before the file can be replaced on Windows.
+        del resized
+        self.embeddings = None
+        os.replace(tmp_path, self.embeddings_path)
+        self.embeddings = np.load(self.embeddings_path, mmap_mode="r+")
+
+    @staticmethod
+    def key(image_hash, bbox):
+        """
+        Build the key of a crop from the hash of its image and its bounding box.
+        """
+        x1, y1, x2, y2 = bbox
+        return hashlib.sha256(f"{image_hash}:{x1},{y1},{x2},{y2}".encode()).hexdigest()
+
+    def lookup(self, keys):
+        """
+        Return an (N, dim) float32 array holding the cached embedding of every
+        key, and the indices of the keys which are not in the cache.
+        """
+        entries = self.index["entries"]
+        embeddings = np.zeros((len(keys), self.dim), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            entry = entries.get(key)
+            if entry is None:
+                missing.append(i)
+                continue
+            embeddings[i] = self.embeddings[entry[0]]
+            entry[1] = self.generation
+        return embeddings, missing
+
+    def insert(self, keys, embeddings):
+        """
+        Store the embeddings of the given keys, evicting the least recently used
+        entries to stay within the size budget. Returns the embeddings as they
+        were stored, so callers see the same values as future lookups.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        entries = self.index["entries"]
+        free_slots = self.index["free_slots"]
+
+        new_keys = [key for key in dict.fromkeys(keys) if key not in entries][:self.max_entries]
+        overflow = len(entries) + len(new_keys) - self.max_entries
+        if overflow > 0:
+            by_age = sorted(entries, key=lambda k: entries[k][1])
+            for key in by_age[:overflow]:
+                free_slots.append(entries.pop(key)[0])
+
+        next_slot = len(entries) + len(free_slots)
+        required = next_slot + max(0, len(new_keys) - len(free_slots))
+        if required > len(self.embeddings):
+            self._allocate(min(self.max_entries, max(required, 2 * len(self.embeddings))))
+        for key in new_keys:
+            if free_slots:
+                slot = free_slots.pop()
+            else:
+                slot = next_slot
+                next_slot += 1
+            entries[key] = [slot, self.generation]
+
+        for key, embedding in zip(keys, embeddings):
+            if key in entries:
+                self.embeddings[entries[key][0]] = embedding
+        return embeddings.astype(self.dtype).astype(np.float32)
+
+    def save(self):
+        """
+        Flush the embeddings and atomically rewrite the index.
+        """
+        self.embeddings.flush()
+        self.index["model_files"] = self.model_files
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.index["entries"])
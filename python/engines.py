@@ -0,0 +1,177 @@
+"""
+Inference engines for the detector and the ReID model on CPU.
+
+The "torch" engine runs Detector.pt through ultralytics and CARE_Traced.pt
+through TorchScript, as before. The "onnx" engine exports both models to ONNX
+once, into a cache folder next to the outputs (the models folder is read-only
+once the app is installed), and runs them with onnxruntime's CPU execution
+provider. Both engines present the same
+interface to the rest of the code:
+
+    - the detector is a YOLO object: detector(images) returns ultralytics Results,
+      as ultralytics runs .onnx weights through onnxruntime itself;
+    - the ReID model is a callable: model(batch) returns the features of a
+      [B, 3, H, W] tensor as a tensor.
+
+The engine is chosen at runtime, with the engine argument of detection, the
+TEST.ENGINE cfg key of ReID, or else the CARE_ENGINE environment variable.
+onnxruntime is optional and only imported when the onnx engine is used;
+exporting also needs the onnx package (see requirements-onnx.txt). An export is
+redone whenever the model it was made from changes.
+
+Export both models ahead of time into a folder with:
+
+    python engines.py <export_dir>
+"""
+
+import importlib.util
+import json
+import os
+import sys
+
+import torch
+
+from embedding_cache import model_fingerprint
+
+
+ENGINES = ("torch", "onnx")
+ONNX_OPSET = 17
+
+_loaded = dict()    # onnxruntime sessions of this process, by path and source hash
+
+
+def resolve_engine(engine=None):
+    """
+    The engine to use: engine if given, else $CARE_ENGINE, else torch.
+    """
+    engine = engine or os.environ.get("CARE_ENGINE") or "torch"
+    if engine not in ENGINES:
+        raise ValueError(f"Invalid inference engine '{engine}', expected one of {ENGINES}")
+    if engine == "onnx" and importlib.util.find_spec("onnxruntime") is None:
+        raise ImportError("The onnx inference engine needs onnxruntime: pip install onnxruntime")
+    return engine
+
+
+def onnx_path(model_path, export_dir):
+    """
+    The ONNX export of model_path in export_dir, e.g. models/Detector.pt ->
+    <export_dir>/Detector.onnx.
+    """
+    return os.path.join(export_dir, os.path.splitext(os.path.basename(model_path))[0] + ".onnx")
+
+
+def _export_if_stale(model_path, export_dir, export):
+    """
+    Export model_path to ONNX in export_dir with export(model_path, path),
+    unless the export there was made from the same model. Returns the ONNX
+    path and the hash of the model it was made from.
+    """
+    path = onnx_path(model_path, export_dir)
+    info_path = path + ".json"
+    try:
+        with open(info_path, "r") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        info = {}
+    source_hash, source_files = model_fingerprint([model_path], info.get("source_files"))
+    if info.get("source_hash") != source_hash or not os.path.exists(path):
+        os.makedirs(export_dir, exist_ok=True)
+        export(model_path, path)
+        with open(info_path, "w") as f:
+            json.dump({"source_hash": source_hash, "source_files": source_files}, f)
+    return path, source_hash
+
+
+def export_detector(model_path, path):
+    """
+    Export a YOLO detector to ONNX, with dynamic batch and image sizes.
+    """
+    from ultralytics import YOLO
+
+    exported = YOLO(model_path).export(format="onnx", dynamic=True, simplify=False, opset=ONNX_OPSET,
+                                       verbose=False)
+    if os.path.abspath(exported) != os.path.abspath(path):
+        os.replace(exported, path)
+
+
+def export_reid(model_path, path, input_size=(256, 128)):
+    """
+    Export the traced ReID model to ONNX, with a dynamic batch size.
+    """
+    model = torch.jit.load(model_path, map_location="cpu")
+    model.eval()
+    tmp_path = path + ".tmp"
+    torch.onnx.export(model, torch.randn(1, 3, *input_size), tmp_path,
+                      input_names=["images"], output_names=["features"],
+                      dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+                      opset_version=ONNX_OPSET, dynamo=False)
+    os.replace(tmp_path, path)
+
+
+def load_onnx_detector(model_path, export_dir):
+    """
+    Load the ONNX export of a YOLO detector from export_dir, exporting it first
+    if needed. Returns the YOLO object and the path of the ONNX model.
+    """
+    from ultralytics import YOLO
+
+    path, _ = _export_if_stale(model_path, export_dir, export_detector)
+    return YOLO(path, task="detect"), path
+
+
+class OnnxEmbedder:
+    """
+    The ReID model run by onnxruntime, called like the traced model.
+    """
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        features = self.session.run(None, {self.input_name: batch.cpu().numpy()})[0]
+        return torch.from_numpy(features)
+
+
+def load_onnx_reid(model_path, export_dir, input_size=(256, 128)):
+    """
+    Load the ONNX export of the traced ReID model from export_dir, exporting it
+    first if needed.
+    """
+    path, source_hash = _export_if_stale(model_path, export_dir, lambda src, dst: export_reid(src, dst, input_size))
+    if (path, source_hash) not in _loaded:
+        _loaded[(path, source_hash)] = OnnxEmbedder(path, num_threads=torch.get_num_threads())
+    return _loaded[(path, source_hash)]
+
+
+def export_models(export_dir):
+    """
+    Export the detector and the ReID model to export_dir, unless they are up
+    to date there.
+    """
+    import detection_cpu
+    import reid_cpu
+
+    reid_cpu.load_cfg(reid_cpu.CFG_FILE_PATH)
+    for model_path, export in [
+        (detection_cpu.MODEL_PATH, export_detector),
+        (reid_cpu.MODEL_PATH, lambda src, dst: export_reid(src, dst, tuple(reid_cpu.cfg.INPUT.SIZE_TEST))),
+    ]:
+        path, _ = _export_if_stale(model_path, export_dir, export)
+        print(f"ONNX export of {model_path}: {path}")
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python engines.py <export_dir>", flush=True)
+        sys.exit(1)
+    export_models(sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Scale-aware image decoding.
+
+Camera trap images are often 12-20 MP, while YOLO runs at 640 px and the ReID
+model only takes a 256x128 crop. JPEGs can be decoded straight to 1/2, 1/4 or
+1/8 scale in the DCT domain (cv2.IMREAD_REDUCED_*, PIL's draft), which is
+several times faster than a full decode and needs a fraction of the memory.
+These helpers pick the largest reduction which still leaves the consumer enough
+pixels, and map coordinates between the reduced and the full image exactly.
+Other formats are always decoded at full size.
+"""
+
+import cv2
+
+from PIL import Image
+
+
+REDUCTION_FACTORS = (8, 4, 2, 1)
+CV2_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+EXIF_ORIENTATION = 274
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def is_jpeg(image_path):
+    return image_path.lower().endswith(('.jpg', '.jpeg'))
+
+
+def reduction_factor(size, min_size):
+    """
+    Largest reduction factor which keeps every dimension of size at least as
+    large as min_size. A JPEG decoded at 1/f scale is ceil(size / f) pixels.
+    """
+    for factor in REDUCTION_FACTORS:
+        if all(-(-s // factor) >= m for s, m in zip(size, min_size)):
+            return factor
+    return 1
+
+
+def oriented_size(image_path):
+    """
+    Read the (width, height) of an image from its header, as cv2.imread returns
+    it, i.e. after applying the EXIF orientation.
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+        if img.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+    return width, height
+
+
+def read_image_reduced(image_path, min_side):
+    """
+    Decode an image as BGR for detection, as small as possible while keeping
+    its long side at least min_side. Returns the image and the (x, y) scale
+    from its pixel coordinates to those of the full image, or (None, None) if
+    it cannot be read.
+    """
+    if is_jpeg(image_path):
+        try:
+            width, height = oriented_size(image_path)
+        except OSError:
+            width, height = 0, 0
+        factor = reduction_factor((max(width, height),), (min_side,))
+        if factor > 1:
+            image = cv2.imread(image_path, CV2_REDUCED_FLAGS[factor])
+            if image is not None:
+                return image, (width / image.shape[1], height / image.shape[0])
+
+    image = cv2.imread(image_path)
+    if image is None:
+        return None, None
+    return image, (1.0, 1.0)
+
+
+def scale_box(bbox, scale):
+    """
+    Map an (x1, y1, x2, y2) box from reduced to full image coordinates.
+    """
+    sx, sy = scale
+    x1, y1, x2, y2 = bbox
+    return [x1 * sx, y1 * sy, x2 * sx, y2 * sy]
+
+
+def read_crops_reduced(image_path, bboxes, size):
+    """
+    Decode an RGB image just large enough for its crops and return every box
+    (in full image coordinates) cropped and resized to size = (width, height).
+    The image is decoded once, at the largest reduction which leaves the
+    smallest crop at least size; crops are then resampled straight from the
+    exact, fractional position of the box in the reduced image.
+    """
+    with Image.open(image_path) as img:
+        full_width, full_height = img.size
+        factor = 1
+        if is_jpeg(image_path) and bboxes:
+            factor = min(reduction_factor((x2 - x1, y2 - y1), size) for x1, y1, x2, y2 in bboxes)
+        if factor == 1:
+            img = img.convert("RGB")
+            return [img.crop(bbox).resize(size, Image.BILINEAR) for bbox in bboxes]
+
+        img.draft("RGB", (full_width // factor, full_height // factor))
+        img = img.convert("RGB")
+
+    sx, sy = full_width / img.width, full_height / img.height
+    crops = []
+    for x1, y1, x2, y2 in bboxes:
+        box = (max(0, x1 / sx), max(0, y1 / sy), min(img.width, x2 / sx), min(img.height, y2 / sy))
+        crops.append(img.resize(size, Image.BILINEAR, box=box))
+    return crops
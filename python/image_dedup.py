@@ -0,0 +1,91 @@
+"""
+Content-hash deduplication of input images.
+
+The same SD card is often uploaded more than once, so identical images arrive
+under different names. find_duplicates groups the images by content in three
+passes, each only looking at the candidates left by the one before:
+
+    file size -> hash of the first and last PARTIAL_HASH_BYTES -> full hash
+
+Most images have a unique size and are never read. Detection and ReID then only
+process the first image of each group (its canonical image) and copy the results
+to the others (its aliases). In ReID this also keeps identical crops out of the
+clustering, which assumes the only exact match of a crop is itself.
+"""
+
+import hashlib
+import os
+import shutil
+
+from embedding_cache import hash_file
+
+
+PARTIAL_HASH_BYTES = 64 << 10
+
+
+def partial_hash(file_path, chunk_size=PARTIAL_HASH_BYTES):
+    """
+    Hash the first and last chunk_size bytes of a file.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        sha.update(f.read(chunk_size))
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            sha.update(f.read(chunk_size))
+    return sha.hexdigest()
+
+
+def _split_by(groups, key):
+    """
+    Split every group of paths by key(path), dropping the singletons.
+    """
+    split = []
+    for group in groups:
+        buckets = dict()
+        for path in group:
+            buckets.setdefault(key(path), []).append(path)
+        split.extend(bucket for bucket in buckets.values() if len(bucket) > 1)
+    return split
+
+
+def find_duplicates(image_paths):
+    """
+    Group image_paths by content. Returns the unique images, in the order of
+    image_paths, and a dict from each unique image with duplicates to the list
+    of its duplicates (aliases).
+    """
+    groups = _split_by([image_paths], os.path.getsize)
+    groups = _split_by(groups, partial_hash)
+    groups = _split_by(groups, hash_file)
+
+    aliases = {group[0]: group[1:] for group in groups}
+    duplicates = {alias for group in groups for alias in group[1:]}
+    unique_paths = [path for path in image_paths if path not in duplicates]
+    return unique_paths, aliases
+
+
+def format_dedup_stats(image_paths, unique_paths):
+    duplicates = len(image_paths) - len(unique_paths)
+    return f"Deduplication: {len(unique_paths)} unique images, {duplicates} duplicates skipped."
+
+
+def copy_detection_outputs(image_path, alias_paths, original_root, output_dir, store):
+    """
+    Copy the detection (in the detection store) and the marked image of
+    image_path to each of its aliases, naming the alias in its detection.
+    """
+    relative_path = os.path.relpath(image_path, original_root)
+    detection = store.get(relative_path)
+
+    for alias_path in alias_paths:
+        alias_relative_path = os.path.relpath(alias_path, original_root)
+        store.put(alias_relative_path, dict(detection, image=os.path.basename(alias_path)))
+
+        marked_path = os.path.join(output_dir, relative_path) if output_dir else None
+        if marked_path and os.path.exists(marked_path):
+            alias_marked_path = os.path.join(output_dir, alias_relative_path)
+            os.makedirs(os.path.dirname(alias_marked_path), exist_ok=True)
+            shutil.copyfile(marked_path, alias_marked_path)
@@ -0,0 +1,78 @@
+"""
+Import time profile of the tasks of main.py.
+
+Cold start is dominated by importing torch and the libraries around it, before
+a single image is read. To see where the time goes, run:
+
+    python main.py --import-profile detection
+
+which imports what the task needs, as main.py would, without running it, and
+reports the time spent importing each module: cumulative (with the modules it
+imports) and self (without them). It works like `python -X importtime`, but
+also in the PyInstaller build, where interpreter options cannot be passed.
+Modules imported before profiling started (e.g. by the interpreter) are not
+counted.
+"""
+
+import builtins
+import importlib.util
+import sys
+import time
+
+
+class ImportProfiler:
+    """
+    Times every first import of a module while active, by wrapping
+    builtins.__import__.
+    """
+
+    def __init__(self):
+        self.records = []    # (name, self seconds, cumulative seconds, depth), in the order imported
+        self.children = []    # cumulative seconds of the imports nested in each import in progress
+
+    def __enter__(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._import
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self.original_import
+        self.seconds = time.perf_counter() - self.start
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        try:
+            package = (globals or {}).get("__package__") or ""
+            module_name = importlib.util.resolve_name("." * level + name, package) if level else name
+        except (ImportError, ValueError):
+            module_name = None
+        if not module_name or module_name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        self.children.append(0.0)
+        start = time.perf_counter()
+        imported = False
+        try:
+            module = self.original_import(name, globals, locals, fromlist, level)
+            imported = True
+            return module
+        finally:
+            cumulative = time.perf_counter() - start
+            children = self.children.pop()
+            if self.children:
+                self.children[-1] += cumulative
+            if imported:
+                self.records.append((module_name, cumulative - children, cumulative, len(self.children)))
+
+    def report(self, title, top=25):
+        """
+        Print the top-level imports and the slowest modules by self time.
+        """
+        print(f"{title}: {self.seconds:.2f} s, {len(self.records)} modules imported.")
+        print(f"\n{'cumulative ms':>14} {'self ms':>9}  top-level imports")
+        for name, self_time, cumulative, depth in self.records:
+            if depth == 0:
+                print(f"{cumulative * 1000:>14.1f} {self_time * 1000:>9.1f}  {name}")
+        print(f"\n{'cumulative ms':>14} {'self ms':>9}  slowest {top} modules by self time")
+        for name, self_time, cumulative, _ in sorted(self.records, key=lambda r: -r[1])[:top]:
+            print(f"{cumulative * 1000:>14.1f} {self_time * 1000:>9.1f}  {name}")
@@ -29,16 +29,95 @@ Test with:
         /tmp/care/reid_image_output \
         /tmp/care/reid_json_output \
         /tmp/care/logs
+
+To run both in a single pass over the images, embedding the crops during
+detection (see detect_reid.py):
+
+    python main.py detect-reid \
+        /Users/cpearce/Downloads/Test-Data \
+        /tmp/care/detection_images \
+        /tmp/care/detection_json \
+        /tmp/care/reid_image_output \
+        /tmp/care/reid_json_output \
+        /tmp/care/logs
+
+To keep the models loaded between jobs, run a long-lived worker which reads
+jobs as JSON lines on stdin (see serve.py):
+
+    python main.py serve
+
+ReID cfg keys (see config/defaults.py) can be overridden by appending KEY VALUE
+pairs, e.g. `TEST.INCREMENTAL True`.
+
+On CPU, set CARE_ENGINE=onnx to run both models with onnxruntime instead of
+torch (see engines.py).
+
+Only the modules of the requested task and device are imported, once the task
+is known. To see how long the imports of a task take (see import_profile.py):
+
+    python main.py --import-profile reid
 """
 
 import multiprocessing
 import sys
-import torch
 
-import detection_cpu
-import detection_gpu
-import reid_cpu
-import reid_gpu
+# The modules running each task on GPU and on CPU, and their function. They are
+# only imported once the task is known, as importing them all would pull in
+# ultralytics, cv2, torchvision and yacs whatever the task, in every process.
+TASKS = {
+    "detection": ("detection_gpu", "detection_cpu", "run"),
+    "reid": ("reid_gpu", "reid_cpu", "run"),
+    "detect-reid": ("detect_reid", "detect_reid", "run"),
+    "serve": ("serve", "serve", "serve"),
+}
+TASK_ARGS = {
+    "detection": [
+        "original_images_dir",
+        "output_images_dir",
+        "json_output_dir",
+        "log_dir",
+    ],
+    "reid": [
+        "image_dir",
+        "json_dir",
+        "output_dir",
+        "reid_output_dir",
+        "log_dir",
+    ],
+    "detect-reid": [
+        "original_images_dir",
+        "output_images_dir",
+        "json_output_dir",
+        "output_dir",
+        "reid_output_dir",
+        "log_dir",
+    ],
+    "serve": [],
+}
+
+
+def load_task(task):
+    """
+    Import the module of task for this device, returning its run function and
+    the device.
+    """
+    import torch
+
+    use_gpu = torch.cuda.is_available()
+    print(f"torch.cuda.is_available(): {use_gpu}")
+    gpu_module, cpu_module, run = TASKS[task]
+    module_name = gpu_module if use_gpu else cpu_module
+    # A plain import statement, so that it is seen by the import profile.
+    __import__(module_name)
+    return getattr(sys.modules[module_name], run), "cuda" if use_gpu else "cpu"
+
+
+def profile_imports(task):
+    from import_profile import ImportProfiler
+
+    with ImportProfiler() as profiler:
+        _, device = load_task(task)
+    profiler.report(f"Imports of the {task} task on {device}")
 
 
 def main():
@@ -48,40 +127,27 @@ def main():
     if len(sys.argv) == 1:
         print("No task specified.")
         sys.exit(1)
-    task = sys.argv[1]
-    print(f"torch.cuda.is_available(): {torch.cuda.is_available()}")
-    match (task):
-        case "reid":
-            args = [
-                "image_dir",
-                "json_dir",
-                "output_dir",
-                "reid_output_dir",
-                "log_dir",
-            ]
-            if torch.cuda.is_available():
-                run = reid_gpu.run
-            else:
-                run = reid_cpu.run
-        case "detection":
-            args = [
-                "original_images_dir",
-                "output_images_dir",
-                "json_output_dir",
-                "log_dir",
-            ]
-            if torch.cuda.is_available():
-                run = detection_gpu.run
-            else:
-                run = detection_cpu.run
-        case _:
-            print(f"Invalid option {task}")
+    if sys.argv[1] == "--import-profile":
+        if len(sys.argv) != 3 or sys.argv[2] not in TASKS:
+            print(f"Usage: main.py --import-profile <task>, where task is one of {list(TASKS)}")
             sys.exit(1)
-    if len(sys.argv) != len(args) + 2:
+        profile_imports(sys.argv[2])
+        return
+    task = sys.argv[1]
+    if task not in TASKS:
+        print(f"Invalid option {task}")
+        sys.exit(1)
+    args = TASK_ARGS[task]
+    # ReID accepts trailing cfg overrides as KEY VALUE pairs, e.g. TEST.INCREMENTAL True.
+    opts = sys.argv[2 + len(args):]
+    if len(sys.argv) < len(args) + 2 or (opts and (task not in ("reid", "detect-reid") or len(opts) % 2 != 0)):
         print(f"Invalid arguments for task {task} expected {args}")
         print(f"sys.argv={sys.argv}")
         sys.exit(1)
+    run, _ = load_task(task)
     kwargs = {k : sys.argv[2 + i] for (i, k) in enumerate(args)}
+    if opts:
+        kwargs["opts"] = opts
     run(**kwargs)
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+"""
+Nearest-neighbour search over ReID embeddings.
+
+Instead of a dense N x N distance matrix, the ReID stage only needs the
+candidate matches of every crop. stream_candidates finds them exactly, streaming
+over blocks of rows of the distance matrix. Alternatively, two backends find the
+k nearest neighbours of every crop, as a pair of (N, k) arrays of neighbour
+indices and cosine distances, sorted nearest first:
+
+- "exact": brute force, one block of queries at a time, so peak memory is
+  O(block_size * N) rather than O(N^2).
+- "ivf": an inverted file index (spherical k-means coarse quantizer) in pure
+  NumPy. Each query is only compared with the members of the n_probe lists
+  whose centroids are nearest, trading a little recall for speed on large
+  galleries.
+"""
+
+import numpy as np
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def _sorted_topk(dist, ids, k):
+    """
+    Keep the k smallest distances of every row, sorted by distance and then by
+    index, so ties resolve like np.argmin.
+    """
+    if dist.shape[1] > k:
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        dist = np.take_along_axis(dist, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.lexsort((ids, dist), axis=1)
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(dist, order, axis=1)
+
+
+def _drop_self(indices, distances):
+    """
+    Drop the nearest neighbour of every row, which is the query itself when the
+    queries are also the gallery.
+    """
+    return indices[:, 1:], distances[:, 1:]
+
+
+def exact_search(embeddings, k, queries=None, exclude_self=True, block_size=1024):
+    """
+    Find the k nearest neighbours of each query by brute force, one block of
+    queries at a time. Queries default to the embeddings themselves.
+    """
+    gallery = normalize(embeddings)
+    queries = gallery if queries is None else normalize(queries)
+    k_search = min(k + int(exclude_self), len(gallery))
+
+    indices = np.empty((len(queries), k_search), dtype=np.int64)
+    distances = np.empty((len(queries), k_search), dtype=np.float32)
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size]
+        dist = 1 - block @ gallery.T    # ([B, N])
+        ids = np.broadcast_to(np.arange(len(gallery)), dist.shape)
+        indices[start:start + len(block)], distances[start:start + len(block)] = _sorted_topk(dist, ids, k_search)
+
+    if exclude_self:
+        return _drop_self(indices, distances)
+    return indices, distances
+
+
+def stream_candidates(embeddings, window, block_size=1024, spill_path=None):
+    """
+    Find the candidate matches of every embedding without keeping the distance
+    matrix: the rows are computed one block at a time, with the nearest match of
+    each row (the query itself) masked, and only the indices within window of
+    each row's minimum are kept. Peak memory is O(block_size * N).
+
+    If spill_path is given, the full masked distance matrix is also written to
+    a memory-mapped .npy file there, for auditing.
+    """
+    gallery = normalize(embeddings)
+    n = len(gallery)
+    spill = None
+    if spill_path:
+        spill = np.lib.format.open_memmap(spill_path, mode="w+", dtype=np.float32, shape=(n, n))
+
+    candidates_per_row = []
+    for start in range(0, n, block_size):
+        dist = 1 - gallery[start:start + block_size] @ gallery.T    # ([B, N])
+        rows = np.arange(len(dist))
+        dist[rows, np.argmin(dist, axis=1)] = np.max(dist, axis=1) + 1
+        if spill is not None:
+            spill[start:start + len(dist)] = dist
+
+        min_dist = np.min(dist, axis=1, keepdims=True)
+        candidate_rows, candidate_cols = np.nonzero(np.abs(dist - min_dist) <= window)
+        bounds = np.searchsorted(candidate_rows, np.arange(len(dist) + 1))
+        candidates_per_row.extend(np.split(candidate_cols, bounds[1:-1]))
+
+    if spill is not None:
+        spill.flush()
+        del spill
+    return candidates_per_row
+
+
+class IVFIndex:
+    """
+    Inverted file index over normalized embeddings.
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def build(self, embeddings, block_size=4096):
+        """
+        Train the coarse quantizer with spherical k-means on a sample of the
+        embeddings, then assign every embedding to its nearest list.
+        """
+        self.gallery = normalize(embeddings)
+        n = len(self.gallery)
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(self.seed)
+
+        sample = self.gallery[rng.choice(n, size=min(n, 256 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = self._nearest_centroid(sample, centroids, block_size)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=n_lists)
+            filled = counts > 0
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = centroids.copy()    # keep the previous centroid of empty lists
+            sums[filled] = np.add.reduceat(sample[order], offsets[filled], axis=0)
+            centroids = normalize(sums)
+        self.centroids = centroids
+
+        assignment = self._nearest_centroid(self.gallery, centroids, block_size)
+        self.list_order = np.argsort(assignment, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return self
+
+    @staticmethod
+    def _nearest_centroid(vectors, centroids, block_size):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            assignment[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+        return assignment
+
+    def search(self, k, queries=None, exclude_self=True):
+        """
+        Find the approximate k nearest neighbours of each query. The work is
+        done list by list: every list is compared in one product with all the
+        queries that probe it, and merged into their running top-k.
+        """
+        queries = self.gallery if queries is None else normalize(queries)
+        k_search = min(k + int(exclude_self), len(self.gallery))
+        n_probe = min(self.n_probe, len(self.centroids))
+
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        probe_queries = np.repeat(np.arange(len(queries)), n_probe)
+        probe_lists = probes.ravel()
+        by_list = np.argsort(probe_lists, kind="stable")
+        probe_queries, probe_lists = probe_queries[by_list], probe_lists[by_list]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(probe_lists, minlength=len(self.centroids)))])
+
+        best_ids = np.full((len(queries), k_search), -1, dtype=np.int64)
+        best_dist = np.full((len(queries), k_search), np.inf, dtype=np.float32)
+        for list_id in range(len(self.centroids)):
+            query_ids = probe_queries[bounds[list_id]:bounds[list_id + 1]]
+            members = self.list_order[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+            if len(query_ids) == 0 or len(members) == 0:
+                continue
+            dist = 1 - queries[query_ids] @ self.gallery[members].T
+            merged_dist = np.concatenate([best_dist[query_ids], dist], axis=1)
+            merged_ids = np.concatenate([best_ids[query_ids], np.broadcast_to(members, dist.shape)], axis=1)
+            best_ids[query_ids], best_dist[query_ids] = _sorted_topk(merged_dist, merged_ids, k_search)
+
+        if exclude_self:
+            return _drop_self(best_ids, best_dist)
+        return best_ids, best_dist
+
+
+def search_neighbors(embeddings, k, backend="exact", n_probe=8, block_size=1024):
+    """
+    Find the k nearest neighbours of every embedding among the others, with the
+    given backend. Returns (indices, distances), both (N, min(k, N - 1)).
+    """
+    if backend == "exact":
+        return exact_search(embeddings, k, block_size=block_size)
+    if backend == "ivf":
+        return IVFIndex(n_probe=n_probe).build(embeddings).search(k)
+    raise ValueError(f"Unknown neighbour search backend '{backend}'.")
@@ -0,0 +1,153 @@
+"""
+Persistent gallery of known individuals for incremental ReID.
+
+The gallery keeps up to max_exemplars embeddings per individual, together with
+the individual's ID. New crops are matched against it, so a returning animal
+keeps its ID across runs; only the crops which match no known individual are
+clustered into new individuals, which get the next free IDs.
+
+Like the embedding cache, the gallery is tied to the model fingerprint and to
+the embedding variant (the decode and the form of the model, see
+reid_cpu.embedding_variant), as embeddings from different models or engines are
+not comparable.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from neighbors import exact_search
+
+
+META_FILENAME = "gallery.json"
+EXEMPLARS_FILENAME = "exemplars.npz"
+GALLERY_VERSION = 1
+
+
+def default_gallery_dir(reid_output_dir):
+    """
+    Place the gallery next to the ReID output folder, e.g.
+    data/image_reid_output/1 -> data/image_reid_output_gallery/1.
+    """
+    reid_output_dir = os.path.normpath(reid_output_dir)
+    parent_dir, user_dir = os.path.split(reid_output_dir)
+    return os.path.join(parent_dir + "_gallery", user_dir)
+
+
+class Gallery:
+    """
+    Exemplar embeddings of every known individual.
+    """
+
+    def __init__(self, gallery_dir, model_hash, max_exemplars=32, variant=""):
+        self.gallery_dir = gallery_dir
+        self.model_hash = model_hash
+        self.variant = variant
+        self.max_exemplars = max_exemplars
+        self.meta_path = os.path.join(gallery_dir, META_FILENAME)
+        self.exemplars_path = os.path.join(gallery_dir, EXEMPLARS_FILENAME)
+        os.makedirs(gallery_dir, exist_ok=True)
+
+        self.meta = self._load_meta()
+        if (self.meta.get("version") != GALLERY_VERSION
+                or self.meta.get("model_hash") != model_hash
+                or self.meta.get("variant", "") != variant
+                or not os.path.exists(self.exemplars_path)):
+            self.meta = {"version": GALLERY_VERSION, "model_hash": model_hash, "variant": variant,
+                         "next_id": 0}
+            self.exemplars = np.zeros((0, 0), dtype=np.float32)
+            self.labels = np.zeros(0, dtype=np.int64)
+        else:
+            with np.load(self.exemplars_path) as data:
+                self.exemplars = data["exemplars"]
+                self.labels = data["labels"]
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def new_id(self):
+        new_id = self.meta["next_id"]
+        self.meta["next_id"] += 1
+        return new_id
+
+    def match(self, embeddings, max_dist, block_size=1024):
+        """
+        Find the known individual of every embedding: that of its nearest
+        exemplar, if within max_dist. Several embeddings may match the same
+        individual, e.g. a burst of photos of one animal. The exemplars are
+        searched one block of embeddings at a time, so memory stays
+        O(block_size * exemplars). Returns the matched IDs, with -1 for
+        unmatched embeddings.
+        """
+        labels = np.full(len(embeddings), -1, dtype=np.int64)
+        if len(self.labels) == 0 or len(embeddings) == 0:
+            return labels
+
+        nearest, nearest_dist = exact_search(self.exemplars, 1, queries=embeddings,
+                                             exclude_self=False, block_size=block_size)
+        nearest, nearest_dist = nearest[:, 0], nearest_dist[:, 0]
+        matched = nearest_dist <= max_dist
+        labels[matched] = self.labels[nearest[matched]]
+        return labels
+
+    def assign(self, embeddings, max_dist, cluster):
+        """
+        Assign every embedding to a known or new individual. cluster is called on
+        the embeddings which match no known individual, and their indices, and
+        must return a dict of group to indices, like process_dist_mat_v2.
+        Returns a dict of individual ID to the indices of its embeddings.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        labels = self.match(embeddings, max_dist)
+
+        unmatched = np.where(labels == -1)[0]
+        if len(unmatched):
+            for group in cluster(embeddings[unmatched], unmatched).values():
+                labels[unmatched[group]] = self.new_id()
+
+        self.add(embeddings, labels)
+
+        output_dict = dict()
+        for label in np.unique(labels):
+            output_dict[int(label)] = list(np.where(labels == label)[0])
+        return output_dict
+
+    def add(self, embeddings, labels):
+        """
+        Add the embeddings as exemplars of their individuals, keeping only the
+        most recent max_exemplars of each.
+        """
+        if len(self.labels) == 0:
+            exemplars, all_labels = embeddings, labels
+        else:
+            exemplars = np.concatenate([self.exemplars, embeddings])
+            all_labels = np.concatenate([self.labels, labels])
+
+        # Count each individual's exemplars from the most recent one backwards.
+        keep = np.ones(len(all_labels), dtype=bool)
+        counts = dict()
+        for i in range(len(all_labels) - 1, -1, -1):
+            label = all_labels[i]
+            counts[label] = counts.get(label, 0) + 1
+            keep[i] = counts[label] <= self.max_exemplars
+        self.exemplars = exemplars[keep]
+        self.labels = all_labels[keep]
+
+    def save(self):
+        """
+        Atomically write the exemplars and the gallery metadata.
+        """
+        tmp_path = self.exemplars_path + ".tmp.npz"
+        np.savez(tmp_path, exemplars=self.exemplars, labels=self.labels)
+        os.replace(tmp_path, self.exemplars_path)
+
+        self.meta["individuals"] = len(np.unique(self.labels))
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=4)
+        os.replace(tmp_path, self.meta_path)
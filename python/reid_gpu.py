@@ -1,17 +1,30 @@
-import glob
+import itertools
 import json
 import numpy as np
 import os
 import shutil
 import sys
 import torch
-import torch.nn.functional as F
-import torchvision.transforms as T
 
+from blocking import Blocks, format_blocking_stats, stream_blocked_candidates
+from clustering import CANDIDATE_WINDOW, count_truncated_rows, group_candidates, process_neighbor_lists
 from config import cfg
+from crop_shards import CropShards, default_shard_dir
 from datetime import datetime
+from detection_store import DetectionStore, read_detection
+from embedding_cache import EmbeddingCache, default_cache_dir, hash_file, model_fingerprint
+from image_decode import read_crops_reduced
+from image_dedup import find_duplicates, format_dedup_stats
+from neighbors import search_neighbors, stream_candidates
 from PIL import Image
 from pathlib import Path
+from reid_gallery import Gallery, default_gallery_dir
+from reranking import k_reciprocal_rerank
+from tracing import span, trace, traced_iter
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "CARE_Traced_GPUv.pt")
+CFG_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "vit_care.yml")
+DEFAULT_CFG = cfg.clone()    # the cfg defaults, before any cfg file is merged in
 
 def create_log_file(log_dir: str = '') -> str:
     """
@@ -30,11 +43,36 @@ def log_message(log_file, message):
         f.write(f"[{current_time}] {message}\n")
 
 
-def load_and_preprocess_image(file_path):
+def load_cfg(cfg_file_path, opts=None):
+    """
+    Reset the cfg to its defaults, then read the cfg file and the overrides, so
+    that each run in a long-lived process starts from the same cfg.
+    """
+    cfg.defrost()
+    # Restore the defaults wholesale: merge_from_other_cfg would re-decode string
+    # values such as MODEL.DEVICE_ID '0' and reject them.
+    cfg.clear()
+    cfg.update(DEFAULT_CFG.clone())
+    cfg.merge_from_file(cfg_file_path)
+    cfg.merge_from_list(opts or [])
+    cfg.freeze()
+
+
+def load_model(model_path=MODEL_PATH, device="cuda"):
+    """
+    Load the traced reid model.
+    """
+    model = torch.jit.load(model_path)
+    model = model.to(device)
+    model.eval()    # set the model in evaluation mode
+    return model
+
+
+def preprocess_image(img):
     """
-    Load and preprocess image with the configrations.
+    Preprocess an RGB image with the configrations.
     """
-    img = Image.open(file_path).convert("RGB")
+    import torchvision.transforms as T    # on first use, as it takes seconds to import
 
     image_transforms = T.Compose([
         T.Resize(cfg.INPUT.SIZE_TEST),
@@ -47,25 +85,132 @@ def load_and_preprocess_image(file_path):
     return image
 
 
-def compute_distances(model, query_image, gallery_images, is_duplicate, device):
+def resize_crop(img):
     """
-    Compute the distances between the query image and the gallery images.
+    Resize an RGB crop to the model input size, as preprocess_image does,
+    returning its uint8 pixels for the crop shards.
     """
-    list_of_dist = []
-    query_embedding = model(query_image.to(device))[2]    # forward pass to get the embedding of the query image
+    import torchvision.transforms as T
 
-    # Calculate the similarity and distance.
-    for index in range(len(gallery_images)):
-        gallery_embedding = model(gallery_images[index].to(device))[2]
-        similarity = F.cosine_similarity(query_embedding, gallery_embedding)
-        dist = 1 - similarity
-        list_of_dist.append(dist.cpu().detach().numpy()[0])
+    return np.array(T.Resize(cfg.INPUT.SIZE_TEST)(img))    # ([256, 128, 3])
 
-    list_of_dist = np.array(list_of_dist)
 
-    if is_duplicate:
-        list_of_dist[np.argmin(list_of_dist)] = list_of_dist[np.argmax(list_of_dist)] + 1
-    return list_of_dist
+def normalize_crop(pixels):
+    """
+    Turn the uint8 pixels of a resized crop into the model input, giving the
+    same tensor as preprocess_image on the crop (T.ToTensor and T.Normalize
+    written out, so that reading crops back does not import torchvision).
+    """
+    image = torch.from_numpy(pixels).permute(2, 0, 1).contiguous().float().div(255)
+    mean = torch.as_tensor(cfg.INPUT.PIXEL_MEAN, dtype = image.dtype)
+    std = torch.as_tensor(cfg.INPUT.PIXEL_STD, dtype = image.dtype)
+    image = image.sub(mean[:, None, None]).div(std[:, None, None])
+    return image.unsqueeze(0)    # ([1, 3, 256, 128])
+
+
+def compute_embeddings(model, images, device, batch_size=1, progress_callback=None, total=None):
+    """
+    Compute the [CLS] embedding of every image, stacking the images into
+    mini-batches of batch_size. The batch is halved if it runs out of memory.
+    images can be any iterable of preprocessed images, e.g. a generator, in
+    which case only the current batch is held in memory and total gives the
+    number of images for the progress.
+    """
+    total = len(images) if total is None else total
+    images = iter(images)
+    pending = []
+    embeddings = []
+    start = 0
+    with torch.inference_mode():
+        while True:
+            pending.extend(itertools.islice(images, max(0, batch_size - len(pending))))
+            if not pending:
+                break
+            batch = torch.cat(pending[:batch_size])    # ([B, 3, 256, 128])
+            try:
+                with span("embed", items = len(batch)):
+                    embedding = model(batch.to(device))[2]    # forward pass to get the embeddings of the batch ([B, 512])
+            except torch.cuda.OutOfMemoryError:
+                if batch_size == 1:
+                    raise
+                batch_size = batch_size // 2
+                torch.cuda.empty_cache()
+                continue
+            embeddings.append(embedding.cpu())
+            del pending[:len(batch)]
+            start += len(batch)
+            if progress_callback:
+                progress_callback(start, total)
+    return torch.cat(embeddings)    # ([N, 512])
+
+
+def embedding_variant(model_variant=""):
+    """
+    The suffix of the image hashes in the embedding cache keys, naming the
+    decode and the model variant, as reduced decodes give slightly different
+    embeddings.
+    """
+    return (":reduced" if cfg.TEST.REDUCED_DECODE else "") + (":" + model_variant if model_variant else "")
+
+
+def embed_crops(model, cropped_image_paths, crop_sources, cache, device, log_file, progress_callback=None,
+                model_variant="", shards=None, detected_variant=None):
+    """
+    Compute the embedding of every cropped image, only running the model on the
+    crops which are not already in the embedding cache. model_variant names the
+    form of the model in use, if not the traced model itself.
+    The crops to embed are read from shards, the crop shards, if given. With
+    detected_variant, the crops which detect-reid embedded under that variant
+    are looked up first.
+    """
+    if cache is None:
+        cropped_images = iter_crop_tensors(cropped_image_paths, crop_sources, shards)
+        return compute_embeddings(model = model, images = cropped_images, device = device,
+                                  batch_size = cfg.TEST.IMS_PER_BATCH, progress_callback = progress_callback,
+                                  total = len(cropped_image_paths))
+
+    # Key each crop by the content of its original image and its bbox, and by
+    # the decode and the model variant (see embedding_variant).
+    variant = embedding_variant(model_variant)
+    detected = embedding_variant(detected_variant) if detected_variant else None
+    image_hashes = dict()
+    keys = []
+    detected_keys = []
+    for img_path in cropped_image_paths:
+        image_path, bbox = crop_sources[img_path]
+        if image_path not in image_hashes:
+            image_hashes[image_path] = hash_file(image_path)
+        keys.append(cache.key(image_hashes[image_path] + variant, bbox))
+        if detected is not None:
+            detected_keys.append(cache.key(image_hashes[image_path] + detected, bbox))
+
+    if detected is not None:
+        # Only the crops cut from detection's decode are under the detect-reid
+        # variant; the others are decoded here and cached under the usual keys.
+        embeddings, missing = cache.lookup(detected_keys)
+        found, still_missing = cache.lookup([keys[i] for i in missing])
+        embeddings[missing] = found
+        missing = [missing[i] for i in still_missing]
+    else:
+        embeddings, missing = cache.lookup(keys)
+    num_cached = len(keys) - len(missing)
+    log_message(log_file, f"Embedding cache: {num_cached} cached, {len(missing)} to compute.")
+
+    if missing:
+        def report_progress(done, total):
+            if progress_callback:
+                progress_callback(num_cached + done, len(keys))
+
+        cropped_images = iter_crop_tensors([cropped_image_paths[i] for i in missing], crop_sources, shards,
+                                           image_hashes)
+        new_embeddings = compute_embeddings(model = model, images = cropped_images, device = device,
+                                            batch_size = cfg.TEST.IMS_PER_BATCH, progress_callback = report_progress,
+                                            total = len(missing))
+        embeddings[missing] = cache.insert([keys[i] for i in missing], new_embeddings.numpy())
+    elif progress_callback:
+        progress_callback(len(keys), len(keys))
+    cache.save()
+    return torch.from_numpy(embeddings)
 
 
 def process_dist_mat(dist_mat):
@@ -94,46 +239,69 @@ def process_dist_mat(dist_mat):
     return output_dict
 
 
-def process_dist_mat_v2(dist_mat):
+def cluster_embeddings(embeddings, log_file, blocks=None):
     """
-    Process the distance matrix to count the number of individuals.
+    Group the embeddings into individuals from their candidate matches, only
+    looking for them within the allowed blocks if blocks are given (see
+    blocking).
     """
-    number_of_images = len(dist_mat)
-    keys = np.array([-1] * number_of_images)
-
-    for r in range(len(dist_mat)):
-        row = dist_mat[r]
-        min_dist = np.min(row)
-        candidates_bool = np.abs(row - min_dist) <= 0.05
-        candidates_index = np.where(candidates_bool)[0]
-        candidates_key = keys[candidates_index]
-        current_counter = np.max(keys)
-
-        if keys[r] != -1:
-            keys[candidates_index] = keys[r]
-
-        elif keys[r] == -1 and np.all(candidates_key == -1):
-            keys[r] = current_counter + 1
-            keys[candidates_index] = current_counter + 1
-
-        elif keys[r] == -1 and np.any(candidates_key != -1):
-            min_pos_key = np.min(candidates_key[candidates_key != -1])
-            selected_indices = candidates_index[np.where(candidates_key != min_pos_key)[0]]
-            keys[r] = min_pos_key
-            keys[selected_indices] = min_pos_key
-
-    aid = 0
-    output_dict = dict()
-    min_key, max_key = np.min(keys), np.max(keys)
-    for k in range(min_key, max_key + 1):
-        if k in keys:
-            if aid not in output_dict:
-                output_dict[aid] = list(np.where(keys == k)[0])
-                aid += 1
-    return output_dict
-
-
-def format_output_dict(image_paths, output_dict, rel_parent_path):
+    if blocks is not None:
+        with span("distance", items = len(embeddings)):
+            candidates, compared = stream_blocked_candidates(embeddings, blocks,
+                                                             window = CANDIDATE_WINDOW,
+                                                             block_size = cfg.TEST.DIST_BLOCK_SIZE)
+        log_message(log_file, format_blocking_stats(blocks, compared))
+        if cfg.TEST.RE_RANKING:
+            log_message(log_file, "TEST.RE_RANKING is not applied with TEST.BLOCKING_KEYS.")
+        with span("cluster", items = len(embeddings)):
+            return group_candidates(candidates)
+
+    backend = cfg.TEST.NEIGHBOR_BACKEND
+    if backend == "auto":
+        backend = "ivf" if len(embeddings) >= cfg.TEST.ANN_MIN_SIZE else "blocked"
+    if cfg.TEST.RE_RANKING and backend == "blocked":
+        backend = "exact"    # re-ranking works on neighbour lists
+
+    if backend == "blocked":
+        spill_path = None
+        if cfg.TEST.SAVE_DIST_MAT:
+            spill_path = os.path.splitext(log_file)[0] + "_" + cfg.TEST.DIST_MAT
+            log_message(log_file, f"Saving the distance matrix to {spill_path}")
+        with span("distance", items = len(embeddings)):
+            candidates = stream_candidates(embeddings,
+                                           window = CANDIDATE_WINDOW,
+                                           block_size = cfg.TEST.DIST_BLOCK_SIZE,
+                                           spill_path = spill_path)
+        with span("cluster", items = len(embeddings)):
+            return group_candidates(candidates)
+
+    k = max(cfg.TEST.NEIGHBOR_K, cfg.TEST.RE_RANKING_K1) if cfg.TEST.RE_RANKING else cfg.TEST.NEIGHBOR_K
+    with span("distance", items = len(embeddings)):
+        indices, distances = search_neighbors(embeddings,
+                                              k = k,
+                                              backend = backend,
+                                              n_probe = cfg.TEST.ANN_N_PROBE,
+                                              block_size = cfg.TEST.DIST_BLOCK_SIZE)
+    if cfg.TEST.RE_RANKING:
+        with span("rerank", items = len(embeddings)):
+            indices, distances = k_reciprocal_rerank(embeddings, indices, distances,
+                                                     k1 = cfg.TEST.RE_RANKING_K1,
+                                                     k2 = cfg.TEST.RE_RANKING_K2,
+                                                     lambda_value = cfg.TEST.RE_RANKING_LAMBDA)
+    if distances.shape[1] < len(embeddings) - 1:
+        truncated = count_truncated_rows(distances)
+        if truncated:
+            log_message(log_file, f"{truncated} crops may have more candidate matches than the {k} neighbours searched.")
+    with span("cluster", items = len(embeddings)):
+        return process_neighbor_lists(indices, distances)
+
+
+def format_output_dict(image_paths, output_dict, rel_parent_path, crop_aliases=None):
+    """
+    Name the individuals and list their crops relative to rel_parent_path,
+    each crop followed by the crops of its duplicate images, if any.
+    """
+    crop_aliases = crop_aliases or dict()
     image_names = []
     output_dict_with_rel_paths = dict()
     for img_path in image_paths:
@@ -145,8 +313,8 @@ def format_output_dict(image_paths, output_dict, rel_parent_path):
         list_of_img_paths = []
         for img_idx in list_of_imgs:
             img_full_path = image_paths[img_idx]
-            img_relative_path = os.path.relpath(img_full_path, rel_parent_path)
-            list_of_img_paths.append(img_relative_path)
+            for crop_path in [img_full_path] + crop_aliases.get(img_full_path, []):
+                list_of_img_paths.append(os.path.relpath(crop_path, rel_parent_path))
         if id not in output_dict_with_rel_paths:
             output_dict_with_rel_paths[id] = list_of_img_paths
     return output_dict_with_rel_paths
@@ -172,29 +340,39 @@ def show_results(q_img_paths, reid_dict, reid_output_dir, log_file):
     output_parent_path = os.path.join(reid_output_dir, formatted_date)
     os.makedirs(output_parent_path, exist_ok=True)
 
-    json_output_path = os.path.join(output_parent_path, formatted_time + '.json')
-    with open(json_output_path, 'w') as json_file:
+    # Create the file exclusively, adding a counter to the name if it is taken,
+    # so that jobs finishing in the same second do not overwrite each other.
+    suffix = 0
+    while True:
+        name = formatted_time + (f"_{suffix}" if suffix else "")
+        json_output_path = os.path.join(output_parent_path, name + '.json')
+        try:
+            json_file = open(json_output_path, 'x')
+            break
+        except FileExistsError:
+            suffix += 1
+    with json_file:
         json.dump(reid_dict, json_file, indent=4)
 
     log_message(log_file, f"Re-identification results saved to JSON file: {json_output_path}")
 
 
-def crop_image_from_json(image_path, json_path, output_dir, original_root, log_file):
-    with open(json_path, "r") as f:
-        crop_info = json.load(f)
+def crop_boxes_from_detection(image_path, crop_info, output_dir, original_root, log_file):
+    """
+    Read the detected boxes of an image from its detection results. Returns
+    the (path, bbox) of every crop, where the path names the crop as if it was
+    saved into output_dir.
+    """
+    crops = []
 
     if 'boxes' not in crop_info or not crop_info['boxes']:
         log_message(log_file, f"No animal detected in image: {image_path}, skipping.")
-        return
+        return crops
 
-    img = Image.open(image_path).convert("RGB")
     relative_path = os.path.relpath(image_path, original_root)
     relative_dir = os.path.dirname(relative_path)
     output_dir_with_subfolders = os.path.join(output_dir, relative_dir)
 
-    if not os.path.exists(output_dir_with_subfolders):
-        os.makedirs(output_dir_with_subfolders)
-
     base_name = os.path.splitext(os.path.basename(image_path))[0]
 
     for i, bbox_info in enumerate(crop_info['boxes']):
@@ -205,7 +383,6 @@ def crop_image_from_json(image_path, json_path, output_dir, original_root, log_f
             continue
 
         x1, y1, x2, y2 = map(int, bbox)
-        cropped_img = img.crop((x1, y1, x2, y2))
 
         if len(crop_info['boxes']) > 1:
             cropped_img_filename = f"{base_name}_{i}.jpg"
@@ -213,23 +390,118 @@ def crop_image_from_json(image_path, json_path, output_dir, original_root, log_f
             cropped_img_filename = f"{base_name}.jpg"
 
         cropped_img_path = os.path.join(output_dir_with_subfolders, cropped_img_filename)
-        cropped_img.save(cropped_img_path)
-        log_message(log_file, f"Saved cropped image: {cropped_img_path}")
+        crops.append((cropped_img_path, (x1, y1, x2, y2)))
+    return crops
 
 
-def process_images_in_folder(image_dir, json_dir, output_dir, log_file):
+def process_images_in_folder(image_dir, json_dir, output_dir, log_file, dedup=False):
+    """
+    Find the crops of every image with detection results, in the detection
+    store of json_dir or else in a per-image JSON file (see detection_store). Returns a dict mapping
+    each crop's path to the (image path, bbox) it is cropped from, and a dict
+    mapping crop paths to the matching crops of their duplicate images. With
+    dedup, only the first of a set of identical images (see image_dedup) has
+    its crops returned, and the others become its duplicates.
+    """
+    image_paths = []
     for root, _, files in os.walk(image_dir):
         for file in files:
             if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                image_path = os.path.join(root, file)
-                relative_path = os.path.relpath(image_path, image_dir)
-                json_path = os.path.join(json_dir, relative_path)
-                json_path = os.path.splitext(json_path)[0] + '.json'
+                image_paths.append(os.path.join(root, file))
+
+    image_aliases = dict()
+    if dedup:
+        unique_paths, image_aliases = find_duplicates(image_paths)
+        log_message(log_file, format_dedup_stats(image_paths, unique_paths))
+        image_paths = unique_paths
+
+    store = DetectionStore(json_dir)
+    crop_sources = dict()
+    crop_aliases = dict()
+    for image_path in image_paths:
+        relative_path = os.path.relpath(image_path, image_dir)
+        crop_info = read_detection(store, json_dir, relative_path)
+
+        if crop_info is not None:
+            crops = crop_boxes_from_detection(image_path, crop_info, output_dir, image_dir, log_file)
+            for cropped_img_path, bbox in crops:
+                crop_sources[cropped_img_path] = (image_path, bbox)
+            # Duplicates share the boxes of the image, under their own names.
+            for alias_path in image_aliases.get(image_path, []):
+                alias_crops = crop_boxes_from_detection(alias_path, crop_info, output_dir, image_dir, log_file)
+                for (cropped_img_path, _), (alias_crop_path, _) in zip(crops, alias_crops):
+                    crop_aliases.setdefault(cropped_img_path, []).append(alias_crop_path)
+        else:
+            log_message(log_file, f"No detection results found for image: {os.path.basename(image_path)}")
+    return crop_sources, crop_aliases
+
 
-                if os.path.exists(json_path):
-                    crop_image_from_json(image_path, json_path, output_dir, image_dir, log_file)
-                else:
-                    log_message(log_file, f"JSON file not found for image: {file}")
+def iter_crop_images(cropped_image_paths, crop_sources, reduced_decode=False):
+    """
+    Crop the given crops out of their original images, in memory. Consecutive
+    crops of the same image share a single decode. With reduced_decode, the
+    image is decoded at reduced size (see image_decode) and the crops come out
+    already resized to the model input size.
+    """
+    for image_path, group in itertools.groupby(cropped_image_paths, key=lambda path: crop_sources[path][0]):
+        bboxes = [crop_sources[cropped_img_path][1] for cropped_img_path in group]
+        if reduced_decode:
+            height, width = cfg.INPUT.SIZE_TEST
+            yield from read_crops_reduced(image_path, bboxes, (width, height))
+        else:
+            img = Image.open(image_path).convert("RGB")
+            for bbox in bboxes:
+                yield img.crop(bbox)
+
+
+def iter_crop_tensors(cropped_image_paths, crop_sources, shards=None, image_hashes=None):
+    """
+    Yield the preprocessed crops, ready for the model, without writing them to
+    disk. With crop shards, the crops in them are read back rather than
+    decoded, and the others are added to them; image_hashes can give the
+    hashes of the original images, if already computed.
+    """
+    if shards is not None:
+        yield from traced_iter("crop", iter_sharded_crops(cropped_image_paths, crop_sources, shards, image_hashes))
+        return
+    cropped_images = iter_crop_images(cropped_image_paths, crop_sources, cfg.TEST.REDUCED_DECODE)
+    yield from traced_iter("crop", (preprocess_image(cropped_img) for cropped_img in cropped_images))
+
+
+def iter_sharded_crops(cropped_image_paths, crop_sources, shards, image_hashes=None):
+    """
+    Yield the preprocessed crops, paging the stored ones in from the crop
+    shards and only decoding the images of the others. Crops are keyed by the
+    hash of their original image (taken from image_hashes, else computed) and
+    the decode, as named by embedding_variant.
+    """
+    image_hashes = dict() if image_hashes is None else image_hashes
+    decode = embedding_variant()
+    keys = []
+    for img_path in cropped_image_paths:
+        image_path, bbox = crop_sources[img_path]
+        if image_path not in image_hashes:
+            image_hashes[image_path] = hash_file(image_path)
+        keys.append(shards.key(image_hashes[image_path] + decode, bbox))
+
+    missing = [path for path, key in zip(cropped_image_paths, keys) if key not in shards]
+    decoded = iter_crop_images(missing, crop_sources, cfg.TEST.REDUCED_DECODE)
+    for key in keys:
+        pixels = shards.get(key)
+        if pixels is None:
+            pixels = resize_crop(next(decoded))
+            shards.put(key, pixels)
+        yield normalize_crop(pixels)
+
+
+def dump_crops(cropped_image_paths, crop_sources, log_file):
+    """
+    Save the crops as JPEGs at their paths, for debugging (TEST.DUMP_CROPS).
+    """
+    for cropped_img_path, cropped_img in zip(cropped_image_paths, iter_crop_images(cropped_image_paths, crop_sources)):
+        os.makedirs(os.path.dirname(cropped_img_path), exist_ok=True)
+        cropped_img.save(cropped_img_path)
+        log_message(log_file, f"Saved cropped image: {cropped_img_path}")
 
 
 def clear_cropped_folder(cropped_dir, log_file):
@@ -250,71 +522,122 @@ def clear_cropped_folder(cropped_dir, log_file):
                 log_message(log_file, f"Error deleting directory {dir_path}: {e}")
 
 
-def run(image_dir, json_dir, output_dir, reid_output_dir, log_dir = ''):
+def load_reid_model(model_path, reid_output_dir, log_file, model=None):
+    """
+    Load the traced reid model, unless it is given. Returns the model and the
+    name of its variant for embed_crops.
+    """
+    try:
+        return (model if model is not None else load_model(model_path, "cuda")), ""
+    except Exception as e:
+        log_message(log_file, f'Errors: {e}')
+        raise e
+
+
+def run(image_dir, json_dir, output_dir, reid_output_dir, log_dir = '', opts = None, model = None,
+        model_variant = None, detected_variant = None):
+    with trace("reid"):
+        reidentify(image_dir, json_dir, output_dir, reid_output_dir, log_dir, opts, model, model_variant,
+                   detected_variant)
+
+
+def reidentify(image_dir, json_dir, output_dir, reid_output_dir, log_dir = '', opts = None, model = None,
+               model_variant = None, detected_variant = None):
     log_file = create_log_file(log_dir)
     clear_cropped_folder(output_dir, log_file)
 
-    model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "CARE_Traced_GPUv.pt")
-    cfg_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "vit_care.yml")
+    model_path = MODEL_PATH
+    cfg_file_path = CFG_FILE_PATH
 
     print("STATUS: BEGIN", flush=True)
 
-    process_images_in_folder(image_dir, json_dir, output_dir, log_file)
+    # Read and import the cfg file.
+    load_cfg(cfg_file_path, opts)
+
+    with span("scan") as scan:
+        crop_sources, crop_aliases = process_images_in_folder(image_dir, json_dir, output_dir, log_file,
+                                                              dedup=cfg.TEST.DEDUP_IMAGES)
+        scan["items"] = len(crop_sources)
 
     log_message(log_file, f'{torch.cuda.is_available()}')
     DEVICE = "cuda"
 
-    # Read and import the cfg file.
-    cfg.merge_from_file(cfg_file_path)
-    cfg.merge_from_list([])
-    cfg.freeze()
-
-    # Load the traced reid model.
-    try:
-        CARE_Model = torch.jit.load(model_path)
-        CARE_Model = CARE_Model.to(DEVICE)
-        CARE_Model.eval()    # set the model in evaluation mode
-    except Exception as e:
-        log_message(log_file, f'Errors: {e}')
-        raise e
+    # Load the traced reid model, unless the model is given with its variant.
+    if model_variant is None:
+        CARE_Model, model_variant = load_reid_model(model_path, reid_output_dir, log_file, model)
+    else:
+        CARE_Model = model
 
-    cropped_image_paths = sorted(glob.glob(os.path.join(output_dir, "**", "*.jpg"), recursive=True))
+    cropped_image_paths = sorted(crop_sources)
     if not cropped_image_paths:
         log_message(log_file, "No cropped images found. Exiting ReID processing.")
         print("STATUS: DONE", flush=True)
-        sys.exit(0)
-
-    distance_mat = []    # a distance matrix
-    cropped_images = [load_and_preprocess_image(img_path) for img_path in cropped_image_paths]
-    log_message(log_file, cropped_images)
-
-    print("STATUS: PROCESSING", flush=True)
+        return
 
-    total_images = len(cropped_image_paths)
+    blocks = None
+    if cfg.TEST.BLOCKING_KEYS:
+        blocks = Blocks.from_images([crop_sources[path][0] for path in cropped_image_paths], image_dir,
+                                    cfg.TEST.BLOCKING_KEYS,
+                                    time_window = cfg.TEST.BLOCKING_TIME_WINDOW,
+                                    adjacent_windows = cfg.TEST.BLOCKING_ADJACENT_WINDOWS,
+                                    allowed_sites = cfg.TEST.BLOCKING_ALLOWED_SITES)
 
-    # Compute the similarity of each matched image pair.
-    for index in range(total_images):
-        dist = compute_distances(model = CARE_Model,
-                                 query_image = cropped_images[index],
-                                 gallery_images = cropped_images,
-                                 is_duplicate = True,    # check whether the query image has a duplicate in Gallery
-                                 device = DEVICE)
-        distance_mat.append(dist)
+    if cfg.TEST.DUMP_CROPS:
+        dump_crops(cropped_image_paths, crop_sources, log_file)
 
-        print(f"PROCESS: {index+1}/{total_images}", flush=True)
+    print("STATUS: PROCESSING", flush=True)
 
-    id_dict = process_dist_mat_v2(distance_mat)
+    def report_progress(done, total):
+        print(f"PROCESS: {done}/{total}", flush=True)
+
+    cache = None
+    if cfg.TEST.EMBEDDING_CACHE:
+        cache = EmbeddingCache(default_cache_dir(reid_output_dir), [model_path, cfg_file_path],
+                               dtype = cfg.TEST.EMBEDDING_CACHE_DTYPE,
+                               max_bytes = cfg.TEST.EMBEDDING_CACHE_MAX_MB << 20)
+
+    shards = None
+    if cfg.TEST.CROP_SHARDS:
+        shards = CropShards(default_shard_dir(reid_output_dir), tuple(cfg.INPUT.SIZE_TEST),
+                            max_bytes = cfg.TEST.CROP_SHARDS_MAX_MB << 20)
+
+    # Embed every cropped image once, then group them by their nearest neighbours.
+    embeddings = embed_crops(model = CARE_Model,
+                             cropped_image_paths = cropped_image_paths,
+                             crop_sources = crop_sources,
+                             cache = cache,
+                             device = DEVICE,
+                             log_file = log_file,
+                             progress_callback = report_progress,
+                             model_variant = model_variant,
+                             shards = shards,
+                             detected_variant = detected_variant)
+    if shards is not None:
+        shards.save()
+        log_message(log_file, f"Crop shards: {len(shards)} crops stored.")
+
+    if cfg.TEST.INCREMENTAL:
+        # Keep the IDs of known individuals, and only cluster the new ones.
+        model_hash = cache.model_hash if cache else model_fingerprint([model_path, cfg_file_path])[0]
+        gallery = Gallery(default_gallery_dir(reid_output_dir), model_hash,
+                          max_exemplars = cfg.TEST.GALLERY_EXEMPLARS,
+                          variant = embedding_variant(detected_variant or model_variant))
+        id_dict = gallery.assign(embeddings.numpy(),
+                                 max_dist = cfg.TEST.GALLERY_MAX_DIST,
+                                 cluster = lambda e, rows: cluster_embeddings(e, log_file, blocks and blocks.subset(rows)))
+        gallery.save()
+        log_message(log_file, f"Gallery: {len(np.unique(gallery.labels))} known individuals.")
+    else:
+        id_dict = cluster_embeddings(embeddings.numpy(), log_file, blocks)
 
     log_message(log_file, id_dict)
     log_message(log_file, output_dir)
     log_message(log_file, cropped_image_paths)
 
-    output_dict = format_output_dict(cropped_image_paths, id_dict, output_dir)
+    output_dict = format_output_dict(cropped_image_paths, id_dict, output_dir, crop_aliases)
 
     show_results(cropped_image_paths, output_dict, reid_output_dir, log_file)
 
-    clear_cropped_folder(output_dir, log_file)
-
     print("STATUS: DONE", flush=True)
 
 
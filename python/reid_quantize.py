@@ -0,0 +1,75 @@
+"""
+INT8 quantized CARE model for CPU inference.
+
+The ViT in CARE_Traced.pt spends nearly all of its CPU time in Linear layers
+(attention projections and MLPs). Dynamic quantization stores their weights as
+INT8, per output channel, and quantizes the activations on the fly for each
+batch, which typically runs 1.5-2x faster on CPU at a cosine similarity above
+0.999 to the FP32 embeddings. benchmarks/bench_quantization.py measures both on
+a validation folder.
+
+Quantizing takes a while, so the quantized model is saved next to the embedding
+cache, and rebuilt whenever the traced model changes.
+"""
+
+import json
+import os
+
+import torch
+
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic_jit
+
+from embedding_cache import model_fingerprint
+
+
+QUANTIZED_SUFFIX = "_int8"
+
+_loaded = dict()    # quantized models of this process, by path and source hash
+
+
+def quantize_model(model):
+    """
+    Quantize the Linear layers of a traced model to INT8.
+    """
+    model.eval()
+    with torch.inference_mode():
+        return quantize_dynamic_jit(model, {"": per_channel_dynamic_qconfig})
+
+
+def load_quantized_model(model_path, cache_dir):
+    """
+    Load the quantized model of model_path from cache_dir, quantizing and
+    saving it first if it is missing or was made from a different model.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0] + QUANTIZED_SUFFIX
+    quantized_path = os.path.join(cache_dir, name + ".pt")
+    info_path = os.path.join(cache_dir, name + ".json")
+
+    try:
+        with open(info_path, "r") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        info = {}
+    source_hash, source_files = model_fingerprint([model_path], info.get("source_files"))
+
+    if (quantized_path, source_hash) in _loaded:
+        return _loaded[(quantized_path, source_hash)]
+
+    model = None
+    if info.get("source_hash") == source_hash and os.path.exists(quantized_path):
+        try:
+            model = torch.jit.load(quantized_path, map_location="cpu")
+        except RuntimeError:
+            model = None    # a partly written file, quantize again
+    if model is None:
+        model = quantize_model(torch.jit.load(model_path, map_location="cpu"))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = quantized_path + ".tmp"
+        torch.jit.save(model, tmp_path)
+        os.replace(tmp_path, quantized_path)
+        with open(info_path, "w") as f:
+            json.dump({"source_hash": source_hash, "source_files": source_files}, f)
+
+    model.eval()
+    _loaded[(quantized_path, source_hash)] = model
+    return model
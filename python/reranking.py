@@ -0,0 +1,171 @@
+"""
+k-reciprocal re-ranking of ReID neighbour lists (Zhong et al., CVPR 2017).
+
+Two crops are more likely to be the same individual when each is among the
+nearest neighbours of the other. Re-ranking replaces the cosine distance of
+every candidate pair with
+
+    (1 - lambda) * jaccard + lambda * cosine
+
+where jaccard compares the k-reciprocal neighbourhoods of both crops. The
+usual implementation builds dense N x N distance and neighbourhood matrices,
+O(N^2) in memory. Here everything is derived from the (N, k) neighbour lists
+of neighbors.search_neighbors, with each crop's neighbourhood held as a sparse
+row, so time and memory stay near-linear in N * k:
+
+1. R(i): the neighbours j among the k1 nearest of i which also have i among
+   their k1 nearest, vectorized over blocks of rows.
+2. Expansion: R(i) takes in R(j, k1 / 2) of each j in R(i) which shares more
+   than 2/3 of its members with R(i).
+3. V: row i holds exp(-cosine(i, j)) over j in R(i), normalized to sum to 1,
+   stored as a sorted list of row * N + column keys (a CSR matrix).
+4. Query expansion: row i of V becomes the mean of the rows of its k2 nearest
+   neighbours, summing duplicate columns with np.unique and np.bincount.
+5. Jaccard: for each candidate pair, the sum of min(V[i], V[j]) over the
+   columns of row i, looking up V[j] by binary search; as both rows sum to 1,
+   the sum of max is 2 minus the sum of min.
+
+Pairs which are not in each other's neighbour lists keep no distance, as with
+top-k search itself, so k should cover k1.
+"""
+
+import numpy as np
+
+from neighbors import normalize
+
+
+def _expand_ranges(starts, counts):
+    """
+    The concatenation of range(start, start + count) for every start, count.
+    """
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+def reciprocal_neighbors(neighbors, block_size=1024):
+    """
+    Keep the neighbours j of each row i (an (N, k) array, -1 if missing) whose
+    own row also holds i; the others become -1.
+    """
+    reciprocal = np.full_like(neighbors, -1)
+    for start in range(0, len(neighbors), block_size):
+        rows = np.arange(start, min(start + block_size, len(neighbors)))
+        candidates = neighbors[rows]    # ([B, k])
+        back = neighbors[np.maximum(candidates, 0)]    # ([B, k, k])
+        is_reciprocal = (back == rows[:, None, None]).any(axis=2) & (candidates >= 0)
+        reciprocal[rows] = np.where(is_reciprocal, candidates, -1)
+    return reciprocal
+
+
+def neighbourhood_weights(gallery, neighbors, k1, block_size=256):
+    """
+    Build V (steps 1-3) as sorted int64 keys (row * N + column) and float32
+    values.
+    """
+    n = len(gallery)
+    half = max(1, int(round(k1 / 2)))
+    r_full = reciprocal_neighbors(neighbors[:, :k1 + 1])
+    r_half = reciprocal_neighbors(neighbors[:, :half + 1])
+
+    keys, values = [], []
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(start + block_size, n))
+        members = r_full[rows]    # ([B, k1 + 1])
+        expansion = r_half[np.maximum(members, 0)]    # ([B, k1 + 1, half + 1])
+        valid = (expansion >= 0) & (members >= 0)[:, :, None]
+        shared = ((expansion[..., None] == members[:, None, None, :]).any(axis=3) & valid).sum(axis=2)
+        keep = (shared > 2 / 3 * valid.sum(axis=2)) & (members >= 0)
+        expanded = np.where(keep[:, :, None] & valid, expansion, -1).reshape(len(rows), -1)
+
+        # The union of each row's members, as sorted column indices padded with n.
+        union = np.concatenate([members, expanded], axis=1)
+        union = np.where(union < 0, n, union)
+        union.sort(axis=1)
+        union[:, 1:][union[:, 1:] == union[:, :-1]] = n
+        union.sort(axis=1)
+        union = union[:, :max(1, int((union < n).sum(axis=1).max()))]
+        in_union = union < n
+
+        dist = 1 - np.einsum("bd,bmd->bm", gallery[rows], gallery[np.minimum(union, n - 1)])
+        weights = np.where(in_union, np.exp(-dist), 0)
+        weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+        keys.append((rows[:, None] * n + union)[in_union])
+        values.append(weights[in_union].astype(np.float32))
+    return np.concatenate(keys), np.concatenate(values)
+
+
+def query_expansion(keys, values, neighbors, k2, n, block_size=1024):
+    """
+    Replace every row of V by the mean of the rows of its k2 nearest
+    neighbours (step 4).
+    """
+    indptr = np.searchsorted(keys, np.arange(n + 1) * n)
+    neighbors = neighbors[:, :k2]
+    expanded_keys, expanded_values = [], []
+    for start in range(0, n, block_size):
+        rows = np.repeat(np.arange(start, min(start + block_size, n)), k2)
+        sources = neighbors[start:start + block_size].ravel()
+        rows, sources = rows[sources >= 0], sources[sources >= 0]
+        counts = indptr[sources + 1] - indptr[sources]
+        entries = _expand_ranges(indptr[sources], counts)
+        entry_rows = np.repeat(rows, counts)
+        entry_keys = entry_rows * n + keys[entries] % n
+        weights = values[entries] / np.bincount(rows, minlength=n)[entry_rows]
+
+        unique_keys, inverse = np.unique(entry_keys, return_inverse=True)
+        expanded_keys.append(unique_keys)
+        expanded_values.append(np.bincount(inverse, weights=weights).astype(np.float32))
+    return np.concatenate(expanded_keys), np.concatenate(expanded_values)
+
+
+def jaccard_distances(keys, values, indices, n, block_size=1024):
+    """
+    The Jaccard distance between the neighbourhoods of every row and each of
+    its (N, k) candidates (step 5), inf for missing candidates.
+    """
+    indptr = np.searchsorted(keys, np.arange(n + 1) * n)
+    k = indices.shape[1]
+    jaccard = np.full(indices.shape, np.inf, dtype=np.float32)
+    for start in range(0, n, block_size):
+        block = indices[start:start + block_size]
+        pair_rows = np.repeat(np.arange(start, start + len(block)), k)
+        pair_cols = block.ravel()
+        counts = np.where(pair_cols >= 0, indptr[pair_rows + 1] - indptr[pair_rows], 0)
+        entries = _expand_ranges(indptr[pair_rows], counts)
+        pairs = np.repeat(np.arange(len(pair_rows)), counts)
+
+        # Look up V[j, column] for every column of row i.
+        lookup = pair_cols[pairs] * n + keys[entries] % n
+        positions = np.minimum(np.searchsorted(keys, lookup), len(keys) - 1)
+        other = np.where(keys[positions] == lookup, values[positions], 0)
+        shared = np.bincount(pairs, weights=np.minimum(values[entries], other), minlength=len(pair_rows))
+
+        distance = 1 - shared / (2 - shared)
+        jaccard[start:start + len(block)] = np.where(pair_cols >= 0, distance, np.inf).reshape(len(block), k)
+    return jaccard
+
+
+def k_reciprocal_rerank(embeddings, indices, distances, k1=20, k2=6, lambda_value=0.3):
+    """
+    Re-rank the (N, k) neighbour lists of search_neighbors (self excluded,
+    sorted nearest first, -1 / inf if missing). Returns the same candidates
+    with their re-ranked distances, sorted nearest first.
+    """
+    n = len(embeddings)
+    if n < 2 or indices.shape[1] == 0:
+        return indices, distances
+    gallery = normalize(embeddings)
+    # The neighbour lists with every crop first, as its own nearest neighbour.
+    neighbors = np.concatenate([np.arange(n)[:, None], indices], axis=1)
+    k1 = min(k1, indices.shape[1])
+    k2 = min(k2, k1 + 1)
+
+    keys, values = neighbourhood_weights(gallery, neighbors, k1)
+    if k2 > 1:
+        keys, values = query_expansion(keys, values, neighbors, k2, n)
+    jaccard = jaccard_distances(keys, values, indices, n)
+
+    reranked = ((1 - lambda_value) * jaccard + lambda_value * distances).astype(np.float32)
+    reranked[indices < 0] = np.inf
+    order = np.lexsort((indices, reranked), axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(reranked, order, axis=1)
@@ -0,0 +1,111 @@
+"""
+Long-lived detection and ReID worker.
+
+Rather than starting a new Python process for every job, which pays for
+importing torch and loading the models each time, `python main.py serve` keeps
+the models warm and reads jobs as newline
+delimited JSON on stdin, one per line:
+
+    {"id": "1", "task": "detection", "args": {"original_images_dir": ..., "output_images_dir": ...,
+                                              "json_output_dir": ..., "log_dir": ...}}
+    {"id": "2", "task": "reid", "args": {"image_dir": ..., "json_dir": ..., "output_dir": ...,
+                                         "reid_output_dir": ..., "log_dir": ...},
+     "opts": ["TEST.INCREMENTAL", "True"]}
+    {"task": "shutdown"}
+
+The args are the same as for the CLI tasks; detection jobs also take the
+optional reduced_decode and, on CPU, engine ("torch" or "onnx", see engines.py)
+args. Jobs run one at a time and print the usual STATUS:/PROCESS:/METRIC: lines
+(see tracing.py) on stdout, followed by a single result line:
+
+    JOB: {"id": "1", "ok": true, "seconds": 0.52}
+    JOB: {"id": "2", "ok": false, "seconds": 0.01, "error": "..."}
+
+The worker exits on a shutdown job or when stdin is closed.
+"""
+
+import importlib
+import json
+import sys
+import time
+import torch
+import traceback
+
+from embedding_cache import default_cache_dir
+from engines import resolve_engine
+
+
+class Server:
+    """
+    Runs jobs with models which are loaded on first use and then kept.
+    """
+
+    def __init__(self):
+        self.use_gpu = torch.cuda.is_available()
+        self.detection_models = dict()    # by engine
+        self.reid_model = None
+
+    def task_module(self, task):
+        """
+        The module of a task for this device, imported on its first job.
+        """
+        return importlib.import_module(f"{task}_gpu" if self.use_gpu else f"{task}_cpu")
+
+    def run_detection(self, args):
+        detection = self.task_module("detection")
+        if self.use_gpu:
+            if "gpu" not in self.detection_models:
+                self.detection_models["gpu"] = detection.load_model()
+            detection.run(**args, yolo_model=self.detection_models["gpu"])
+            return
+        engine = resolve_engine(args.pop("engine", None))
+        if engine not in self.detection_models:
+            export_dir = default_cache_dir(args["json_output_dir"])
+            self.detection_models[engine] = detection.load_model(engine=engine, export_dir=export_dir)
+        detection.run(**args, yolo_model=self.detection_models[engine], engine=engine)
+
+    def run_reid(self, args, opts):
+        reid = self.task_module("reid")
+        if self.reid_model is None:
+            self.reid_model = reid.load_model(device="cuda" if self.use_gpu else "cpu")
+        reid.run(**args, opts=opts, model=self.reid_model)
+
+    def handle(self, job):
+        """
+        Run a single job, returning its result.
+        """
+        start_time = time.time()
+        result = {"id": job.get("id")}
+        try:
+            match (job.get("task")):
+                case "detection":
+                    self.run_detection(job.get("args", {}))
+                case "reid":
+                    self.run_reid(job.get("args", {}), job.get("opts"))
+                case task:
+                    raise ValueError(f"Invalid task {task}")
+            result["ok"] = True
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            result["ok"] = False
+            result["error"] = str(e)
+        result["seconds"] = round(time.time() - start_time, 3)
+        return result
+
+
+def serve():
+    server = Server()
+    print("STATUS: READY", flush=True)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            print(f"JOB: {json.dumps({'id': None, 'ok': False, 'error': f'Invalid job: {e}'})}", flush=True)
+            continue
+        if job.get("task") == "shutdown":
+            break
+        result = server.handle(job)
+        print(f"JOB: {json.dumps(result)}", flush=True)
@@ -0,0 +1,41 @@
+"""
+The ReID grouping (clustering.py) against the original row-by-row
+implementation, on random distance matrices.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_DIR)
+sys.path.insert(0, os.path.join(PYTHON_DIR, "benchmarks"))
+
+from clustering import CANDIDATE_WINDOW, group_candidates, process_dist_mat_v2    # noqa: E402
+from neighbors import stream_candidates    # noqa: E402
+from reference import reference_process_dist_mat_v2    # noqa: E402
+from synthetic import random_dist_mat    # noqa: E402
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_groupings_match_the_original_implementation(seed):
+    rng = np.random.default_rng(seed)
+    dist_mat = random_dist_mat(rng, int(rng.integers(1, 300)))
+    assert process_dist_mat_v2(dist_mat) == reference_process_dist_mat_v2(dist_mat)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_streamed_candidates_give_the_same_groupings(seed):
+    rng = np.random.default_rng(seed)
+    individuals = rng.normal(size=(int(rng.integers(2, 20)), 32))
+    embeddings = individuals[rng.integers(0, len(individuals), 200)]
+    embeddings = (embeddings + rng.uniform(0.05, 1.0) * rng.normal(size=embeddings.shape)).astype(np.float32)
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    dist_mat = 1 - normed @ normed.T
+    rows = np.arange(len(dist_mat))
+    dist_mat[rows, np.argmin(dist_mat, axis=1)] = np.max(dist_mat, axis=1) + 1
+
+    candidates = stream_candidates(embeddings, window=CANDIDATE_WINDOW, block_size=64)
+    assert group_candidates(candidates) == reference_process_dist_mat_v2(dist_mat)
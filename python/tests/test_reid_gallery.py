@@ -0,0 +1,81 @@
+"""
+Stable IDs of incremental ReID (reid_gallery.Gallery).
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clustering import CANDIDATE_WINDOW, group_candidates    # noqa: E402
+from neighbors import stream_candidates    # noqa: E402
+from reid_gallery import Gallery    # noqa: E402
+
+
+MAX_DIST = 0.3
+
+
+def cluster(embeddings, rows):
+    return group_candidates(stream_candidates(embeddings, window=CANDIDATE_WINDOW))
+
+
+def sightings(rng, individuals, per_individual, noise=0.05):
+    """
+    per_individual noisy embeddings of each individual, in a shuffled burst.
+    """
+    labels = np.repeat(np.arange(len(individuals)), per_individual)
+    rng.shuffle(labels)
+    embeddings = individuals[labels] + noise * rng.normal(size=(len(labels), individuals.shape[1]))
+    return embeddings.astype(np.float32), labels
+
+
+def ids_of(output_dict, n):
+    ids = np.empty(n, dtype=np.int64)
+    for individual, members in output_dict.items():
+        ids[members] = individual
+    return ids
+
+
+def test_same_images_keep_their_ids(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings, _ = sightings(rng, rng.normal(size=(1, 64)), per_individual=31)
+    embeddings[1::3] = embeddings[0]    # identical frames of a burst
+
+    gallery = Gallery(str(tmp_path), "model")
+    first = ids_of(gallery.assign(embeddings, MAX_DIST, cluster), len(embeddings))
+    gallery.save()
+    # The same crops again, embedded with a little numerical jitter (e.g. from another decode or batch size).
+    rerun = embeddings + 1e-3 * rng.normal(size=embeddings.shape).astype(np.float32)
+    rerun[1::3] = rerun[0]
+    second = ids_of(Gallery(str(tmp_path), "model").assign(rerun, MAX_DIST, cluster), len(rerun))
+    assert np.array_equal(first, second)
+
+
+def test_repeated_sightings_in_one_batch_keep_known_ids(tmp_path):
+    rng = np.random.default_rng(1)
+    individuals = rng.normal(size=(5, 64))
+    gallery = Gallery(str(tmp_path), "model")
+    known, known_labels = sightings(rng, individuals, per_individual=3)
+    known_ids = ids_of(gallery.assign(known, MAX_DIST, cluster), len(known))
+    gallery.save()
+    id_of_individual = dict(zip(known_labels, known_ids))
+    assert len(set(id_of_individual.values())) == len(individuals)
+
+    gallery = Gallery(str(tmp_path), "model")
+    burst, burst_labels = sightings(rng, individuals, per_individual=4)
+    burst_ids = ids_of(gallery.assign(burst, MAX_DIST, cluster), len(burst))
+    assert np.array_equal(burst_ids, [id_of_individual[label] for label in burst_labels])
+    assert gallery.meta["next_id"] == len(individuals)
+
+
+def test_other_embedding_variants_start_a_new_gallery(tmp_path):
+    rng = np.random.default_rng(2)
+    embeddings, _ = sightings(rng, rng.normal(size=(2, 64)), per_individual=3)
+    gallery = Gallery(str(tmp_path), "model")
+    gallery.assign(embeddings, MAX_DIST, cluster)
+    gallery.save()
+
+    assert len(Gallery(str(tmp_path), "model").labels) == len(embeddings)
+    assert len(Gallery(str(tmp_path), "model", variant="int8").labels) == 0
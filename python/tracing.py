@@ -0,0 +1,181 @@
+"""
+Lightweight tracing of the stages of detection and ReID.
+
+Code marks its stages with spans, which are no-ops unless a run is being traced:
+
+    with span("infer", items=len(batch)):
+        ...
+    for crop in traced_iter("crop", iter_crops(...)):    # each next() is a span
+        ...
+
+detection and reid trace every run. Each span name (scan, decode, infer,
+annotate, write, crop, embed, distance, rerank, cluster) accumulates its number
+of calls, items, wall time, CPU time and peak RSS, and at the end of the run
+every name is reported on stdout as a METRIC line, next to the STATUS and
+PROCESS lines of the progress protocol, followed by the run as a whole:
+
+    METRIC: {"task": "detection", "span": "decode", "calls": 40, "items": 40, "wall_s": 0.61, "cpu_s": 0.58, "peak_rss_mb": 812.4}
+
+Spans may run on several threads at once (e.g. decode and write), so wall_s is
+the time spent in the span summed over the threads, and cpu_s is the CPU time
+of the thread which ran it; work the span hands to other threads, like torch's
+intra-op threads during infer and embed, only shows in the CPU time of the
+whole run. The RSS of the process is sampled every RSS_INTERVAL seconds while
+spans are open, and at both ends of each span.
+
+Set CARE_TRACE to a folder to also save every span of a run as a Chrome trace
+(<task>_<timestamp>.json, viewable in chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import psutil
+
+
+RSS_INTERVAL = 0.05
+
+_current = None    # the tracer of the run in progress, if any
+
+
+class Tracer:
+    """
+    Accumulates the spans of one run of a task.
+    """
+
+    def __init__(self, task, trace_dir=None):
+        self.task = task
+        self.trace_dir = trace_dir
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.stats = dict()
+        self.events = [] if trace_dir else None
+        self.open_spans = dict()    # id -> peak RSS while open
+        self.run_peak_rss = 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.sampler.start()
+
+    def _rss(self):
+        rss = self.process.memory_info().rss
+        self.run_peak_rss = max(self.run_peak_rss, rss)
+        return rss
+
+    def _sample_rss(self):
+        while not self.stopped.wait(RSS_INTERVAL):
+            with self.lock:
+                if not self.open_spans:
+                    continue
+                rss = self._rss()
+                for key, peak in self.open_spans.items():
+                    self.open_spans[key] = max(peak, rss)
+
+    @contextlib.contextmanager
+    def span(self, name, items=1):
+        key = object()
+        with self.lock:
+            self.open_spans[key] = self._rss()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        info = {"items": items}
+        try:
+            yield info
+        finally:
+            items = info["items"]
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            with self.lock:
+                peak_rss = max(self.open_spans.pop(key), self._rss())
+                stats = self.stats.setdefault(name, {"calls": 0, "items": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                     "peak_rss": 0})
+                stats["calls"] += 1
+                stats["items"] += items
+                stats["wall_s"] += wall
+                stats["cpu_s"] += cpu
+                stats["peak_rss"] = max(stats["peak_rss"], peak_rss)
+                if self.events is not None:
+                    self.events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                                        "ts": (start_wall - self.start_wall) * 1e6, "dur": wall * 1e6,
+                                        "args": {"items": items}})
+
+    def metrics(self):
+        """
+        The totals of each span name, in the order they were first closed,
+        then of the whole run.
+        """
+        with self.lock:
+            metrics = [{"task": self.task, "span": name, "calls": s["calls"], "items": s["items"],
+                        "wall_s": round(s["wall_s"], 4), "cpu_s": round(s["cpu_s"], 4),
+                        "peak_rss_mb": round(s["peak_rss"] / 2**20, 1)}
+                       for name, s in self.stats.items()]
+            metrics.append({"task": self.task, "span": "total", "calls": 1, "items": 0,
+                            "wall_s": round(time.perf_counter() - self.start_wall, 4),
+                            "cpu_s": round(time.process_time() - self.start_cpu, 4),
+                            "peak_rss_mb": round(max(self.run_peak_rss, self._rss()) / 2**20, 1)})
+        return metrics
+
+    def stop(self):
+        """
+        Stop sampling, print the METRIC lines and save the Chrome trace.
+        """
+        self.stopped.set()
+        self.sampler.join()
+        for metric in self.metrics():
+            print(f"METRIC: {json.dumps(metric)}", flush=True)
+        if self.events is not None:
+            self.save_trace()
+
+    def save_trace(self):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(self.trace_dir, f"{self.task}_{timestamp}.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+@contextlib.contextmanager
+def trace(task):
+    """
+    Trace the spans of a run of task, reporting them when it ends, even if it
+    fails.
+    """
+    global _current
+    previous, _current = _current, Tracer(task, os.environ.get("CARE_TRACE") or None)
+    try:
+        yield _current
+    finally:
+        tracer, _current = _current, previous
+        tracer.stop()
+
+
+def span(name, items=1):
+    """
+    A span of the run being traced, or a no-op. Yields a dict whose "items"
+    can be updated before the span ends.
+    """
+    if _current is None:
+        return contextlib.nullcontext({"items": items})
+    return _current.span(name, items)
+
+
+def traced_iter(name, iterable):
+    """
+    Iterate over iterable, timing the production of each item as a span of one
+    item. The call which finds the end counts as a span of no items.
+    """
+    iterator = iter(iterable)
+    while True:
+        with span(name) as info:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                info["items"] = 0
+                return
+        yield item